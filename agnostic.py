@@ -6,25 +6,50 @@ This script updates your IP address on the MyAnonamouse (MAM) website.
 It provides a simple graphical interface for entering necessary information.
 You can choose how the script gets your IP address: by entering it yourself, fetching it from a website, or from a Docker container.
 The script works on Windows, macOS, and Linux.
+Run it with mam_cli.py options (e.g. --mam_cookie, --container_name) to update once without the GUI.
 
 Author: Your Name
 Version: 1.2
 """
 
+import sys
+
+# Given mam_cli.py options, run a single headless update instead of the GUI,
+# before tkinter is imported, so this also works on machines without Tk
+if __name__ == '__main__' and len(sys.argv) > 1:
+    from mam_cli import main, wants_cli
+    if wants_cli(sys.argv[1:]):
+        sys.exit(main())
+
 import tkinter as tk
 from tkinter import messagebox, filedialog, ttk
-import subprocess
-import sys
 import os
-import re
-import json
 import configparser
+import logging
+import logging.handlers
+import queue
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from mam_containers import DEFAULT_CACHE_TTL, DEFAULT_NEGATIVE_TTL
+from mam_core import Account, Updater, DEFAULT_IP_URL, DEFAULT_UPDATE_TIMEOUT, DEFAULT_URL, NETWORK_EXEC
+from mam_http import HTTPClient
+from mam_metrics import Metrics
+from mam_reload import ConfigWatcher
+
+# The output pane keeps only the newest lines; everything also goes to MAM.log in the state directory
+DEFAULT_OUTPUT_MAX_LINES = 500
+OUTPUT_FLUSH_INTERVAL = 250
+LOG_FILE = 'MAM.log'
+DEFAULT_LOG_MAX_BYTES = 1024 * 1024
+DEFAULT_LOG_BACKUPS = 3
 
 class MAMUpdaterApp:
     def __init__(self, root):
         self.root = root
         self.root.title("MyAnonamouse IP Updater")
-        self.root.geometry("600x500")
+        self.root.geometry("600x560")
         self.root.resizable(False, False)
 
         # Initialize variables
@@ -32,9 +57,26 @@ class MAMUpdaterApp:
         self.settings = configparser.ConfigParser()
         self.load_settings()
 
+        # Background worker for the update pipeline; results come back through a queue
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='mam-update')
+        self.output_queue = queue.Queue()
+        self.update_future = None
+        self.current_updater = None
+        self.http = HTTPClient()
+        self.metrics = Metrics()
+        self.output_lines = deque(maxlen=max(1, self.settings.getint('DEFAULT', 'output_max_lines', fallback=DEFAULT_OUTPUT_MAX_LINES)))
+        self.log_handler = None
+
         # Create GUI elements
         self.create_widgets()
 
+        # Pick up edits made to the config file while the app is open
+        self.config_watcher = ConfigWatcher(self.config_file, lambda settings: self.output_queue.put(('settings', settings)),
+                                            on_error=lambda message: self.append_output(message + "\n")).start()
+
+        self.root.protocol("WM_DELETE_WINDOW", self.on_close)
+        self.root.after(OUTPUT_FLUSH_INTERVAL, self.process_output_queue)
+
     def create_widgets(self):
         # Style configuration
         style = ttk.Style()
@@ -81,11 +123,11 @@ class MAMUpdaterApp:
         # External IP Website
         external_ip_label = ttk.Label(self.external_ip_frame, text="Website to Fetch IP From:")
         external_ip_label.grid(row=0, column=0, sticky='e', pady=5)
-        external_ip_label_ttp = CreateToolTip(external_ip_label, "The website that shows your IP address.\nDefault is the MyAnonamouse website.")
+        external_ip_label_ttp = CreateToolTip(external_ip_label, "The website that shows your IP address.\nDefault is the MyAnonamouse website.\nSeparate several websites with commas to use whichever answers first.")
 
         self.external_ip_entry = ttk.Entry(self.external_ip_frame, width=50)
         self.external_ip_entry.grid(row=0, column=1, padx=5, pady=5)
-        self.external_ip_entry.insert(0, self.settings.get('DEFAULT', 'external_ip_url', fallback='https://www.myanonamouse.net/myip.php'))
+        self.external_ip_entry.insert(0, self.settings.get('DEFAULT', 'external_ip_url', fallback=DEFAULT_IP_URL))
 
         # Docker Container Name
         container_name_label = ttk.Label(self.docker_ip_frame, text="Docker Container Name:")
@@ -126,6 +168,11 @@ class MAMUpdaterApp:
         self.update_button = ttk.Button(button_frame, text="Update IP Now", command=self.update_ip)
         self.update_button.pack(side=tk.LEFT, padx=5)
 
+        self.profile_var = tk.IntVar(value=0)
+        profile_check = ttk.Checkbutton(button_frame, text="Profile", variable=self.profile_var)
+        profile_check.pack(side=tk.LEFT, padx=5)
+        profile_ttp = CreateToolTip(profile_check, "Profile the next updates (time per step, memory, processes started).\nReports are saved in the MAM.profile folder of the state directory.")
+
         # Help Button
         help_button = ttk.Button(main_frame, text="Help", command=self.show_help)
         help_button.grid(row=7, column=2, padx=5, pady=5)
@@ -139,6 +186,12 @@ class MAMUpdaterApp:
         output_scrollbar.grid(row=10, column=3, sticky='ns', pady=5)
         self.output_text.configure(yscrollcommand=output_scrollbar.set)
 
+        # Stats Panel
+        self.stats_var = tk.StringVar(value="No updates yet.")
+        stats_label = ttk.Label(main_frame, textvariable=self.stats_var, font=('Arial', 9), justify=tk.LEFT)
+        stats_label.grid(row=11, column=0, columnspan=3, sticky='w', padx=5)
+        stats_label_ttp = CreateToolTip(stats_label, "Update counts since the app started, and how long each step of the last update took.")
+
         # Initialize fields based on IP method
         self.update_ip_method_fields(self.ip_method_var.get())
 
@@ -227,6 +280,39 @@ This tool helps you update your IP address on the MyAnonamouse (MAM) website, en
         else:
             self.settings['DEFAULT'] = {}
 
+    def apply_settings(self, settings):
+        """
+        Switch to settings reloaded from the config file. Only fields whose saved value
+        changed are refreshed, so unsaved edits in the other fields are kept.
+        """
+        old, new = self.settings['DEFAULT'], settings['DEFAULT']
+        if {name: dict(settings[name]) for name in settings} == {name: dict(self.settings[name]) for name in self.settings}:
+            # Our own Save Settings
+            return
+        fields = (
+            ('mam_cookie', self.mam_cookie_entry, ''),
+            ('manual_ip', self.manual_ip_entry, ''),
+            ('external_ip_url', self.external_ip_entry, DEFAULT_IP_URL),
+            ('container_name', self.container_name_entry, ''),
+            ('statedir', self.statedir_entry, os.path.expanduser("~")),
+        )
+        for key, entry, fallback in fields:
+            if new.get(key, fallback) != old.get(key, fallback):
+                entry.delete(0, tk.END)
+                entry.insert(0, new.get(key, fallback))
+        if new.get('ip_method', 'Fetch from Website') != old.get('ip_method', 'Fetch from Website'):
+            self.ip_method_var.set(new.get('ip_method', 'Fetch from Website'))
+            self.update_ip_method_fields(self.ip_method_var.get())
+        if new.getboolean('run_on_startup', fallback=False) != old.getboolean('run_on_startup', fallback=False):
+            self.run_on_startup_var.set(new.getboolean('run_on_startup', fallback=False))
+        self.resize_output(max(1, new.getint('output_max_lines', fallback=DEFAULT_OUTPUT_MAX_LINES)))
+        self.settings = settings
+        # The log file is reopened with the new rotation settings
+        if self.log_handler is not None:
+            self.log_handler.close()
+            self.log_handler = None
+        self.write_output("Settings reloaded from the config file.\n")
+
     def save_settings(self):
         self.settings['DEFAULT']['mam_cookie'] = self.mam_cookie_entry.get()
         self.settings['DEFAULT']['ip_method'] = self.ip_method_var.get()
@@ -234,7 +320,7 @@ This tool helps you update your IP address on the MyAnonamouse (MAM) website, en
         self.settings['DEFAULT']['external_ip_url'] = self.external_ip_entry.get() if self.ip_method_var.get() == 'Fetch from Website' else ''
         self.settings['DEFAULT']['container_name'] = self.container_name_entry.get() if self.ip_method_var.get() == 'From Docker Container' else ''
         self.settings['DEFAULT']['statedir'] = self.statedir_entry.get()
-        self.settings['DEFAULT']['url'] = 'https://t.myanonamouse.net/json/dynamicSeedbox.php'
+        self.settings['DEFAULT']['url'] = DEFAULT_URL
         self.settings['DEFAULT']['run_on_startup'] = str(self.run_on_startup_var.get())
 
         with open(self.config_file, 'w') as configfile:
@@ -350,140 +436,163 @@ Comment=Updates the IP address on MyAnonamouse
             os.remove(plist_path)
 
     def update_ip(self):
-        mam_cookie = self.mam_cookie_entry.get().strip()
-        ip_method = self.ip_method_var.get()
-        statedir = self.statedir_entry.get().strip()
-        url = 'https://t.myanonamouse.net/json/dynamicSeedbox.php'
-
-        if not mam_cookie or not statedir:
-            self.append_output("Error: Please fill in all required fields marked with *.\n")
-            return
-
-        cachefile = os.path.join(statedir, 'MAM.ip')
-        cookiefile = os.path.join(statedir, 'MAM.cookie')
-
-        # Ensure the state directory exists
-        try:
-            os.makedirs(statedir, exist_ok=True)
-        except Exception as e:
-            self.append_output(f"Error creating directory '{statedir}': {e}\n")
-            return
-
-        # Retrieve the current IP address based on the selected method
-        if ip_method == "Enter Manually":
-            current_ip = self.manual_ip_entry.get().strip()
-            if not current_ip:
-                self.append_output("Error: Please enter your IP address.\n")
-                return
-        elif ip_method == "Fetch from Website":
-            external_ip_url = self.external_ip_entry.get().strip()
-            current_ip = self.get_external_ip(external_ip_url)
-            if not current_ip:
-                return
-        elif ip_method == "From Docker Container":
-            container_name = self.container_name_entry.get().strip()
-            if not container_name:
-                self.append_output("Error: Please enter the Docker container name.\n")
-                return
-            current_ip = self.get_docker_ip(container_name)
-            if not current_ip:
-                return
-        else:
-            self.append_output("Error: Invalid IP retrieval method selected.\n")
+        # Ignore clicks while a run is still in flight
+        if self.update_future is not None and not self.update_future.done():
             return
 
-        # Update MAM.ip file regardless of IP change
+        # Read the widgets on the Tk thread; the worker only sees plain values
+        params = {
+            'mam_cookie': self.mam_cookie_entry.get().strip(),
+            'ip_method': self.ip_method_var.get(),
+            'statedir': self.statedir_entry.get().strip(),
+            'manual_ip': self.manual_ip_entry.get().strip(),
+            'external_ip_url': self.external_ip_entry.get().strip(),
+            'container_name': self.container_name_entry.get().strip(),
+            'url': self.settings.get('DEFAULT', 'url', fallback=''),
+            'docker_network': self.settings.get('DEFAULT', 'docker_network', fallback=NETWORK_EXEC),
+            'netns': self.settings.get('DEFAULT', 'netns', fallback=''),
+            'update_timeout': self.settings.get('DEFAULT', 'update_timeout', fallback=str(DEFAULT_UPDATE_TIMEOUT)),
+            'docker_cache_ttl': self.settings.get('DEFAULT', 'docker_cache_ttl', fallback=str(DEFAULT_CACHE_TTL)),
+            'docker_negative_ttl': self.settings.get('DEFAULT', 'docker_negative_ttl', fallback=str(DEFAULT_NEGATIVE_TTL)),
+        }
+
+        self.update_button.configure(state='disabled')
+        self.update_future = self.executor.submit(self.run_update, params, bool(self.profile_var.get()))
+        self.update_future.add_done_callback(lambda future: self.output_queue.put(('done', None)))
+
+    def run_update(self, params, profile=False):
         try:
-            with open(cachefile, 'w') as f:
-                f.write(current_ip)
+            updater = self.current_updater = Updater(Account(**params), self.http)
+            started = time.monotonic()
+            profiler = None
+            try:
+                # The button always asks MAM, like the script did before change detection
+                if profile:
+                    from mam_profile import profile_updates
+                    result, profiler = profile_updates(updater, force=True)
+                else:
+                    result = updater.run(force=True)
+            finally:
+                self.current_updater = None
+                updater.close()
+            self.metrics.record(updater, result, time.monotonic() - started)
+            self.append_output(result.message + "\n")
+            self.output_queue.put(('stats', updater.account.name))
+            if profiler is not None:
+                self.save_profile(profiler, updater.account)
         except Exception as e:
-            self.append_output(f"Error writing to file '{cachefile}': {e}\n")
-            return
+            self.append_output(f"Error: Unexpected failure while updating IP: {e}\n")
 
-        # Create the cookie file with the special session cookie
+    def save_profile(self, profiler, account):
+        from mam_profile import ProfileError
         try:
-            with open(cookiefile, 'w') as f:
-                f.write(f"""# Netscape HTTP Cookie File
-# This file was generated by the MAM IP Updater script
-.t.myanonamouse.net\tTRUE\t/\tFALSE\t0\tmam_id\t{mam_cookie}
-""")
-        except Exception as e:
-            self.append_output(f"Error creating file '{cookiefile}': {e}\n")
-            return
+            self.append_output(f"Profile saved to '{profiler.save(account.statedir, account)}'.\n")
+        except ProfileError as e:
+            self.append_output(f"Error: {e}\n")
 
-        # Update the dynamic seedbox IP
-        success, message = self.update_seedbox_ip(mam_cookie, cookiefile, url)
-        self.append_output(message + "\n")
+    def append_output(self, text):
+        # Safe to call from any thread; the Tk thread drains the queue
+        self.output_queue.put(('output', text))
 
-    def get_external_ip(self, external_ip_url):
+    def process_output_queue(self):
+        # Output queued since the last tick is written to the widget in one batch
+        batch = []
         try:
-            result = subprocess.run(['curl', '-s', external_ip_url], stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, check=True)
-            response = result.stdout.strip()
-            if not response:
-                self.append_output("Error: Failed to retrieve IP address from the website.\n")
-                return None
-
-            # Extract IP address using regex
-            ip_match = re.search(r'\b(?:[0-9]{1,3}\.){3}[0-9]{1,3}\b', response)
-            if ip_match:
-                current_ip = ip_match.group(0)
-                return current_ip
-            else:
-                self.append_output("Error: No valid IP address found in the website's response.\n")
-                return None
-        except subprocess.CalledProcessError as e:
-            self.append_output(f"Error retrieving IP address: {e}\n")
-            return None
-
-    def get_docker_ip(self, container_name):
-        try:
-            result = subprocess.run(['docker', 'exec', container_name, 'curl', '-s', 'https://www.myanonamouse.net/myip.php'], stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, check=True)
-            response = result.stdout.strip()
-            if not response:
-                self.append_output(f"Error: Failed to retrieve IP address from Docker container '{container_name}'.\n")
-                return None
-
-            # Extract IP address using regex
-            ip_match = re.search(r'\b(?:[0-9]{1,3}\.){3}[0-9]{1,3}\b', response)
-            if ip_match:
-                current_ip = ip_match.group(0)
-                return current_ip
-            else:
-                self.append_output("Error: No valid IP address found in the container's response.\n")
-                return None
-        except subprocess.CalledProcessError as e:
-            self.append_output(f"Error retrieving IP address: {e}\n")
-            return None
-
-    def update_seedbox_ip(self, mam_cookie, cookiefile, url):
-        try:
-            command = [
-                'curl', '-s',
-                '-b', f"mam_id={mam_cookie}",
-                '-c', cookiefile,
-                url
-            ]
-            result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, check=True)
-            response = result.stdout.strip()
-            if not response:
-                return False, "Error: Failed to get a response from the MyAnonamouse website."
-            response_json = json.loads(response)
-            success = response_json.get('Success')
-            message = response_json.get('msg')
-            if success == True:
-                return True, f"Success: {message}"
-            else:
-                return False, f"Failed: {message}"
-        except subprocess.CalledProcessError as e:
-            return False, f"Error updating IP address: {e}"
-        except json.JSONDecodeError:
-            return False, "Error: Received invalid response from the MyAnonamouse website."
-
-    def append_output(self, text):
+            while True:
+                kind, text = self.output_queue.get_nowait()
+                if kind == 'output':
+                    batch.append(text)
+                elif kind == 'stats':
+                    self.show_stats(text)
+                elif kind == 'settings':
+                    if batch:
+                        self.write_output(''.join(batch))
+                        batch = []
+                    self.apply_settings(text)
+                elif kind == 'done':
+                    self.update_button.configure(state='normal')
+        except queue.Empty:
+            pass
+        if batch:
+            self.write_output(''.join(batch))
+        self.root.after(OUTPUT_FLUSH_INTERVAL, self.process_output_queue)
+
+    def show_stats(self, account_name):
+        stats = self.metrics.summary(account_name)
+        results = stats['results']
+        failed = sum(results.get(status, 0) for status in ('failed', 'error', 'timeout'))
+        lines = [f"Updates: {stats['attempts']}  ·  changed {results.get('updated', 0)}  ·  unchanged {results.get('unchanged', 0)}"
+                 f"  ·  rate limited {results.get('rate_limited', 0)}  ·  failed {failed}"]
+        last = stats['last']
+        if last:
+            phases = ', '.join(f"{phase} {seconds:.2f}s" for phase, seconds in last['timings'].items())
+            lines.append(f"Last update: {last['elapsed']:.2f}s ({phases})")
+        cache = stats['container_cache']
+        if any(cache.values()):
+            lines.append(f"Container cache: {cache.get('hit', 0)} hits  ·  {cache.get('negative_hit', 0)} skipped (container down)  ·  {cache.get('miss', 0)} misses")
+        self.stats_var.set('\n'.join(lines))
+
+    def write_output(self, text):
+        lines = text.splitlines()
+        if not lines:
+            return
+        self.write_log_file(lines)
+        # The widget mirrors the ring buffer: lines pushed out of it are deleted from the top
+        maxlen = self.output_lines.maxlen
+        overflow = min(len(self.output_lines), max(0, len(self.output_lines) + len(lines) - maxlen))
+        self.output_lines.extend(lines)
+        follow = self.output_text.yview()[1] >= 1.0
         self.output_text.configure(state='normal')
-        self.output_text.insert(tk.END, text)
+        if len(lines) >= maxlen:
+            self.output_text.delete('1.0', tk.END)
+        elif overflow:
+            self.output_text.delete('1.0', f'{overflow + 1}.0')
+        self.output_text.insert(tk.END, ''.join(line + '\n' for line in lines[-maxlen:]))
         self.output_text.configure(state='disabled')
-        self.output_text.see(tk.END)
+        # Don't pull the view away from someone reading older messages
+        if follow:
+            self.output_text.see(tk.END)
+
+    def resize_output(self, maxlen):
+        if maxlen == self.output_lines.maxlen:
+            return
+        overflow = max(0, len(self.output_lines) - maxlen)
+        self.output_lines = deque(self.output_lines, maxlen=maxlen)
+        if overflow:
+            self.output_text.configure(state='normal')
+            self.output_text.delete('1.0', f'{overflow + 1}.0')
+            self.output_text.configure(state='disabled')
+
+    def write_log_file(self, lines):
+        statedir = self.statedir_entry.get().strip()
+        path = os.path.abspath(os.path.join(statedir, LOG_FILE)) if statedir and os.path.isdir(statedir) else None
+        if self.log_handler is not None and self.log_handler.baseFilename != path:
+            self.log_handler.close()
+            self.log_handler = None
+        if path is None:
+            return
+        if self.log_handler is None:
+            try:
+                self.log_handler = logging.handlers.RotatingFileHandler(
+                    path, encoding='utf-8',
+                    maxBytes=self.settings.getint('DEFAULT', 'log_max_bytes', fallback=DEFAULT_LOG_MAX_BYTES),
+                    backupCount=self.settings.getint('DEFAULT', 'log_backups', fallback=DEFAULT_LOG_BACKUPS))
+            except OSError:
+                return
+        stamp = time.strftime('%Y-%m-%d %H:%M:%S')
+        for line in lines:
+            self.log_handler.emit(logging.makeLogRecord({'msg': f"{stamp} {line}"}))
+
+    def on_close(self):
+        updater = self.current_updater
+        if updater is not None:
+            updater.cancel()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.http.close()
+        self.config_watcher.stop()
+        if self.log_handler is not None:
+            self.log_handler.close()
+        self.root.destroy()
 
 class CreateToolTip(object):
     """
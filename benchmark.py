@@ -0,0 +1,457 @@
+#!/usr/bin/env python3
+
+"""
+Description:
+Benchmark harness for the MAM IP Updater.
+It starts local stand-ins for myip.php (plain and HTML-wrapped replies), dynamicSeedbox.php
+(success, "Last change too recent", malformed JSON and slow replies) and the Docker daemon
+(a unix socket and a fake docker executable). Every scenario then runs one update in a
+fresh interpreter, recording end-to-end latency, time per phase, process spawns and peak
+RSS. Results are written as JSON; --compare shows the change against an earlier file.
+
+Usage:
+    python3 benchmark.py [--iterations N] [--methods M ...] [--replies R ...] [--output FILE] [--compare OLD.json]
+"""
+
+import argparse
+import http.server
+import json
+import os
+import platform
+import shutil
+import socketserver
+import statistics
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+STUB_IP = '203.0.113.10'
+CONTAINER_NAME = 'bench-vpn'
+CONTAINER_ID = 'bench0'
+DEFAULT_ITERATIONS = 3
+DEFAULT_SLOW_DELAY = 0.5
+DEFAULT_UPDATE_TIMEOUT = 10
+
+METHODS = ('manual', 'website_html', 'website_plain', 'docker_socket', 'docker_cli', 'netns')
+# 'unchanged' has MAM.ip already holding the current IP, so no API call is made
+REPLIES = ('success', 'rate_limited', 'malformed', 'slow', 'unchanged')
+
+# Audit events that start a new process; subprocess's own posix_spawn is not counted twice
+SPAWN_EVENTS = ('subprocess.Popen', 'os.system', 'os.fork', 'os.forkpty', 'os.spawn')
+
+
+class StubServer(http.server.ThreadingHTTPServer):
+    """
+    Serves /myip.php (HTML), /myip.txt (plain) and /json/<reply>/dynamicSeedbox.php.
+    """
+    daemon_threads = True
+
+    def __init__(self, slow_delay):
+        super().__init__(('127.0.0.1', 0), StubHandler)
+        self.slow_delay = slow_delay
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def count(self, key):
+        with self.lock:
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+    def take_counts(self):
+        with self.lock:
+            counts, self.counts = self.counts, {}
+        return counts
+
+    @property
+    def base_url(self):
+        return f'http://127.0.0.1:{self.server_port}'
+
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *_args):
+        pass
+
+    def send(self, body, content_type, headers=()):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        if path == '/myip.php':
+            self.server.count('ip_lookups')
+            body = f"<html><head><title>My IP</title></head><body><h1>Your IP address</h1><p>{STUB_IP}</p></body></html>"
+            return self.send(body.encode(), 'text/html; charset=utf-8')
+        if path == '/myip.txt':
+            self.server.count('ip_lookups')
+            return self.send(f"{STUB_IP}\n".encode(), 'text/plain')
+        parts = path.strip('/').split('/')
+        if len(parts) == 3 and parts[0] == 'json' and parts[2] == 'dynamicSeedbox.php':
+            self.server.count('api_calls')
+            return self.seedbox(parts[1])
+        self.send_error(404)
+
+    def seedbox(self, reply):
+        if reply == 'slow':
+            time.sleep(self.server.slow_delay)
+        if reply == 'rate_limited':
+            body = json.dumps({'Success': False, 'msg': 'Last change too recent'}).encode()
+        elif reply == 'malformed':
+            body = b'{"Success": tru'
+        else:
+            body = json.dumps({'Success': True, 'msg': 'Completed', 'ip': STUB_IP, 'ASN': 64496, 'AS': 'Benchmark'}).encode()
+        refreshed = ('Set-Cookie', f"mam_id=refreshed-{time.monotonic_ns()}; Path=/")
+        self.send(body, 'application/json', [refreshed] if reply in ('success', 'slow') else [])
+
+
+def fake_curl(argv):
+    """
+    Carry out the curl command lines the updater runs inside the container.
+    Returns (exit code, output).
+    """
+    headers = {}
+    include = False
+    timeout = 30.0
+    url = None
+    args = list(argv[1:])
+    while args:
+        arg = args.pop(0)
+        if arg == '-i':
+            include = True
+        elif arg == '-H':
+            name, _, value = args.pop(0).partition(':')
+            headers[name.strip()] = value.strip()
+        elif arg == '--max-time':
+            timeout = float(args.pop(0))
+        elif arg == '--max-filesize':
+            args.pop(0)
+        elif not arg.startswith('-'):
+            url = arg
+    if argv[:1] != ['curl'] or url is None:
+        return 127, ''
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=timeout) as response:
+            body = response.read().decode(errors='replace')
+            head = f"HTTP/1.1 {response.status} {response.reason}\r\n" + ''.join(f"{k}: {v}\r\n" for k, v in response.getheaders())
+    except OSError:
+        return 28, ''
+    return 0, (head + '\r\n' + body) if include else body
+
+
+def fake_docker_cli(argv):
+    """
+    Entry point of the fake docker executable: supports 'docker exec NAME CMD...'.
+    """
+    if len(argv) < 3 or argv[0] != 'exec':
+        sys.stderr.write(f"fake docker: unsupported command {argv}\n")
+        return 1
+    if argv[1] not in (CONTAINER_NAME, CONTAINER_ID):
+        sys.stderr.write(f"Error response from daemon: No such container: {argv[1]}\n")
+        return 1
+    exit_code, output = fake_curl(argv[2:])
+    sys.stdout.write(output)
+    return exit_code
+
+
+class DockerServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Fake Docker Engine API with one running container whose execs run fake_curl.
+    """
+    daemon_threads = True
+
+    def __init__(self, socket_path):
+        super().__init__(socket_path, DockerHandler)
+        self.execs = {}
+        self.exec_count = 0
+        self.lock = threading.Lock()
+
+    def take_exec_count(self):
+        with self.lock:
+            count, self.exec_count = self.exec_count, 0
+        return count
+
+
+class DockerHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def address_string(self):
+        return 'docker'
+
+    def log_message(self, *_args):
+        pass
+
+    def send(self, status, obj=None, raw=None):
+        body = raw if raw is not None else json.dumps(obj).encode() if obj is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length) or b'null')
+
+    def do_GET(self):
+        parts = self.path.split('?')[0].strip('/').split('/')[1:]
+        if parts == ['containers', CONTAINER_NAME, 'json']:
+            return self.send(200, {'Id': CONTAINER_ID, 'Name': '/' + CONTAINER_NAME, 'State': {'Running': True, 'Pid': os.getpid()}})
+        if parts[:1] == ['containers']:
+            return self.send(404, {'message': f"No such container: {parts[1]}"})
+        if parts[:1] == ['exec'] and parts[2:] == ['json']:
+            with self.server.lock:
+                exit_code = self.server.execs.pop(parts[1], {}).get('exit_code')
+            return self.send(200, {'ExitCode': exit_code})
+        self.send(404, {'message': 'not found'})
+
+    def do_POST(self):
+        body = self.read_body()
+        parts = self.path.split('?')[0].strip('/').split('/')[1:]
+        # Execs by ID come from the container resolution cache
+        if parts in (['containers', CONTAINER_NAME, 'exec'], ['containers', CONTAINER_ID, 'exec']):
+            with self.server.lock:
+                self.server.exec_count += 1
+                exec_id = f"exec{self.server.exec_count}-{time.monotonic_ns()}"
+                self.server.execs[exec_id] = {'cmd': body['Cmd']}
+            return self.send(201, {'Id': exec_id})
+        if parts[:1] == ['containers']:
+            return self.send(404, {'message': f"No such container: {parts[1]}"})
+        if parts[:1] == ['exec'] and parts[2:] == ['start']:
+            with self.server.lock:
+                job = self.server.execs.get(parts[1])
+            if job is None:
+                return self.send(404, {'message': 'No such exec instance'})
+            job['exit_code'], output = fake_curl(job['cmd'])
+            data = output.encode()
+            return self.send(200, raw=struct.pack('>BxxxL', 1, len(data)) + data)
+        self.send(404, {'message': 'not found'})
+
+
+def account_settings(method, reply, base_url, statedir, timeout):
+    settings = {
+        'mam_cookie': 'benchmark-cookie',
+        'statedir': statedir,
+        'url': f'{base_url}/json/{reply}/dynamicSeedbox.php',
+        'external_ip_url': f'{base_url}/myip.php',
+        'update_timeout': str(timeout),
+    }
+    if method == 'manual':
+        settings.update(ip_method='Enter Manually', manual_ip=STUB_IP)
+    elif method == 'website_html':
+        settings.update(ip_method='Fetch from Website')
+    elif method == 'website_plain':
+        settings.update(ip_method='Fetch from Website', external_ip_url=f'{base_url}/myip.txt')
+    elif method in ('docker_socket', 'docker_cli'):
+        settings.update(ip_method='From Docker Container', container_name=CONTAINER_NAME, docker_network='exec')
+    elif method == 'netns':
+        # The benchmark process's own namespace: measures the worker, not a VPN
+        settings.update(ip_method='From Docker Container', netns='/proc/self/ns/net')
+    return settings
+
+
+# Runs one update in a fresh interpreter that has imported nothing else, so import
+# costs and the lazily loaded modules show up as they would for mam_cli.py
+CHILD_SCRIPT = """
+import json, sys, time
+started = time.perf_counter()
+spawns = []
+sys.addaudithook(lambda event, _args: spawns.append(event) if event in %(spawn_events)r else None)
+sys.path.insert(0, %(here)r)
+from mam_core import Account, Updater
+imported = time.perf_counter()
+updater = Updater(Account.from_section('DEFAULT', json.loads(sys.argv[1])))
+try:
+    run_started = time.perf_counter()
+    result = updater.run()
+    latency = time.perf_counter() - run_started
+finally:
+    updater.close()
+print(json.dumps({
+    'status': result.status,
+    'message': result.message,
+    'import_ms': (imported - started) * 1000,
+    'latency_ms': latency * 1000,
+    'phases_ms': {name: seconds * 1000 for name, seconds in updater.timings.items()},
+    'spawns': len(spawns),
+}))
+""" % {'spawn_events': SPAWN_EVENTS, 'here': HERE}
+
+
+class Bench(object):
+    def __init__(self, workdir, slow_delay, timeout):
+        self.workdir = workdir
+        self.timeout = timeout
+        self.stub = StubServer(slow_delay)
+        threading.Thread(target=self.stub.serve_forever, daemon=True).start()
+        self.socket_path = os.path.join(workdir, 'docker.sock')
+        self.docker = DockerServer(self.socket_path)
+        threading.Thread(target=self.docker.serve_forever, daemon=True).start()
+        self.bindir = os.path.join(workdir, 'bin')
+        os.makedirs(self.bindir)
+        docker_cli = os.path.join(self.bindir, 'docker')
+        with open(docker_cli, 'w') as f:
+            f.write(f"#!{sys.executable}\nimport sys\nsys.path.insert(0, {HERE!r})\n"
+                    "from benchmark import fake_docker_cli\nsys.exit(fake_docker_cli(sys.argv[1:]))\n")
+        os.chmod(docker_cli, 0o755)
+        self.runs = 0
+
+    def close(self):
+        self.stub.shutdown()
+        self.docker.shutdown()
+
+    def run_once(self, method, reply):
+        self.runs += 1
+        statedir = os.path.join(self.workdir, f'state{self.runs}')
+        os.makedirs(statedir)
+        if reply == 'unchanged':
+            with open(os.path.join(statedir, 'MAM.ip'), 'w') as f:
+                f.write(STUB_IP)
+        settings = account_settings(method, reply, self.stub.base_url, statedir, self.timeout)
+        env = dict(os.environ, PATH=self.bindir + os.pathsep + os.environ.get('PATH', ''))
+        # Without a reachable socket the updater falls back to the docker executable
+        env['DOCKER_HOST'] = 'unix://' + (self.socket_path if method != 'docker_cli' else os.path.join(self.workdir, 'missing.sock'))
+        self.stub.take_counts()
+        self.docker.take_exec_count()
+
+        started = time.perf_counter()
+        proc = subprocess.Popen([sys.executable, '-c', CHILD_SCRIPT, json.dumps(settings)],
+                                stdout=subprocess.PIPE, env=env, cwd=self.workdir)
+        output = proc.stdout.read()
+        proc.stdout.close()
+        # wait4 rather than wait() to get the child's own peak RSS
+        _pid, status, usage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        wall = time.perf_counter() - started
+        try:
+            sample = json.loads(output)
+        except ValueError:
+            sample = {'status': 'crashed', 'message': f"exit code {proc.returncode}"}
+        counts = self.stub.take_counts()
+        sample.update({
+            'process_ms': wall * 1000,
+            'peak_rss_kb': usage.ru_maxrss,
+            'container_execs': self.docker.take_exec_count(),
+            'ip_lookups': counts.get('ip_lookups', 0),
+            'api_calls': counts.get('api_calls', 0),
+        })
+        return sample
+
+
+def summarize(method, reply, samples):
+    def median(key):
+        values = [sample[key] for sample in samples if key in sample]
+        return round(statistics.median(values), 2) if values else None
+
+    phases = {}
+    for sample in samples:
+        for name, ms in sample.get('phases_ms', {}).items():
+            phases.setdefault(name, []).append(ms)
+    latencies = [sample['latency_ms'] for sample in samples if 'latency_ms' in sample]
+    return {
+        'method': method,
+        'reply': reply,
+        'statuses': sorted(set(sample['status'] for sample in samples)),
+        'message': samples[-1].get('message'),
+        'runs': len(samples),
+        'latency_ms': {
+            'median': median('latency_ms'),
+            'min': round(min(latencies), 2) if latencies else None,
+            'max': round(max(latencies), 2) if latencies else None,
+        },
+        'process_ms': median('process_ms'),
+        'import_ms': median('import_ms'),
+        'phases_ms': {name: round(statistics.median(values), 2) for name, values in sorted(phases.items())},
+        'spawns': max(sample.get('spawns', 0) for sample in samples),
+        'container_execs': max(sample['container_execs'] for sample in samples),
+        'ip_lookups': max(sample['ip_lookups'] for sample in samples),
+        'api_calls': max(sample['api_calls'] for sample in samples),
+        'peak_rss_kb': max(sample['peak_rss_kb'] for sample in samples),
+    }
+
+
+def git_revision():
+    try:
+        result = subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=HERE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, timeout=10)
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+    return result.stdout.strip() or None
+
+
+def format_table(results):
+    rows = [('METHOD', 'REPLY', 'STATUS', 'LATENCY', 'PROCESS', 'SPAWNS', 'EXECS', 'RSS')]
+    for item in results:
+        rows.append((item['method'], item['reply'], ','.join(item['statuses']), f"{item['latency_ms']['median']}ms",
+                     f"{item['process_ms']}ms", str(item['spawns']), str(item['container_execs']), f"{item['peak_rss_kb'] // 1024}MB"))
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    return '\n'.join('  '.join(cell.ljust(widths[i]) for i, cell in enumerate(row)).rstrip() for row in rows)
+
+
+def format_comparison(old, new):
+    previous = {(item['method'], item['reply']): item for item in old['results']}
+    lines = [f"Compared with {old.get('revision') or 'previous run'} ({old.get('timestamp')}):"]
+    for item in new['results']:
+        before = previous.get((item['method'], item['reply']))
+        if before is None or not before['latency_ms']['median'] or item['latency_ms']['median'] is None:
+            continue
+        change = (item['latency_ms']['median'] - before['latency_ms']['median']) / before['latency_ms']['median'] * 100
+        lines.append(f"  {item['method']}/{item['reply']}: latency {before['latency_ms']['median']} -> {item['latency_ms']['median']}ms ({change:+.0f}%), "
+                     f"RSS {before['peak_rss_kb']} -> {item['peak_rss_kb']}KB, spawns {before['spawns']} -> {item['spawns']}")
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the MAM IP Updater against local stub servers.")
+    parser.add_argument('--iterations', type=int, default=DEFAULT_ITERATIONS, help=f"Runs per scenario. Default: {DEFAULT_ITERATIONS}")
+    parser.add_argument('--methods', nargs='+', choices=METHODS, default=list(METHODS), help="IP methods to benchmark. Default: all")
+    parser.add_argument('--replies', nargs='+', choices=REPLIES, default=list(REPLIES), help="dynamicSeedbox.php replies to benchmark. Default: all")
+    parser.add_argument('--slow-delay', type=float, default=DEFAULT_SLOW_DELAY, help=f"Delay of the slow API reply in seconds. Default: {DEFAULT_SLOW_DELAY}")
+    parser.add_argument('--timeout', type=float, default=DEFAULT_UPDATE_TIMEOUT, help=f"update_timeout of the benchmark account. Default: {DEFAULT_UPDATE_TIMEOUT}")
+    parser.add_argument('--output', help="Write the results as JSON to this file instead of stdout.")
+    parser.add_argument('--compare', help="Earlier results file to compare against.")
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix='mam-bench-')
+    bench = Bench(workdir, args.slow_delay, args.timeout)
+    results = []
+    try:
+        for method in args.methods:
+            for reply in args.replies:
+                samples = [bench.run_once(method, reply) for _ in range(max(1, args.iterations))]
+                results.append(summarize(method, reply, samples))
+                print(f"{method}/{reply}: {results[-1]['latency_ms']['median']}ms", file=sys.stderr, flush=True)
+    finally:
+        bench.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'iterations': args.iterations,
+        'slow_delay': args.slow_delay,
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(format_table(results))
+    else:
+        print(json.dumps(report, indent=2))
+    if args.compare:
+        with open(args.compare) as f:
+            print(format_comparison(json.load(f), report), file=sys.stderr if not args.output else sys.stdout)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+
+"""
+Description:
+Import-time regression check for the headless MAM IP Updater.
+It imports what a cron run of mam_cli.py loads before its first request, under
+python -X importtime, and fails if that takes longer than the budget or pulls in a
+module that should only be loaded on demand (tkinter above all).
+
+Usage:
+    python3 check_startup.py [--budget MILLISECONDS] [--runs N]
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+
+DEFAULT_BUDGET_MS = 50
+DEFAULT_RUNS = 5
+ENTRY_MODULES = ('mam_cli', 'mam_config', 'mam_core')
+# Never needed before the first request of a plain website or manual update
+FORBIDDEN_MODULES = (
+    'tkinter', 'http.client', 'ssl', 'http.cookiejar', 'urllib.request', 'subprocess',
+    'concurrent.futures', 'ctypes', 'statistics', 'hashlib', 'mam_docker', 'mam_netns',
+)
+
+
+def measure():
+    """
+    Return (total microseconds, set of imported module names) for one fresh interpreter.
+    """
+    code = 'import ' + ', '.join(ENTRY_MODULES)
+    here = os.path.dirname(os.path.abspath(__file__))
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=here,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, check=True)
+    total = 0
+    modules = set()
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _self, cumulative, name = line[len('import time:'):].split('|')
+        modules.add(name.strip())
+        # Nested imports are indented by two spaces per level; count top-level ones only
+        if name.strip() in ENTRY_MODULES and not name.startswith('  '):
+            total += int(cumulative)
+    return total, modules
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check the import time of the headless updater.")
+    parser.add_argument('--budget', type=float, default=DEFAULT_BUDGET_MS, help=f"Allowed import time in milliseconds. Default: {DEFAULT_BUDGET_MS}")
+    parser.add_argument('--runs', type=int, default=DEFAULT_RUNS, help=f"Interpreters to start; the fastest counts. Default: {DEFAULT_RUNS}")
+    args = parser.parse_args(argv)
+
+    timings = []
+    imported = set()
+    for _ in range(max(1, args.runs)):
+        total, modules = measure()
+        timings.append(total)
+        imported |= modules
+    best = min(timings) / 1000
+    failed = False
+    print(f"Import time of {', '.join(ENTRY_MODULES)}: {best:.1f}ms (budget {args.budget:.0f}ms, best of {len(timings)})")
+    if best > args.budget:
+        print("FAIL: import time is over budget.")
+        failed = True
+    unexpected = sorted(name for name in imported if name.split('.')[0] in FORBIDDEN_MODULES or name in FORBIDDEN_MODULES)
+    if unexpected:
+        print(f"FAIL: imported at startup: {', '.join(unexpected)}")
+        failed = True
+    if not failed:
+        print("OK")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
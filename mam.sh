@@ -15,6 +15,11 @@ DEFAULT_CACHEFILE=""
 DEFAULT_COOKIEFILE=""
 DEFAULT_URL="https://t.myanonamouse.net/json/dynamicSeedbox.php"
 DEFAULT_MAM_ID_COOKIE=""
+DEFAULT_MAX_TIME=20
+# How long the container lookup cached in STATEDIR/MAM.containers is trusted (seconds);
+# a missing or stopped container is only remembered briefly
+CACHE_TTL=300
+NEGATIVE_TTL=30
 
 # Function to display usage information
 usage() {
@@ -27,6 +32,8 @@ Options:
   --cachefile FILE        Set the cache file. Default: STATEDIR/MAM.ip
   --cookiefile FILE       Set the cookie file. Default: STATEDIR/MAM.cookie
   --url URL               Set the MAM API URL. Default: $DEFAULT_URL
+  --force                 Call the MAM API even if the IP is unchanged.
+  --max_time SECONDS      Give up on each request after this many seconds. Default: $DEFAULT_MAX_TIME
   -h, --help              Display this help message."
 }
 
@@ -51,6 +58,11 @@ while [[ "$1" != "" ]]; do
         --url )               shift
                               URL="$1"
                               ;;
+        --force )             FORCE=1
+                              ;;
+        --max_time )          shift
+                              MAX_TIME="$1"
+                              ;;
         -h | --help )         usage
                               exit 0
                               ;;
@@ -67,6 +79,20 @@ STATEDIR="${STATEDIR:-$DEFAULT_STATEDIR}"
 CACHEFILE="${CACHEFILE:-${STATEDIR}/MAM.ip}"
 COOKIEFILE="${COOKIEFILE:-${STATEDIR}/MAM.cookie}"
 URL="${URL:-$DEFAULT_URL}"
+MAX_TIME="${MAX_TIME:-$DEFAULT_MAX_TIME}"
+
+# Fractional seconds are fine for curl, but shell arithmetic needs awk for them
+if ! [[ "$MAX_TIME" =~ ^[0-9]+([.][0-9]+)?$ ]] || [ "$(awk -v t="$MAX_TIME" 'BEGIN { print (t > 0) }')" != "1" ]; then
+    echo "Error: --max_time must be a positive number of seconds, got '$MAX_TIME'."
+    exit 1
+fi
+
+# Bound every docker exec as well, in case the Docker daemon itself hangs
+if command -v timeout &> /dev/null; then
+    DOCKER_EXEC=(timeout "$(awk -v t="$MAX_TIME" 'BEGIN { print t + 5 }')" docker exec)
+else
+    DOCKER_EXEC=(docker exec)
+fi
 
 # Check if MAM_ID_COOKIE is set
 if [ -z "$MAM_ID_COOKIE" ]; then
@@ -74,10 +100,94 @@ if [ -z "$MAM_ID_COOKIE" ]; then
     exit 1
 fi
 
+# The container resolution cache is shared with the Python updater (mam_containers.py):
+# container name -> ID, init PID and running state, so most runs don't ask the daemon
+CONTAINER_CACHE="$STATEDIR/MAM.containers"
+
+# Start time of a process (22nd field of /proc/PID/stat; the command name before it may
+# contain spaces), to notice when the container's init process is gone
+process_start_time() {
+    [ -r "/proc/$1/stat" ] && sed 's/.*) //' "/proc/$1/stat" | cut -d' ' -f20
+}
+
+# Usage: store_container EXISTS RUNNING [ID PID STATUS START_TIME]
+store_container() {
+    local tmp="$CONTAINER_CACHE.tmp.$$"
+    if { cat "$CONTAINER_CACHE" 2>/dev/null || echo '{}'; } | jq --arg name "$CONTAINER_NAME" \
+            --argjson exists "$1" --argjson running "$2" --arg id "$3" --argjson pid "${4:-0}" --arg status "$5" \
+            --arg start "$6" --argjson now "$(date +%s)" '
+        .version = 1 | .containers[$name] = ({exists: $exists, running: $running, checked: $now}
+            + if $exists then {id: $id, status: $status, pid: (if $running then $pid else null end),
+                               netns: (if $running then "/proc/\($pid)/ns/net" else null end),
+                               start_time: (if $start == "" then null else $start end)} else {} end)' > "$tmp" 2>/dev/null; then
+        mv -f "$tmp" "$CONTAINER_CACHE"
+    else
+        rm -f "$tmp"
+    fi
+}
+
+# Drop the cached lookup, e.g. after an exec failed
+forget_container() {
+    local tmp="$CONTAINER_CACHE.tmp.$$"
+    if [ -f "$CONTAINER_CACHE" ] && jq --arg name "$CONTAINER_NAME" 'del(.containers[$name])' "$CONTAINER_CACHE" > "$tmp" 2>/dev/null; then
+        mv -f "$tmp" "$CONTAINER_CACHE"
+    else
+        rm -f "$tmp"
+    fi
+}
+
+# Set CONTAINER_ID for a running container, from the cache when it is still valid,
+# or exit with an error if the container is missing or stopped
+resolve_container() {
+    local entry exists running id pid status start_time checked now
+    now=$(date +%s)
+    entry=$(jq -r --arg name "$CONTAINER_NAME" '.containers[$name] // empty
+        | [(.exists | tostring), (.running | tostring), (.id // ""), (.pid // 0 | tostring), (.start_time // ""), (.checked // 0 | floor | tostring)]
+        | join("|")' "$CONTAINER_CACHE" 2>/dev/null)
+    if [ -n "$entry" ]; then
+        # Not tab separated: read would merge the empty fields
+        IFS='|' read -r exists running id pid start_time checked <<< "$entry"
+        if [ "$running" == "true" ]; then
+            if (( now - checked >= 0 && now - checked <= CACHE_TTL )) && [ -n "$id" ] \
+                    && { [ -z "$start_time" ] || [ "$(process_start_time "$pid")" == "$start_time" ]; }; then
+                CONTAINER_ID="$id"
+                return
+            fi
+        elif (( now - checked >= 0 && now - checked <= NEGATIVE_TTL )); then
+            if [ "$exists" == "true" ]; then
+                echo "Error: Docker container '$CONTAINER_NAME' is not running."
+            else
+                echo "Error: Docker container '$CONTAINER_NAME' does not exist."
+            fi
+            exit 1
+        fi
+    fi
+
+    # One docker inspect gives the running state as well as the ID and PID to cache
+    if ! entry=$(docker inspect --type container --format '{{.Id}}{{"\t"}}{{.State.Running}}{{"\t"}}{{.State.Pid}}{{"\t"}}{{.State.Status}}' "$CONTAINER_NAME" 2>&1); then
+        if [[ "$entry" == *"No such"* ]]; then
+            store_container false false
+            echo "Error: Docker container '$CONTAINER_NAME' does not exist."
+        else
+            echo "Error: Could not inspect Docker container '$CONTAINER_NAME': $entry"
+        fi
+        exit 1
+    fi
+    IFS=$'\t' read -r id running pid status <<< "$entry"
+    if [ "$running" != "true" ] || [ "$pid" == "0" ]; then
+        store_container true false "$id" 0 "$status"
+        echo "Error: Docker container '$CONTAINER_NAME' is not running."
+        exit 1
+    fi
+    store_container true true "$id" "$pid" "$status" "$(process_start_time "$pid")"
+    CONTAINER_ID="$id"
+}
+
 # Function to retrieve the current external IP address from Docker container
 get_current_ip() {
-    CURRENT_IP=$(docker exec "$CONTAINER_NAME" curl -s https://api.ipify.org)
+    CURRENT_IP=$("${DOCKER_EXEC[@]}" "$CONTAINER_ID" curl -s --max-time "$MAX_TIME" https://api.ipify.org)
     if [ -z "$CURRENT_IP" ]; then
+        forget_container
         echo "Failed to retrieve current IP address from Docker container '$CONTAINER_NAME'."
         exit 1
     fi
@@ -86,21 +196,25 @@ get_current_ip() {
 
 # Function to update the dynamic seedbox IP
 update_seedbox_ip() {
-    RESPONSE=$(docker exec "$CONTAINER_NAME" curl -s -b "mam_id=$MAM_ID_COOKIE" -c "$COOKIEFILE" "$URL")
+    RESPONSE=$("${DOCKER_EXEC[@]}" "$CONTAINER_ID" curl -s --max-time "$MAX_TIME" -b "mam_id=$MAM_ID_COOKIE" -c "$COOKIEFILE" "$URL")
     if [ -z "$RESPONSE" ]; then
+        forget_container
         echo "Failed to get a response from the MAM API."
         exit 1
     fi
-    SUCCESS=$(echo "$RESPONSE" | jq -r '.Success')
-    MESSAGE=$(echo "$RESPONSE" | jq -r '.msg')
+    # Extract both fields with a single jq invocation
+    {
+        IFS= read -r SUCCESS
+        IFS= read -r MESSAGE
+    } < <(printf '%s' "$RESPONSE" | jq -r '(.Success | tostring), (.msg // "" | tostring)')
 
     if [ "$SUCCESS" == "true" ]; then
         echo "Success: $MESSAGE"
-        echo "$CURRENT_IP" > "$CACHEFILE"
+        # Replace CACHEFILE atomically so a crash never leaves it half written
+        echo "$CURRENT_IP" > "$CACHEFILE.tmp.$$" && mv -f "$CACHEFILE.tmp.$$" "$CACHEFILE"
     elif [[ "$MESSAGE" == "Last change too recent" ]]; then
+        # Leave CACHEFILE alone so the next run retries the change
         echo "No change made: $MESSAGE"
-        # Still update the CACHEFILE
-        echo "$CURRENT_IP" > "$CACHEFILE"
     else
         echo "Failed: $MESSAGE"
         exit 1
@@ -119,12 +233,6 @@ if ! command -v docker &> /dev/null; then
     exit 1
 fi
 
-# Check if the Docker container is running
-if ! docker ps --format '{{.Names}}' | grep -wq "$CONTAINER_NAME"; then
-    echo "Error: Docker container '$CONTAINER_NAME' is not running."
-    exit 1
-fi
-
 # Check if STATEDIR exists, if not create it
 if [ ! -d "$STATEDIR" ]; then
     mkdir -p "$STATEDIR"
@@ -134,6 +242,9 @@ if [ ! -d "$STATEDIR" ]; then
     fi
 fi
 
+# Find the Docker container and check that it is running
+resolve_container
+
 # Check if the COOKIEFILE exists, if not create it
 if [ ! -f "$COOKIEFILE" ]; then
     echo "Cookie file not found, creating a new cookie file."
@@ -144,11 +255,24 @@ if [ ! -f "$COOKIEFILE" ]; then
 EOL
 fi
 
+# Serialize with other updaters of this state directory (cron, the GUI, the daemon).
+# A run that had to wait finds MAM.ip already updated and exits without an API call.
+if command -v flock &> /dev/null; then
+    exec 9>>"$STATEDIR/MAM.lock"
+    if ! flock -w "$(awk -v t="$MAX_TIME" 'BEGIN { print t * 2 }')" 9; then
+        echo "Error: Timed out waiting for another update of '$STATEDIR' to finish."
+        exit 1
+    fi
+fi
+
 # Retrieve the current IP address from Docker container
 CURRENT_IP=$(get_current_ip)
 
-# Update MAM.ip file regardless of IP change
-echo "$CURRENT_IP" > "$CACHEFILE"
+# Only call the MAM API when the IP differs from the cached one
+if [ "$FORCE" != "1" ] && [ -f "$CACHEFILE" ] && [ "$(cat "$CACHEFILE")" == "$CURRENT_IP" ]; then
+    echo "IP unchanged ($CURRENT_IP), no update needed."
+    exit 0
+fi
 
 # Update the dynamic seedbox IP
 update_seedbox_ip
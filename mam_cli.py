@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+
+"""
+Description:
+Headless command-line entry point for the MAM IP Updater, for cron jobs and machines without Tk.
+It accepts the same options as mam.sh and takes anything not given on the command line from
+the DEFAULT section of the config file written by the GUI. It runs a single update and exits.
+tkinter is never imported, and the update modules are only loaded once the arguments have
+been parsed; check_startup.py guards the import time.
+
+Usage:
+    python3 mam_cli.py [--config FILE] [--mam_cookie COOKIE] [--container_name NAME] [--statedir DIR]
+                       [--cachefile FILE] [--cookiefile FILE] [--url URL] [--force] [--max_time SECONDS]
+                       [--profile [CYCLES]]
+"""
+
+import argparse
+import sys
+import time
+
+# Command-line options that map straight onto config keys, as in mam.sh
+ACCOUNT_OPTIONS = ('mam_cookie', 'container_name', 'statedir', 'cachefile', 'cookiefile', 'url',
+                   'external_ip_url', 'manual_ip', 'docker_network')
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Update the MyAnonamouse dynamic seedbox IP once, without the GUI.")
+    parser.add_argument('--config', help="Path to the updater config file. Default: ~/.mam_updater_config.ini")
+    parser.add_argument('--mam_cookie', help="MAM session cookie.")
+    parser.add_argument('--container_name', help="Docker container to take the IP from; selects the Docker IP method.")
+    parser.add_argument('--statedir', help="State directory. Default: statedir from the config or your home directory.")
+    parser.add_argument('--cachefile', help="Cache file. Default: STATEDIR/MAM.ip")
+    parser.add_argument('--cookiefile', help="Cookie file. Default: STATEDIR/MAM.cookie")
+    parser.add_argument('--url', help="MAM API URL.")
+    parser.add_argument('--external_ip_url', help="IP-echo source(s), comma separated; selects the website IP method.")
+    parser.add_argument('--manual_ip', help="Register this IP address instead of looking it up.")
+    parser.add_argument('--docker_network', choices=('exec', 'netns'), help="How Docker-mode requests reach the container's network.")
+    parser.add_argument('--force', action='store_true', help="Call the MAM API even if the IP is unchanged.")
+    parser.add_argument('--max_time', '--timeout', dest='timeout', type=float, help="Overall time budget for the update in seconds. Default: update_timeout from the config.")
+    parser.add_argument('--metrics_file', '--metrics-file', dest='metrics_file', help="Node-exporter textfile to add this run's metrics to; counters carry on from the file.")
+    parser.add_argument('--profile', type=int, nargs='?', const=1, metavar='CYCLES', help="Profile CYCLES updates (default 1) and save the report to STATEDIR/MAM.profile/.")
+    return parser
+
+
+def wants_cli(argv):
+    """
+    True if argv (without the program name) holds one of this CLI's options, also in
+    the abbreviated or --option=value forms argparse accepts. Anything else, such as
+    the -psn_* argument macOS passes to an app opened from the Finder, is not a request
+    for a headless run.
+    """
+    options = [option for action in build_parser()._actions for option in action.option_strings]
+    for arg in argv:
+        name = arg.split('=', 1)[0]
+        if name in options or (name.startswith('--') and len(name) > 2 and any(option.startswith(name) for option in options)):
+            return True
+    return False
+
+
+def load_cli_account(args):
+    """
+    Build the Account from the config file's DEFAULT section overridden by the command line.
+    """
+    from mam_config import DEFAULT_CONFIG, read_config
+    from mam_core import METHOD_DOCKER, METHOD_MANUAL, METHOD_WEBSITE, Account
+
+    settings = read_config(args.config or DEFAULT_CONFIG)
+    values = dict(settings['DEFAULT'])
+    overrides = {key: getattr(args, key) for key in ACCOUNT_OPTIONS if getattr(args, key) is not None}
+    if 'statedir' in overrides:
+        # State files from the config belong to the config's state directory
+        for key in ('cachefile', 'cookiefile'):
+            values.pop(key, None)
+    values.update(overrides)
+    if args.manual_ip:
+        values['ip_method'] = METHOD_MANUAL
+    elif args.container_name:
+        values['ip_method'] = METHOD_DOCKER
+    elif args.external_ip_url:
+        values['ip_method'] = METHOD_WEBSITE
+    account = Account.from_section('DEFAULT', values)
+    if args.timeout:
+        account.update_timeout = args.timeout
+    return account
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    account = load_cli_account(args)
+    if not account.mam_cookie:
+        print("Error: MAM session cookie is not set. Use --mam_cookie to set it.", flush=True)
+        return 1
+
+    from mam_core import Updater, UpdateResult
+    updater = Updater(account)
+    started = time.monotonic()
+    profiler = None
+    try:
+        if args.profile:
+            from mam_profile import profile_updates
+            result, profiler = profile_updates(updater, args.profile, force=args.force)
+        else:
+            result = updater.run(force=args.force)
+    finally:
+        updater.close()
+        updater.http.close()
+    print(result.message, flush=True)
+    if profiler is not None:
+        from mam_profile import ProfileError
+        try:
+            print(f"Profile saved to '{profiler.save(account.statedir, account)}'.", flush=True)
+        except ProfileError as e:
+            print(f"Error: {e}", flush=True)
+    if args.metrics_file:
+        from mam_metrics import Metrics
+        metrics = Metrics()
+        metrics.load_textfile(args.metrics_file)
+        metrics.record(updater, result, time.monotonic() - started)
+        try:
+            metrics.write_textfile(args.metrics_file)
+        except OSError as e:
+            print(f"Error writing metrics to '{args.metrics_file}': {e}", flush=True)
+    return 0 if result.ok or result.status == UpdateResult.RATE_LIMITED else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,59 @@
+"""
+Description:
+Loads MAM IP Updater settings from ~/.mam_updater_config.ini.
+The DEFAULT section holds the single-account settings used by the GUI. Every other
+section is a named account for fleet mode and inherits anything it does not set from DEFAULT.
+"""
+
+import configparser
+import os
+
+from mam_core import Account, UpdateError
+
+DEFAULT_CONFIG = os.path.join(os.path.expanduser("~"), '.mam_updater_config.ini')
+
+
+def read_config(config_file=DEFAULT_CONFIG):
+    settings = configparser.ConfigParser()
+    if os.path.exists(config_file):
+        settings.read(config_file)
+    return settings
+
+
+def load_account(settings, name='DEFAULT'):
+    return Account.from_section(name, settings[name])
+
+
+def validate_accounts(accounts):
+    """
+    Raise UpdateError naming the first account whose settings are unusable.
+    """
+    for account in accounts:
+        try:
+            account.validate()
+        except UpdateError as e:
+            raise UpdateError(f"[{account.name}] {e}")
+
+
+def load_accounts(settings):
+    """
+    Return one Account per named section, or the DEFAULT account if there are none.
+    Accounts that share the DEFAULT statedir get their own subdirectory named after the section.
+    """
+    if not settings.sections():
+        return [load_account(settings)]
+    defaults = settings.defaults()
+    default_statedir = defaults.get('statedir', os.path.expanduser('~'))
+    accounts = []
+    for name in settings.sections():
+        section = settings[name]
+        account = Account.from_section(name, section)
+        # State files inherited from DEFAULT would be shared by every account
+        if section.get('statedir', default_statedir) == default_statedir:
+            account.statedir = os.path.join(default_statedir, name)
+        for key, filename in (('cachefile', 'MAM.ip'), ('cookiefile', 'MAM.cookie')):
+            value = section.get(key, '')
+            if not value or value == defaults.get(key):
+                setattr(account, key, os.path.join(account.statedir, filename))
+        accounts.append(account)
+    return accounts
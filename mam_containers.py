@@ -0,0 +1,216 @@
+"""
+Description:
+Container resolution cache for the "From Docker Container" mode of the MAM IP Updater.
+It maps a container name to its ID, init PID, network namespace and running state, so a
+run doesn't have to ask the Docker daemon again (or spawn the docker CLI) to find the
+container, and remembers a missing or stopped container for a short while so repeated
+runs give up on it without trying an exec. Entries live in STATEDIR/MAM.containers,
+shared with mam.sh and across processes, and are dropped when their TTL runs out, when
+the container's init process is gone, or on a container lifecycle event.
+"""
+
+import json
+import os
+import threading
+import time
+
+from mam_state import atomic_write, read_text
+
+CACHE_FILE = 'MAM.containers'
+CACHE_VERSION = 1
+DEFAULT_CACHE_TTL = 300
+# A stopped container is usually started again soon, so it is only remembered briefly
+DEFAULT_NEGATIVE_TTL = 30
+COUNTERS = ('hits', 'negative_hits', 'misses', 'invalidations')
+
+
+def process_start_time(pid):
+    """
+    Return the start time of process pid in clock ticks since boot, or None if it
+    can't be read (no such process, or no /proc). Tells a container's init process
+    apart from a later process that got the same PID.
+    """
+    text = read_text(f'/proc/{pid}/stat')
+    if not text:
+        return None
+    # The command name in parentheses may contain spaces; starttime is the 22nd field
+    fields = text.rsplit(')', 1)[-1].split()
+    return fields[19] if len(fields) > 19 else None
+
+
+def container_entry(info):
+    """
+    Build a cache entry from a container's inspect document (None: no such container).
+    """
+    if info is None:
+        return {'exists': False, 'running': False}
+    state = info.get('State') or {}
+    pid = state.get('Pid') or 0
+    running = bool(state.get('Running')) and pid > 0
+    return {
+        'exists': True,
+        'id': info.get('Id'),
+        'running': running,
+        'status': state.get('Status'),
+        'pid': pid if running else None,
+        'netns': f"/proc/{pid}/ns/net" if running else None,
+        'start_time': process_start_time(pid) if running else None,
+    }
+
+
+def describe(name, entry):
+    if not entry.get('exists'):
+        return f"Docker container '{name}' does not exist"
+    return f"Docker container '{name}' is not running"
+
+
+class ContainerCache(object):
+    """
+    Thread-safe cache of container lookups backed by one JSON file. Positive entries
+    expire after ttl seconds, negative ones (missing or stopped containers) after
+    negative_ttl. Counts hits, negative hits, misses and invalidations since it was created.
+    clock returns the current time as in time.time(), which the entries are stamped with.
+    """
+    def __init__(self, path, ttl=DEFAULT_CACHE_TTL, negative_ttl=DEFAULT_NEGATIVE_TTL, clock=time.time):
+        self.path = path
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.clock = clock
+        self.counts = dict.fromkeys(COUNTERS, 0)
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._signature = None
+
+    def _file_signature(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return st.st_ino, st.st_size, st.st_mtime_ns
+
+    def _read(self):
+        try:
+            data = json.loads(read_text(self.path) or '{}')
+        except ValueError:
+            return {}
+        containers = data.get('containers') if isinstance(data, dict) else None
+        return containers if isinstance(containers, dict) else {}
+
+    def _refresh(self):
+        # Another process (a cron run, mam.sh) may have rewritten the file
+        signature = self._file_signature()
+        if signature != self._signature:
+            self._entries = self._read()
+            self._signature = signature
+
+    def _write(self, changes):
+        # Merged into the newest file, so entries other processes wrote meanwhile survive
+        entries = self._read()
+        for name, entry in changes.items():
+            if entry is None:
+                entries.pop(name, None)
+            else:
+                entries[name] = entry
+        try:
+            atomic_write(self.path, json.dumps({'version': CACHE_VERSION, 'containers': entries}, sort_keys=True, indent=1))
+        except OSError:
+            # The cache only saves work; without a writable state directory it is kept in memory
+            pass
+        self._entries = entries
+        self._signature = self._file_signature()
+
+    def _valid(self, entry, now):
+        age = now - entry.get('checked', 0)
+        if age < 0 or age > (self.ttl if entry.get('running') else self.negative_ttl):
+            return False
+        if entry.get('running') and entry.get('start_time') is not None:
+            # The init process exited (container stopped or restarted) or its PID was reused
+            return process_start_time(entry['pid']) == entry['start_time']
+        return True
+
+    def lookup(self, name):
+        """
+        Return a copy of the valid entry for name, or None on a miss.
+        """
+        now = self.clock()
+        with self._lock:
+            self._refresh()
+            entry = self._entries.get(name)
+            if entry is not None and not self._valid(entry, now):
+                self._write({name: None})
+                entry = None
+            if entry is None:
+                self.counts['misses'] += 1
+                return None
+            self.counts['hits' if entry.get('running') else 'negative_hits'] += 1
+            return dict(entry)
+
+    def store(self, name, entry):
+        entry = dict(entry, checked=round(self.clock(), 3))
+        with self._lock:
+            self._refresh()
+            self._write({name: entry})
+        return dict(entry)
+
+    def resolve(self, docker, name, timeout=None):
+        """
+        Return the entry for name, inspecting the container through the Docker API
+        client on a miss. DockerError from the inspect is passed on.
+        """
+        entry = self.lookup(name)
+        if entry is None:
+            entry = self.store(name, container_entry(docker.inspect(name, timeout=timeout)))
+        return entry
+
+    def invalidate(self, name):
+        """
+        Drop the entry of a container, given its name or ID. Returns True if there was one.
+        """
+        with self._lock:
+            self._refresh()
+            names = [key for key, entry in self._entries.items() if name in (key, entry.get('id'))]
+            if not names:
+                return False
+            self.counts['invalidations'] += 1
+            self._write(dict.fromkeys(names))
+        return True
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.counts)
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_cache(statedir, ttl=DEFAULT_CACHE_TTL, negative_ttl=DEFAULT_NEGATIVE_TTL):
+    """
+    Return the process-wide cache for a state directory, so every Updater using it (and
+    the Docker event watcher) shares one set of entries and counters.
+    """
+    path = os.path.abspath(os.path.join(statedir, CACHE_FILE))
+    with _caches_lock:
+        cache = _caches.get(path)
+        if cache is None:
+            cache = _caches[path] = ContainerCache(path, ttl, negative_ttl)
+        else:
+            cache.ttl, cache.negative_ttl = ttl, negative_ttl
+        return cache
+
+
+def account_cache(account):
+    """
+    Return the cache for an Account's state directory, with the account's TTLs.
+    """
+    return get_cache(account.statedir, account.docker_cache_ttl, account.docker_negative_ttl)
+
+
+def invalidate_container(name):
+    """
+    Drop a container from every cache of this process, after a lifecycle event.
+    """
+    with _caches_lock:
+        caches = list(_caches.values())
+    for cache in caches:
+        cache.invalidate(name)
@@ -0,0 +1,301 @@
+"""
+Description:
+Local control API for the headless MAM IP Updater, so a VPN up-script, qBittorrent or a
+gluetun-style container can push an update instead of waiting for the next poll.
+It listens on a TCP port on localhost and/or a unix socket and takes
+
+    POST /update                        re-check the IP now
+    POST /update?ip=203.0.113.7         the IP changed to 203.0.113.7; register it
+    POST /update?force=1&account=NAME   call the MAM API even if the IP is unchanged,
+                                        unless MAM's rate limit is known to be in effect
+
+Parameters may also be sent as a JSON body. The request returns once the update
+finished, with its outcome as JSON. Bursts of requests for one account are debounced
+into a single update whose result every caller receives. A pushed IP only triggers the
+update; MAM registers the address the request comes from, and that is what is stored.
+
+Requests must be sent with Content-Type: application/json, which a web page can't do
+cross-origin without a CORS preflight this server never answers. Without a token, the
+TCP port only serves requests addressed to localhost (against DNS rebinding); with
+control_token set, it requires "Authorization: Bearer TOKEN" instead and may listen on
+other addresses. The unix socket is guarded by its file permissions.
+
+Example:
+    curl -fsS -X POST -H 'Content-Type: application/json' --unix-socket ~/MAM.control http://localhost/update
+"""
+
+import json
+import os
+import socket
+import threading
+import time
+import urllib.parse
+
+from mam_resolver import valid_ip
+
+DEFAULT_DEBOUNCE = 0.2
+# A steady stream of requests can't delay the update beyond this
+MAX_DEBOUNCE_DELAY = 0.8
+# Request bodies only carry a few parameters
+MAX_BODY_BYTES = 4096
+
+
+class ControlError(Exception):
+    """
+    Raised for a request the control API cannot act on; the message is sent back as the error.
+    """
+
+
+class _Batch(object):
+    def __init__(self):
+        self.first = self.last = time.monotonic()
+        self.force = False
+        self.ip = None
+        self.requests = 0
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+    def add(self, force, ip):
+        self.last = time.monotonic()
+        self.requests += 1
+        self.force = self.force or force
+        # The newest reported address wins
+        if ip is not None:
+            self.ip = ip
+
+
+class Debouncer(object):
+    """
+    Coalesces update requests per key. The first request of a burst waits until no new
+    request arrived for debounce seconds (at most max_delay in total), then calls
+    run(key, force, ip) once; every request of the burst gets its return value, or
+    has the exception it raised raised again.
+    Requests arriving while that update runs form the next burst, so an event is never
+    answered by a check that started before it.
+    """
+    def __init__(self, run, debounce=DEFAULT_DEBOUNCE, max_delay=MAX_DEBOUNCE_DELAY):
+        self.run = run
+        self.debounce = debounce
+        self.max_delay = max(debounce, max_delay)
+        self._lock = threading.Lock()
+        self._pending = {}
+
+    def submit(self, key, force=False, ip=None):
+        with self._lock:
+            batch = self._pending.get(key)
+            leader = batch is None
+            if leader:
+                batch = self._pending[key] = _Batch()
+            batch.add(force, ip)
+        if not leader:
+            batch.done.wait()
+            if batch.error is not None:
+                raise batch.error
+            return batch.result
+        try:
+            while True:
+                with self._lock:
+                    now = time.monotonic()
+                    wait = min(batch.last + self.debounce, batch.first + self.max_delay) - now
+                    if wait <= 0:
+                        del self._pending[key]
+                        break
+                time.sleep(wait)
+            batch.result = self.run(key, batch.force, batch.ip)
+        except Exception as e:
+            batch.error = e
+            raise
+        finally:
+            with self._lock:
+                if self._pending.get(key) is batch:
+                    del self._pending[key]
+            batch.done.set()
+        return batch.result
+
+    def submit_all(self, keys, force=False, ip=None):
+        """
+        Submit the request for several keys at once and return {key: result}.
+        If one of the runs raised, its exception is raised once all have finished.
+        """
+        results = {}
+        errors = []
+
+        def submit(key):
+            try:
+                results[key] = self.submit(key, force, ip)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=submit, args=(key,), daemon=True) for key in keys[1:]]
+        for thread in threads:
+            thread.start()
+        if keys:
+            submit(keys[0])
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+        return results
+
+
+def parse_ip(value):
+    ip = valid_ip(value)
+    if ip is None:
+        raise ControlError(f"Invalid IP address '{value}'")
+    return str(ip)
+
+
+def _flag(value):
+    return str(value).strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+def is_loopback(host):
+    """
+    True if host (a name or address, IPv6 optionally in brackets) is this machine only.
+    """
+    import ipaddress
+    host = host.strip().lower().strip('[]')
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def _host_name(header):
+    # The Host header without its port
+    header = header.strip()
+    if header.startswith('['):
+        return header[:header.find(']') + 1]
+    return header.rsplit(':', 1)[0] if header.count(':') == 1 else header
+
+
+class ControlServer(object):
+    """
+    Serves the control API from background threads. handle(account, force, ip) runs the
+    update(s) and returns a list of (account name, UpdateResult); account is None when
+    the request named none. It raises ControlError for requests it cannot serve.
+    Raises ControlError if the TCP port would listen beyond localhost without a token.
+    """
+    def __init__(self, handle, host='127.0.0.1', port=None, socket_path=None, token=None):
+        # Only long-running modes serve the API, so the CLI never imports http.server
+        import hmac
+        import http.server
+        import socketserver
+
+        if port and not token and not is_loopback(host):
+            raise ControlError(f"Refusing to accept pushed updates on {host} without a control_token")
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_POST(self):
+                parsed = urllib.parse.urlsplit(self.path)
+                try:
+                    length = int(self.headers.get('Content-Length') or 0)
+                except ValueError:
+                    length = -1
+                if not 0 <= length <= MAX_BODY_BYTES:
+                    self.close_connection = True
+                    self.reply(413, {'error': "Request body too large"})
+                    return
+                # Read before any reply, so a rejected client gets its status and not a reset
+                data = self.rfile.read(length).decode('utf-8', errors='replace') if length else ''
+                if self.client_address and not self.authorized():
+                    self.reply(403, {'error': "Forbidden"})
+                    return
+                if parsed.path.rstrip('/') != '/update':
+                    self.reply(404, {'error': f"Unknown endpoint '{parsed.path}'"})
+                    return
+                if self.headers.get_content_type() != 'application/json':
+                    self.reply(415, {'error': "Requests must be sent with Content-Type: application/json"})
+                    return
+                try:
+                    params = self.params(parsed.query, data)
+                    ip = parse_ip(params['ip']) if params.get('ip') else None
+                    results = handle(params.get('account') or None, _flag(params.get('force', '')), ip)
+                except ControlError as e:
+                    self.reply(400, {'error': str(e)})
+                    return
+                except Exception as e:
+                    self.reply(500, {'error': f"Update failed: {e}"})
+                    return
+                ok = all(result.ok or result.status == result.RATE_LIMITED for _name, result in results)
+                body = {'ok': ok, 'results': [dict(result.to_dict(), account=name) for name, result in results]}
+                self.reply(200 if ok else 502, body)
+
+            def authorized(self):
+                # Only asked of TCP clients; unix socket peers have no address
+                if token:
+                    scheme, _, value = (self.headers.get('Authorization') or '').partition(' ')
+                    return scheme.lower() == 'bearer' and hmac.compare_digest(value.strip().encode(), token.encode())
+                return is_loopback(_host_name(self.headers.get('Host') or ''))
+
+            def params(self, query, data):
+                params = dict(urllib.parse.parse_qsl(query))
+                if data:
+                    try:
+                        values = json.loads(data)
+                    except ValueError:
+                        raise ControlError("Request body is not valid JSON")
+                    if not isinstance(values, dict):
+                        raise ControlError("Request body must be a JSON object")
+                    params.update({key: str(value) for key, value in values.items() if value is not None})
+                return params
+
+            def reply(self, status, body):
+                data = (json.dumps(body) + '\n').encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def address_string(self):
+                # Unix socket peers have no address
+                return self.client_address[0] if self.client_address else 'unix'
+
+            def log_message(self, *_args):
+                pass
+
+        class UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+            daemon_threads = True
+
+        self.servers = []
+        self.socket_path = socket_path
+        if port:
+            server = http.server.ThreadingHTTPServer((host, port), Handler)
+            server.daemon_threads = True
+            self.servers.append(server)
+        if socket_path:
+            # A socket left behind by a killed process would make bind() fail
+            if os.path.exists(socket_path) and not _socket_in_use(socket_path):
+                os.unlink(socket_path)
+            self.servers.append(UnixServer(socket_path, Handler))
+        self.threads = [threading.Thread(target=server.serve_forever, name='mam-control', daemon=True) for server in self.servers]
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def stop(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        if self.socket_path:
+            try:
+                os.unlink(self.socket_path)
+            except OSError:
+                pass
+
+
+def _socket_in_use(path):
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+        return True
+    except OSError:
+        return False
+    finally:
+        probe.close()
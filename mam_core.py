@@ -0,0 +1,730 @@
+"""
+Description:
+Core update logic for the MAM IP Updater, shared by the GUI and the headless modes.
+It resolves the current IP address, compares it with the cached one in MAM.ip and
+only calls the MyAnonamouse dynamicSeedbox.php API when the address actually changed.
+"""
+
+import json
+import os
+import random
+import threading
+import time
+
+# Modules only some IP methods need (mam_docker, mam_netns, subprocess, http.client,
+# concurrent.futures) are imported where they are used, so a cron run of the headless
+# CLI doesn't pay for them.
+from mam_http import CancelToken, HTTPClient, HTTPClientError, Response, cookie_fingerprint, keep_refreshed_cookie, load_cookie_jar, save_cookie_jar
+from mam_containers import DEFAULT_CACHE_TTL, DEFAULT_NEGATIVE_TTL, describe
+from mam_resolver import MAX_RESPONSE_BYTES, IPResolver, ResolverError, extract_ip, parse_source, valid_ip
+from mam_state import LockTimeout, StateStore, cookie_seed
+
+DEFAULT_URL = 'https://t.myanonamouse.net/json/dynamicSeedbox.php'
+DEFAULT_IP_URL = 'https://www.myanonamouse.net/myip.php'
+
+METHOD_MANUAL = 'Enter Manually'
+METHOD_WEBSITE = 'Fetch from Website'
+METHOD_DOCKER = 'From Docker Container'
+IP_METHODS = (METHOD_MANUAL, METHOD_WEBSITE, METHOD_DOCKER)
+
+# How Docker-mode requests reach the network: docker exec inside the container,
+# or in-process from a thread that joined the container's network namespace
+NETWORK_HOST = 'host'
+NETWORK_EXEC = 'exec'
+NETWORK_NETNS = 'netns'
+DOCKER_NETWORKS = (NETWORK_EXEC, NETWORK_NETNS)
+
+# MAM allows one dynamic seedbox IP change per hour
+RATE_LIMIT_MESSAGE = 'Last change too recent'
+RATE_LIMIT_WINDOW = 3600
+RATE_LIMIT_BACKOFF = 300
+
+# Every update runs against one overall time budget. Each phase may use at most its
+# share of the budget, and never more than what is left of it.
+DEFAULT_UPDATE_TIMEOUT = 60
+PHASE_RESOLVE = 'resolve'
+PHASE_STATE = 'state'
+PHASE_API = 'api'
+# Waiting for a concurrent update of the same account; bounded by the whole budget
+PHASE_LOCK = 'lock'
+PHASE_SHARES = {PHASE_RESOLVE: 0.5, PHASE_STATE: 0.2, PHASE_API: 1.0}
+# Part of the budget a phase must leave for the ones after it (the final MAM.ip write)
+PHASE_RESERVE = 0.05
+TIMEOUT_SLACK = 0.1
+
+# A caller that waited for a concurrent update of the same account reuses its
+# result if it finished at most this many seconds before the caller arrived
+SINGLE_FLIGHT_WINDOW = 10
+
+class UpdateError(Exception):
+    """
+    Raised by the pipeline steps with a message suitable for the output log.
+    """
+
+
+class PhaseTimeout(UpdateError):
+    def __init__(self, phase, timeout):
+        super().__init__(f"Error: Timed out during the {phase} phase after {timeout:.1f}s.")
+        self.phase = phase
+
+
+class Deadline(object):
+    def __init__(self, budget):
+        self.budget = budget
+        self.expires = time.monotonic() + budget
+
+    def remaining(self):
+        return max(0.0, self.expires - time.monotonic())
+
+
+class Phase(object):
+    """
+    One pipeline phase with its slice of the deadline. The cancel token fires when the
+    slice runs out (or on abort), which tears down the phase's in-flight requests.
+    If timings is a dict, the time spent in the phase is added to timings[name].
+    """
+    def __init__(self, deadline, name, timings=None):
+        self.name = name
+        self.timings = timings
+        reserve = deadline.budget * PHASE_RESERVE if name != PHASE_STATE else 0
+        self.timeout = max(0.0, min(deadline.remaining() - reserve, deadline.budget * PHASE_SHARES[name]))
+        self.expires = time.monotonic() + self.timeout
+        self.cancel = CancelToken()
+        self.aborted = False
+        self.started = None
+        self._timer = None
+
+    def remaining(self):
+        return max(0.0, self.expires - time.monotonic())
+
+    def abort(self):
+        self.aborted = True
+        self.cancel.cancel()
+
+    def __enter__(self):
+        if self.timeout <= 0:
+            raise PhaseTimeout(self.name, 0)
+        self._timer = threading.Timer(self.timeout, self.cancel.cancel)
+        self._timer.daemon = True
+        self.started = time.monotonic()
+        self._timer.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._timer.cancel()
+        if self.timings is not None:
+            self.timings[self.name] = self.timings.get(self.name, 0.0) + time.monotonic() - self.started
+        if exc_type is None or not issubclass(exc_type, UpdateError) or issubclass(exc_type, PhaseTimeout):
+            return False
+        if self.aborted:
+            raise UpdateError("Error: Update cancelled.") from exc
+        if self.cancel.cancelled or self.remaining() <= TIMEOUT_SLACK:
+            raise PhaseTimeout(self.name, self.timeout) from exc
+        return False
+
+
+class Account(object):
+    """
+    Settings for one MAM session, as stored in a section of the config file.
+    """
+    def __init__(self, name='DEFAULT', mam_cookie='', ip_method=METHOD_WEBSITE, manual_ip='',
+                 external_ip_url='', container_name='', statedir='', url='', cachefile='', cookiefile='',
+                 docker_network=NETWORK_EXEC, netns='', ip_quorum=1, update_timeout=DEFAULT_UPDATE_TIMEOUT,
+                 watch_interfaces=False, docker_cache_ttl=DEFAULT_CACHE_TTL, docker_negative_ttl=DEFAULT_NEGATIVE_TTL):
+        self.name = name
+        self.mam_cookie = mam_cookie.strip()
+        self.ip_method = ip_method
+        self.manual_ip = manual_ip.strip()
+        self.external_ip_url = external_ip_url.strip() or DEFAULT_IP_URL
+        self.container_name = container_name.strip()
+        self.statedir = statedir.strip()
+        self.url = url.strip() or DEFAULT_URL
+        self.cachefile = cachefile.strip() or os.path.join(self.statedir, 'MAM.ip')
+        self.cookiefile = cookiefile.strip() or os.path.join(self.statedir, 'MAM.cookie')
+        self.docker_network = docker_network.strip() or NETWORK_EXEC
+        self.netns = netns.strip()
+        self.ip_quorum = int(ip_quorum)
+        self.update_timeout = float(update_timeout)
+        # Read the IP from the outbound interface when it is public, and let the daemons
+        # watch it over rtnetlink (Linux only)
+        self.watch_interfaces = watch_interfaces
+        # How long a container's resolution (ID, PID, running or not) is trusted, see mam_containers.py
+        self.docker_cache_ttl = float(docker_cache_ttl)
+        self.docker_negative_ttl = float(docker_negative_ttl)
+
+    @classmethod
+    def from_section(cls, name, section):
+        return cls(
+            name=name,
+            mam_cookie=section.get('mam_cookie', ''),
+            ip_method=section.get('ip_method', METHOD_WEBSITE),
+            manual_ip=section.get('manual_ip', ''),
+            external_ip_url=section.get('external_ip_url', ''),
+            container_name=section.get('container_name', ''),
+            statedir=section.get('statedir', os.path.expanduser('~')),
+            url=section.get('url', ''),
+            cachefile=section.get('cachefile', ''),
+            cookiefile=section.get('cookiefile', ''),
+            docker_network=section.get('docker_network', NETWORK_EXEC),
+            netns=section.get('netns', ''),
+            ip_quorum=section.get('ip_quorum', '1'),
+            update_timeout=section.get('update_timeout', str(DEFAULT_UPDATE_TIMEOUT)),
+            watch_interfaces=section.get('watch_interfaces', 'no').strip().lower() in ('1', 'yes', 'true', 'on'),
+            docker_cache_ttl=section.get('docker_cache_ttl', str(DEFAULT_CACHE_TTL)),
+            docker_negative_ttl=section.get('docker_negative_ttl', str(DEFAULT_NEGATIVE_TTL)),
+        )
+
+    def validate(self):
+        if not self.mam_cookie or not self.statedir:
+            raise UpdateError("Error: Please fill in all required fields marked with *.")
+        if self.ip_method not in IP_METHODS:
+            raise UpdateError("Error: Invalid IP retrieval method selected.")
+        if self.ip_method == METHOD_MANUAL and not self.manual_ip:
+            raise UpdateError("Error: Please enter your IP address.")
+        if self.ip_method == METHOD_MANUAL and valid_ip(self.manual_ip) is None:
+            raise UpdateError(f"Error: '{self.manual_ip}' is not a valid public IP address.")
+        if self.ip_method == METHOD_DOCKER and not self.container_name and not self.netns:
+            raise UpdateError("Error: Please enter the Docker container name.")
+        if self.ip_method == METHOD_DOCKER and self.docker_network not in DOCKER_NETWORKS:
+            raise UpdateError(f"Error: Invalid docker_network '{self.docker_network}', expected one of: {', '.join(DOCKER_NETWORKS)}.")
+        if self.ip_method != METHOD_MANUAL:
+            for source in self.ip_sources:
+                try:
+                    parse_source(source)
+                except ValueError as e:
+                    raise UpdateError(f"Error: {e}")
+
+    @property
+    def ip_sources(self):
+        # external_ip_url may list several IP-echo sources separated by commas
+        return [url.strip() for url in self.external_ip_url.split(',') if url.strip()] or [DEFAULT_IP_URL]
+
+    @property
+    def network(self):
+        if self.ip_method != METHOD_DOCKER:
+            return NETWORK_HOST
+        if self.netns:
+            return NETWORK_NETNS
+        return self.docker_network
+
+
+class UpdateResult(object):
+    UPDATED = 'updated'
+    UNCHANGED = 'unchanged'
+    RATE_LIMITED = 'rate_limited'
+    FAILED = 'failed'
+    ERROR = 'error'
+    TIMEOUT = 'timeout'
+
+    def __init__(self, status, message, ip=None, retry_at=None, phase=None):
+        self.status = status
+        self.message = message
+        self.ip = ip
+        self.retry_at = retry_at
+        # Phase that ran out of time (TIMEOUT) or failed (ERROR)
+        self.phase = phase
+
+    def to_dict(self):
+        return {'status': self.status, 'message': self.message, 'ip': self.ip, 'retry_at': self.retry_at, 'phase': self.phase}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['status'], data['message'], data.get('ip'), data.get('retry_at'), data.get('phase'))
+
+    @property
+    def ok(self):
+        return self.status in (self.UPDATED, self.UNCHANGED)
+
+    def __repr__(self):
+        return f"UpdateResult({self.status!r}, {self.message!r}, ip={self.ip!r})"
+
+
+def get_external_ip(resolver, timeout=None, cancel=None):
+    try:
+        return resolver.resolve(timeout=timeout, cancel=cancel)
+    except ResolverError as e:
+        raise UpdateError(f"Error retrieving IP address: {e}")
+
+
+def container_exec(container_name, cmd, docker=None, timeout=None, cache=None):
+    """
+    Run cmd inside the container and return its stdout, through the Docker socket when
+    it is reachable and the docker CLI otherwise. With a ContainerCache, a container
+    known to be missing or stopped fails without an exec, and a cached ID is exec'd by ID.
+    """
+    from mam_docker import DockerError, get_client as get_docker_client
+    entry = cache.lookup(container_name) if cache is not None else None
+    if entry is not None and not entry['running']:
+        raise UpdateError(f"Error: {describe(container_name, entry)}.")
+    target = entry['id'] if entry is not None and entry.get('id') else container_name
+
+    def gone(exists):
+        if target != container_name:
+            # The cached container was removed or replaced; look the name up afresh
+            cache.invalidate(container_name)
+            return container_exec(container_name, cmd, docker, timeout, cache)
+        entry = {'exists': exists, 'running': False}
+        if cache is not None:
+            cache.store(container_name, entry)
+        raise UpdateError(f"Error: {describe(container_name, entry)}.")
+
+    docker = docker or get_docker_client()
+    if docker.available():
+        try:
+            exit_code, stdout, _stderr = docker.exec(target, cmd, timeout=timeout)
+        except DockerError as e:
+            if e.status in (404, 409):
+                return gone(e.status == 409)
+            raise UpdateError(f"Error running '{cmd[0]}' in Docker container '{container_name}': {e}")
+        if exit_code != 0:
+            raise UpdateError(f"Error: '{cmd[0]}' in Docker container '{container_name}' exited with status {exit_code}.")
+        return stdout
+    import subprocess
+    try:
+        result = subprocess.run(['docker', 'exec', target] + list(cmd), stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, check=True, timeout=timeout)
+    except subprocess.CalledProcessError as e:
+        stderr = (e.stderr or '').lower()
+        if 'no such container' in stderr:
+            return gone(False)
+        if 'is not running' in stderr or 'is paused' in stderr:
+            return gone(True)
+        raise UpdateError(f"Error running '{cmd[0]}' in Docker container '{container_name}': {e}")
+    except (subprocess.TimeoutExpired, OSError) as e:
+        raise UpdateError(f"Error running '{cmd[0]}' in Docker container '{container_name}': {e}")
+    return result.stdout
+
+
+def curl_command(timeout=None):
+    cmd = ['curl', '-s']
+    if timeout:
+        cmd += ['--max-time', f"{timeout:.1f}"]
+    return cmd
+
+
+def get_docker_ip(container_name, ip_url=DEFAULT_IP_URL, docker=None, timeout=None, cache=None):
+    try:
+        ip_url, rule = parse_source(ip_url)
+    except ValueError as e:
+        raise UpdateError(f"Error: {e}")
+    # curl stops on its own when the server announces a bigger body
+    cmd = curl_command(timeout) + ['--max-filesize', str(MAX_RESPONSE_BYTES), ip_url]
+    response = container_exec(container_name, cmd, docker, timeout, cache).strip()
+    if not response:
+        raise UpdateError(f"Error: Failed to retrieve IP address from Docker container '{container_name}'.")
+    current_ip = extract_ip(response, rule)
+    if not current_ip:
+        raise UpdateError("Error: No valid IP address found in the container's response.")
+    return current_ip
+
+
+def parse_seedbox_response(response):
+    response = response.strip()
+    if not response:
+        raise UpdateError("Error: Failed to get a response from the MyAnonamouse website.")
+    try:
+        response_json = json.loads(response)
+    except json.JSONDecodeError:
+        raise UpdateError("Error: Received invalid response from the MyAnonamouse website.")
+    if not isinstance(response_json, dict):
+        raise UpdateError("Error: Received invalid response from the MyAnonamouse website.")
+    return response_json
+
+
+def update_seedbox_ip(http, mam_cookie, cookiefile, url, timeout=None, cancel=None):
+    """
+    Call dynamicSeedbox.php and return the decoded JSON reply.
+    The cookie file is only rewritten when MAM sent a new cookie.
+    """
+    try:
+        jar = load_cookie_jar(cookiefile, mam_cookie, url)
+        before = cookie_fingerprint(jar)
+        result = http.get(url, headers={'Accept': 'application/json'}, cookiejar=jar, timeout=timeout, cancel=cancel)
+        keep_refreshed_cookie(jar, 'mam_id', before)
+        save_cookie_jar(jar, before)
+    except (HTTPClientError, OSError) as e:
+        raise UpdateError(f"Error updating IP address: {e}")
+    return parse_seedbox_response(result.text())
+
+
+def update_seedbox_ip_docker(container_name, mam_cookie, cookiefile, url, docker=None, timeout=None, cache=None):
+    """
+    Call dynamicSeedbox.php with curl inside the container, so MAM sees the container's IP.
+    The response headers are parsed here so refreshed cookies still land in cookiefile.
+    """
+    try:
+        jar = load_cookie_jar(cookiefile, mam_cookie, url)
+    except OSError as e:
+        raise UpdateError(f"Error updating IP address: {e}")
+    before = cookie_fingerprint(jar)
+    import http.client
+    import io
+    import urllib.request
+    cookie_request = urllib.request.Request(url)
+    jar.add_cookie_header(cookie_request)
+    cmd = curl_command(timeout) + ['-i', '-H', 'Accept: application/json']
+    if cookie_request.has_header('Cookie'):
+        cmd += ['-H', f"Cookie: {cookie_request.get_header('Cookie')}"]
+    output = container_exec(container_name, cmd + [url], docker, timeout, cache)
+
+    # curl -i prints a header block per response it read: a proxy's "Connection
+    # established" or a "100 Continue" comes before the one of dynamicSeedbox.php
+    head, body = None, output.replace('\r\n', '\n')
+    while body.startswith('HTTP/'):
+        head, _, body = body.partition('\n\n')
+    if head is not None:
+        header_block = head.partition('\n')[2]
+        headers = http.client.parse_headers(io.BytesIO(header_block.encode() + b'\n\n'))
+        jar.extract_cookies(Response(url, None, None, headers, b''), cookie_request)
+        keep_refreshed_cookie(jar, 'mam_id', before)
+        try:
+            save_cookie_jar(jar, before)
+        except OSError as e:
+            raise UpdateError(f"Error updating IP address: {e}")
+    return parse_seedbox_response(body)
+
+
+class Updater(object):
+    """
+    Runs the update pipeline for one account and remembers MAM's rate limit between runs.
+    """
+    def __init__(self, account, http=None, docker=None, source_stats=None):
+        self.account = account
+        self.http = http or HTTPClient()
+        self.docker = docker
+        self.source_stats = source_stats if source_stats is not None else {}
+        self.resolver = IPResolver(self.http, account.ip_sources, account.ip_quorum, stats=self.source_stats)
+        self.netns_worker = None
+        self.netns_resolver = None
+        # The ContainerCache of the state directory, once a Docker-mode run used it
+        self.containers = None
+        self.current_phase = None
+        self.lock_wait = None
+        # Set when a reloaded config changed mam_cookie, so the new cookie reaches MAM
+        self.force_next = False
+        # Seconds spent per phase (and waiting for the account lock) in the last run
+        self.timings = {}
+        self.state = StateStore(account.statedir, account.cachefile, account.cookiefile)
+        self.load_rate_limit()
+
+    def load_rate_limit(self):
+        # The rate limit is kept in MAM.state so it survives restarts
+        self.last_change = self.state.get('last_change')
+        self.next_allowed = self.state.get('next_allowed')
+        self.rate_limited_count = self.state.get('rate_limited_count', 0)
+        if self.last_change is None:
+            try:
+                # MAM.ip is only rewritten on a registered change, so its mtime
+                # is the best guess for when MAM last accepted an update.
+                self.last_change = os.path.getmtime(self.account.cachefile)
+            except OSError:
+                pass
+
+    def container_cache(self):
+        from mam_containers import account_cache
+        self.containers = account_cache(self.account)
+        return self.containers
+
+    def netns(self, timeout=None):
+        """
+        Return the worker for the account's network namespace, replacing it
+        when the container was restarted into a new namespace.
+        """
+        from mam_docker import get_client as get_docker_client
+        from mam_netns import NetnsError, NetnsWorker, container_netns_path
+        account = self.account
+        try:
+            path = account.netns or container_netns_path(self.docker or get_docker_client(), account.container_name, timeout, self.container_cache())
+            if self.netns_worker is None or not self.netns_worker.matches(path):
+                self.close_netns()
+                self.netns_worker = NetnsWorker(path)
+                self.netns_resolver = IPResolver(self.netns_worker.http, account.ip_sources, account.ip_quorum, stats=self.source_stats)
+        except NetnsError as e:
+            raise UpdateError(str(e))
+        return self.netns_worker
+
+    def in_netns(self, phase, fn):
+        from concurrent.futures import TimeoutError as FutureTimeoutError
+        from mam_netns import NetnsError
+        try:
+            return self.netns(phase.remaining()).call(fn, timeout=phase.remaining())
+        except NetnsError as e:
+            raise UpdateError(str(e))
+        except FutureTimeoutError:
+            raise UpdateError("Error: Network namespace worker did not finish in time.")
+
+    def local_ip(self, phase):
+        """
+        Return the address of the outbound interface if it is public, None behind NAT.
+        """
+        from mam_netlink import public_address
+        if self.account.network == NETWORK_HOST:
+            return public_address()
+        if self.account.network == NETWORK_NETNS:
+            return self.in_netns(phase, public_address)
+        # docker exec can't see the container's routing table from here
+        return None
+
+    def resolve_ip(self, phase):
+        account = self.account
+        if account.ip_method == METHOD_MANUAL:
+            return account.manual_ip
+        if account.watch_interfaces:
+            ip = self.local_ip(phase)
+            if ip is not None:
+                return ip
+        if account.network == NETWORK_HOST:
+            return get_external_ip(self.resolver, phase.remaining(), phase.cancel)
+        if account.network == NETWORK_NETNS:
+            return self.in_netns(phase, lambda: get_external_ip(self.netns_resolver, phase.remaining(), phase.cancel))
+        return get_docker_ip(account.container_name, account.ip_sources[0], self.docker, phase.remaining(), self.container_cache())
+
+    def call_api(self, phase):
+        account = self.account
+        if account.network == NETWORK_NETNS:
+            return self.in_netns(phase, lambda: update_seedbox_ip(self.netns_worker.http, account.mam_cookie, account.cookiefile, account.url, phase.remaining(), phase.cancel))
+        if account.network == NETWORK_EXEC:
+            return update_seedbox_ip_docker(account.container_name, account.mam_cookie, account.cookiefile, account.url, self.docker, phase.remaining(), self.container_cache())
+        return update_seedbox_ip(self.http, account.mam_cookie, account.cookiefile, account.url, phase.remaining(), phase.cancel)
+
+    def reconfigure(self, account):
+        """
+        Switch to reloaded settings of the same account between runs. The rate-limit
+        memory is kept, and only the parts the changed settings affect are rebuilt.
+        Returns the names of the changed settings.
+        """
+        old = self.account
+        changed = sorted(key for key, value in vars(account).items() if getattr(old, key, None) != value)
+        self.account = account
+        if 'mam_cookie' in changed:
+            self.force_next = True
+        if (account.statedir, account.cachefile, account.cookiefile) != (old.statedir, old.cachefile, old.cookiefile):
+            self.state = StateStore(account.statedir, account.cachefile, account.cookiefile)
+            self.load_rate_limit()
+        if (account.ip_sources, account.ip_quorum) != (old.ip_sources, old.ip_quorum):
+            self.resolver.close()
+            self.resolver = IPResolver(self.http, account.ip_sources, account.ip_quorum, stats=self.source_stats)
+            # The namespace worker's resolver uses the same sources
+            self.close_netns()
+        if (account.network, account.container_name, account.netns) != (old.network, old.container_name, old.netns):
+            self.close_netns()
+        return changed
+
+    def close_netns(self):
+        if self.netns_worker is not None:
+            self.netns_resolver.close()
+            self.netns_worker.close()
+            self.netns_worker = None
+            self.netns_resolver = None
+
+    def close(self):
+        self.close_netns()
+        self.resolver.close()
+
+    def prepare_statedir(self):
+        statedir = self.account.statedir
+        try:
+            self.state.ensure_statedir()
+        except OSError as e:
+            raise UpdateError(f"Error creating directory '{statedir}': {e}")
+        cookiefile = self.account.cookiefile
+        try:
+            self.state.ensure_cookie(self.account.mam_cookie)
+        except OSError as e:
+            raise UpdateError(f"Error creating file '{cookiefile}': {e}")
+
+    def save_rate_limit(self):
+        self.state.update(last_change=self.last_change, next_allowed=self.next_allowed, rate_limited_count=self.rate_limited_count)
+
+    def phase(self, deadline, name):
+        self.current_phase = Phase(deadline, name, self.timings)
+        return self.current_phase
+
+    def cancel(self):
+        """
+        Abort the update in progress, from any thread.
+        """
+        lock_wait = self.lock_wait
+        if lock_wait is not None:
+            lock_wait.cancel()
+        phase = self.current_phase
+        if phase is not None:
+            phase.abort()
+
+    def run(self, force=False, budget=None, ip=None, override_rate_limit=None):
+        """
+        Resolve the IP and register it with MAM if it changed (or if force is set),
+        all within budget seconds (the account's update_timeout by default).
+        A forced update also ignores a known rate limit unless override_rate_limit is False.
+        After mam_cookie was changed by reconfigure(), runs are forced until MAM answered.
+        If ip is given (pushed through the control API), it is used instead of resolving.
+        Only one process updates an account at a time; callers that arrive while
+        an update is running wait for it (for up to another budget) and reuse its
+        result, or get the full budget for their own update once the lock is theirs.
+        """
+        account = self.account
+        budget = budget or account.update_timeout
+        if override_rate_limit is None:
+            override_rate_limit = force
+        force = force or self.force_next
+        arrived = time.time()
+        self.timings = {}
+        try:
+            account.validate()
+            started = time.monotonic()
+            lock = self.acquire_lock(Deadline(budget))
+            self.timings[PHASE_LOCK] = time.monotonic() - started
+        except UpdateError as e:
+            return UpdateResult(UpdateResult.ERROR, str(e))
+        except LockTimeout:
+            return UpdateResult(UpdateResult.TIMEOUT, "Error: Timed out waiting for another update of this account to finish.", phase=PHASE_LOCK)
+        try:
+            if lock.waited:
+                shared = self.shared_result(lock, arrived, force, ip)
+                if shared is not None:
+                    return shared
+                # The other process may have changed MAM.ip and the rate limit
+                self.state.reload()
+                self.load_rate_limit()
+            result = self.update(Deadline(budget), force, ip, override_rate_limit)
+            try:
+                lock.publish(dict(result.to_dict(), finished=time.time()))
+            except OSError:
+                pass
+            return result
+        finally:
+            lock.release()
+
+    def acquire_lock(self, deadline):
+        statedir = self.account.statedir
+        try:
+            self.state.ensure_statedir()
+        except OSError as e:
+            raise UpdateError(f"Error creating directory '{statedir}': {e}")
+        lock = self.state.lock(self.account.name)
+        self.lock_wait = CancelToken()
+        try:
+            lock.acquire(deadline.remaining(), self.lock_wait)
+        except LockTimeout:
+            if self.lock_wait.cancelled:
+                raise UpdateError("Error: Update cancelled.")
+            raise
+        except OSError as e:
+            raise UpdateError(f"Error locking '{lock.path}': {e}")
+        finally:
+            self.lock_wait = None
+        return lock
+
+    def shared_result(self, lock, arrived, force, ip=None):
+        data = lock.read_result()
+        if not data or data.get('finished', 0) < arrived - SINGLE_FLIGHT_WINDOW:
+            return None
+        result = UpdateResult.from_dict(data)
+        # Failed runs are retried, and a forced update still needs its own API call
+        if result.status in (UpdateResult.ERROR, UpdateResult.TIMEOUT) or (force and result.status == UpdateResult.UNCHANGED):
+            return None
+        # A pushed address the other update didn't see needs its own check
+        if ip is not None and result.ip != ip:
+            return None
+        result.message += " (result of a concurrent update)"
+        return result
+
+    def update(self, deadline, force, ip=None, override_rate_limit=False):
+        account = self.account
+        try:
+            if ip is not None:
+                current_ip = ip
+            else:
+                with self.phase(deadline, PHASE_RESOLVE) as phase:
+                    current_ip = self.resolve_ip(phase)
+            cached_ip = self.state.cached_ip()
+            # A new or rotated mam_cookie has to be registered even if the IP stayed the same
+            if current_ip == cached_ip and not force and not self.cookie_changed():
+                return UpdateResult(UpdateResult.UNCHANGED, f"IP unchanged ({current_ip}), no update needed.", current_ip)
+
+            now = time.time()
+            if self.next_allowed is not None and now < self.next_allowed and not override_rate_limit:
+                wait = int(self.next_allowed - now)
+                return UpdateResult(UpdateResult.RATE_LIMITED, f"No change made: {RATE_LIMIT_MESSAGE}, retrying in {wait}s.", current_ip, self.next_allowed)
+
+            with self.phase(deadline, PHASE_STATE):
+                self.prepare_statedir()
+            with self.phase(deadline, PHASE_API) as phase:
+                response_json = self.call_api(phase)
+            return self.handle_response(deadline, response_json, current_ip, pushed=ip is not None)
+        except PhaseTimeout as e:
+            return UpdateResult(UpdateResult.TIMEOUT, str(e), phase=e.phase)
+        except UpdateError as e:
+            phase = self.current_phase
+            return UpdateResult(UpdateResult.ERROR, str(e), phase=phase.name if phase is not None else None)
+        finally:
+            self.current_phase = None
+
+    def cookie_changed(self):
+        seed = cookie_seed(self.account.mam_cookie)
+        registered = self.state.get('registered_cookie_seed')
+        if registered is None:
+            # MAM.ip from before the registered cookie was kept: it was registered with the
+            # cookie MAM.cookie was written for, unless the configured one changed since
+            written = self.state.get('cookie_seed')
+            if written is not None and written != seed:
+                return True
+            try:
+                self.state.update(registered_cookie_seed=seed)
+            except OSError:
+                pass
+            return False
+        return registered != seed
+
+    def handle_response(self, deadline, response_json, current_ip, pushed=False):
+        account = self.account
+        success = response_json.get('Success')
+        message = response_json.get('msg')
+        if success == True:
+            if pushed:
+                # MAM registers the address the request came from, not the one any local
+                # process pushed; without it in the reply, the next poll checks
+                current_ip = registered_ip(response_json)
+            self.last_change = time.time()
+            self.next_allowed = None
+            self.rate_limited_count = 0
+            result = UpdateResult(UpdateResult.UPDATED, f"Success: {message}", current_ip)
+        elif message == RATE_LIMIT_MESSAGE:
+            self.next_allowed = self.rate_limit_until()
+            result = UpdateResult(UpdateResult.RATE_LIMITED, f"No change made: {message}", current_ip, self.next_allowed)
+        else:
+            result = UpdateResult(UpdateResult.FAILED, f"Failed: {message}", current_ip)
+        if result.status != UpdateResult.RATE_LIMITED:
+            self.force_next = False
+        try:
+            with self.phase(deadline, PHASE_STATE):
+                self.state.record_response(current_ip, response_json)
+                self.save_rate_limit()
+                if result.status == UpdateResult.UPDATED:
+                    if current_ip is not None:
+                        self.state.set_ip(current_ip)
+                    self.state.update(registered_cookie_seed=cookie_seed(account.mam_cookie))
+        except OSError as e:
+            return UpdateResult(UpdateResult.ERROR, f"Error writing to state directory '{account.statedir}': {e}", current_ip, phase=PHASE_STATE)
+        return result
+
+    def rate_limit_until(self):
+        now = time.time()
+        self.rate_limited_count += 1
+        if self.last_change is not None and self.last_change + RATE_LIMIT_WINDOW > now:
+            return self.last_change + RATE_LIMIT_WINDOW
+        # We don't know when the last change happened; back off until MAM accepts it
+        delay = min(RATE_LIMIT_WINDOW, RATE_LIMIT_BACKOFF * 2 ** (self.rate_limited_count - 1))
+        return now + delay
+
+
+def registered_ip(response_json):
+    """
+    Return the address a successful MAM reply says was registered, or None.
+    """
+    reported = response_json.get('ip')
+    ip = valid_ip(reported) if isinstance(reported, str) else None
+    return str(ip) if ip is not None else None
+
+
+def jittered(delay, jitter=0.1):
+    return delay + random.uniform(0, delay * jitter)
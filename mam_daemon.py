@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+
+"""
+Description:
+Headless daemon mode for the MAM IP Updater.
+It polls the current IP address on a fixed interval and only calls the MyAnonamouse API
+when the address differs from the one cached in MAM.ip, or when mam_cookie was replaced
+since MAM last accepted it. When MAM answers
+"Last change too recent", the next attempt is scheduled for the earliest allowed time.
+
+Usage:
+    python3 mam_daemon.py [--config FILE] [--interval SECONDS] [--once] [--metrics-port PORT] [--metrics-file FILE]
+                          [--control-port PORT] [--control-socket PATH] [--no-reload]
+
+Changes to the config file are picked up while the daemon runs (see mam_reload.py).
+"""
+
+import argparse
+import signal
+import sys
+import threading
+import time
+
+from mam_config import DEFAULT_CONFIG, load_account, read_config
+from mam_control import DEFAULT_DEBOUNCE, ControlError, ControlServer, Debouncer, is_loopback
+from mam_containers import account_cache
+from mam_core import METHOD_DOCKER, METHOD_MANUAL, NETWORK_NETNS, Updater, UpdateResult, jittered
+from mam_docker import EventWatcher, get_client as get_docker_client
+from mam_metrics import Metrics, MetricsServer
+from mam_reload import ConfigWatcher
+
+DEFAULT_INTERVAL = 300
+MAX_ERROR_BACKOFF = 3600
+# Settings the container and interface watchers are started from
+WATCHED_SETTINGS = {'ip_method', 'container_name', 'netns', 'docker_network', 'watch_interfaces'}
+
+
+def log(message):
+    print(f"{time.strftime('%Y-%m-%d %H:%M:%S')} {message}", flush=True)
+
+
+class Daemon(object):
+    """
+    Poll loop around an Updater with rate-limit aware, jittered scheduling.
+    """
+    def __init__(self, updater, interval=DEFAULT_INTERVAL, jitter=0.1, log=log, metrics=None, metrics_file=None):
+        self.updater = updater
+        self.interval = interval
+        self.jitter = jitter
+        self.log = log
+        self.metrics = metrics
+        self.metrics_file = metrics_file
+        self.failures = 0
+        # Polls and pushes from the control API take turns on the one Updater
+        self.run_lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.wake_event = threading.Event()
+
+    def next_delay(self, result):
+        if result.ok:
+            self.failures = 0
+            return self.interval
+        if result.status == UpdateResult.RATE_LIMITED and result.retry_at is not None:
+            self.failures = 0
+            return jittered(max(result.retry_at - time.time(), 1), self.jitter)
+        self.failures += 1
+        base = min(self.interval, 60)
+        return jittered(min(base * 2 ** (self.failures - 1), MAX_ERROR_BACKOFF), self.jitter)
+
+    def run_once(self, force=False, ip=None, override_rate_limit=None):
+        with self.run_lock:
+            started = time.monotonic()
+            result = self.updater.run(force=force, ip=ip, override_rate_limit=override_rate_limit)
+            self.log(f"[{self.updater.account.name}] {result.message}")
+            if self.metrics is not None:
+                self.metrics.record(self.updater, result, time.monotonic() - started)
+                write_metrics(self.metrics, self.metrics_file, self.log)
+        return result
+
+    def reconfigure(self, account, interval):
+        """
+        Apply reloaded settings between runs; returns the names of the changed account settings.
+        """
+        with self.run_lock:
+            changed = self.updater.reconfigure(account)
+            self.interval = interval
+        return changed
+
+    def push(self, _name, force, ip):
+        # Runs the debounced update requested through the control API. Any local
+        # process can push, so even a forced push waits out MAM's rate limit.
+        self.log(f"[{self.updater.account.name}] Update pushed" + (f", IP changed to {ip}" if ip else '') + '.')
+        return self.run_once(force=force, ip=ip, override_rate_limit=False)
+
+    def run(self):
+        while not self.stop_event.is_set():
+            result = self.run_once()
+            delay = self.next_delay(result)
+            self.wake_event.wait(delay)
+            self.wake_event.clear()
+
+    def trigger(self, reason):
+        # Run the next check now instead of waiting for the poll interval
+        self.log(f"[{self.updater.account.name}] {reason}, checking IP now.")
+        self.wake_event.set()
+
+    def stop(self, *_args):
+        self.stop_event.set()
+        self.wake_event.set()
+        self.updater.cancel()
+
+
+def watch_containers(accounts, callback):
+    """
+    Start a Docker event watcher for the Docker-based accounts, if the socket is reachable.
+    callback(container_name, action) runs on the watcher thread.
+    """
+    docker_accounts = [account for account in accounts if account.ip_method == METHOD_DOCKER and account.container_name]
+    names = [account.container_name for account in docker_accounts]
+    client = get_docker_client()
+    if not names or not client.available():
+        return None
+    # Loaded now, so events can invalidate entries before the accounts' first run
+    for account in docker_accounts:
+        account_cache(account)
+    return EventWatcher(client, names, callback).start()
+
+
+def watch_interfaces(accounts, callback, log=log):
+    """
+    Start an rtnetlink watcher for every account with watch_interfaces set, in the
+    account's network namespace. callback(account, address, public) runs on the watcher
+    thread when the account's outbound address changes.
+    """
+    from mam_netlink import NetlinkWatcher
+    from mam_netns import container_netns_path
+    watchers = []
+    for account in accounts:
+        if not account.watch_interfaces or account.ip_method == METHOD_MANUAL:
+            continue
+        netns = None
+        if account.network == NETWORK_NETNS:
+            netns = account.netns or (lambda account=account: container_netns_path(get_docker_client(), account.container_name, cache=account_cache(account)))
+        elif account.ip_method == METHOD_DOCKER:
+            netns = lambda account=account: container_netns_path(get_docker_client(), account.container_name, cache=account_cache(account))
+        on_change = lambda address, public, account=account: callback(account, address, public)
+        on_error = lambda message, account=account: log(f"[{account.name}] {message}")
+        watchers.append(NetlinkWatcher(on_change, netns, on_error).start())
+    return watchers
+
+
+class AccountWatchers(object):
+    """
+    The container event and interface watchers for a set of accounts, restarted by
+    start() when a config reload changed what they watch.
+    """
+    def __init__(self, on_container_event, on_address_change):
+        self.on_container_event = on_container_event
+        self.on_address_change = on_address_change
+        self.watchers = []
+
+    def start(self, accounts):
+        self.stop()
+        container_watcher = watch_containers(accounts, self.on_container_event)
+        self.watchers = ([container_watcher] if container_watcher else []) + watch_interfaces(accounts, self.on_address_change)
+        return self
+
+    def stop(self):
+        for watcher in self.watchers:
+            watcher.stop()
+        self.watchers = []
+
+
+def watch_config(args, callback, validate):
+    """
+    Start watching the --config file unless --no-reload was given. callback(settings)
+    runs on the watcher thread with settings that passed validate(settings).
+    """
+    if args.no_reload:
+        return None
+    return ConfigWatcher(args.config, callback, validate, on_error=log).start()
+
+
+def describe_address_change(address, public):
+    if public:
+        return f"Interface address changed to {address}"
+    return f"Route or address behind NAT changed ({address})"
+
+
+def add_reload_arguments(parser):
+    parser.add_argument('--no-reload', action='store_true', help="Don't pick up changes to the config file while running.")
+
+
+def add_metrics_arguments(parser):
+    parser.add_argument('--metrics-port', type=int, help="Serve Prometheus metrics on this port. Default: metrics_port from the config, off if unset.")
+    parser.add_argument('--metrics-host', help="Address to serve metrics on. Default: metrics_host from the config or 127.0.0.1.")
+    parser.add_argument('--metrics-file', help="Write metrics to this node-exporter textfile after every update. Default: metrics_file from the config.")
+
+
+def start_metrics(args, settings):
+    """
+    Return (metrics, metrics_file, server) for the --metrics-* options; metrics is
+    None when neither a port nor a file is configured.
+    """
+    defaults = settings['DEFAULT']
+    port = args.metrics_port or defaults.getint('metrics_port', fallback=0)
+    host = args.metrics_host or defaults.get('metrics_host', '127.0.0.1')
+    metrics_file = args.metrics_file or defaults.get('metrics_file', '') or None
+    if not port and not metrics_file:
+        return None, None, None
+    metrics = Metrics()
+    server = None
+    if port:
+        server = MetricsServer(metrics, host, port).start()
+        log(f"Serving metrics on http://{host}:{port}/metrics")
+    return metrics, metrics_file, server
+
+
+def add_control_arguments(parser):
+    parser.add_argument('--control-port', type=int, help="Accept pushed updates on this localhost port. Default: control_port from the config, off if unset.")
+    parser.add_argument('--control-host', help="Address to accept pushed updates on; other than localhost, control_token must be set in the config. "
+                                               "Default: control_host from the config or 127.0.0.1.")
+    parser.add_argument('--control-socket', help="Accept pushed updates on this unix socket. Default: control_socket from the config, off if unset.")
+    parser.add_argument('--control-debounce', type=float, help=f"Seconds a burst of pushes is collected into one update. Default: control_debounce from the config or {DEFAULT_DEBOUNCE}.")
+
+
+def start_control(args, settings, names, run):
+    """
+    Start the control API for the --control-* options and return the server, or None
+    when neither a port nor a socket is configured. A burst of pushes for one of the
+    accounts names() returns becomes a single run(account name, force, ip).
+    """
+    defaults = settings['DEFAULT']
+    port = args.control_port or defaults.getint('control_port', fallback=0)
+    host = args.control_host or defaults.get('control_host', '127.0.0.1')
+    socket_path = args.control_socket or defaults.get('control_socket', '') or None
+    token = defaults.get('control_token', '') or None
+    if port and not token and not is_loopback(host):
+        log(f"Not accepting pushed updates on {host}:{port}: set control_token to listen beyond localhost.")
+        port = 0
+    if not port and not socket_path:
+        return None
+    debounce = args.control_debounce if args.control_debounce is not None else defaults.getfloat('control_debounce', fallback=DEFAULT_DEBOUNCE)
+    debouncer = Debouncer(run, debounce)
+
+    def handle(account, force, ip):
+        # Accounts can come and go with config reloads
+        known = names()
+        if account is not None and account not in known:
+            raise ControlError(f"Unknown account '{account}'")
+        targets = [account] if account is not None else known
+        if ip is not None and len(targets) > 1:
+            raise ControlError("Name the account the IP address belongs to")
+        results = debouncer.submit_all(targets, force, ip)
+        return [(name, results[name]) for name in targets]
+
+    server = ControlServer(handle, host, port, socket_path, token).start()
+    if port:
+        log(f"Accepting pushed updates on http://{host}:{port}/update")
+    if socket_path:
+        log(f"Accepting pushed updates on unix socket {socket_path}")
+    return server
+
+
+def write_metrics(metrics, metrics_file, log=log):
+    if metrics_file:
+        try:
+            metrics.write_textfile(metrics_file)
+        except OSError as e:
+            log(f"Error writing metrics to '{metrics_file}': {e}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Keep the MyAnonamouse dynamic seedbox IP up to date.")
+    parser.add_argument('--config', default=DEFAULT_CONFIG, help="Path to the updater config file.")
+    parser.add_argument('--interval', type=float, help=f"Seconds between IP checks. Default: poll_interval from the config or {DEFAULT_INTERVAL}.")
+    parser.add_argument('--once', action='store_true', help="Run a single check and exit.")
+    parser.add_argument('--force', action='store_true', help="Call the MAM API even if the IP is unchanged.")
+    parser.add_argument('--timeout', type=float, help="Overall time budget for one update in seconds. Default: update_timeout from the config.")
+    add_metrics_arguments(parser)
+    add_control_arguments(parser)
+    add_reload_arguments(parser)
+    args = parser.parse_args(argv)
+
+    def load(settings):
+        account = load_account(settings)
+        if args.timeout:
+            account.update_timeout = args.timeout
+        return account, args.interval or settings['DEFAULT'].getfloat('poll_interval', fallback=DEFAULT_INTERVAL)
+
+    settings = read_config(args.config)
+    account, interval = load(settings)
+    metrics, metrics_file, metrics_server = start_metrics(args, settings)
+    daemon = Daemon(Updater(account), interval=interval, metrics=metrics, metrics_file=metrics_file)
+
+    if args.once:
+        result = daemon.run_once(force=args.force)
+        return 0 if result.ok or result.status == UpdateResult.RATE_LIMITED else 1
+
+    signal.signal(signal.SIGTERM, daemon.stop)
+    signal.signal(signal.SIGINT, daemon.stop)
+    watchers = AccountWatchers(lambda name, action: daemon.trigger(f"Container '{name}' {action}"),
+                               lambda _account, address, public: daemon.trigger(describe_address_change(address, public))).start([account])
+    control_server = start_control(args, settings, lambda: [daemon.updater.account.name], daemon.push)
+
+    def reload(settings):
+        account, interval = load(settings)
+        changed = daemon.reconfigure(account, interval)
+        log(f"[{account.name}] Config reloaded" + (f", changed: {', '.join(changed)}." if changed else ', no account changes.'))
+        if WATCHED_SETTINGS.intersection(changed):
+            watchers.start([account])
+
+    config_watcher = watch_config(args, reload, lambda settings: load(settings)[0].validate())
+    daemon.run()
+    if config_watcher:
+        config_watcher.stop()
+    watchers.stop()
+    if control_server:
+        control_server.stop()
+    if metrics_server:
+        metrics_server.stop()
+    daemon.updater.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
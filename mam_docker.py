@@ -0,0 +1,298 @@
+"""
+Description:
+Minimal Docker Engine API client for the MAM IP Updater.
+It talks to the Docker daemon over its unix socket with persistent HTTP/1.1 connections
+instead of spawning the docker CLI, and can follow the /events stream so a container
+restart triggers an immediate IP check and drops the container from the resolution cache.
+"""
+
+import http.client
+import json
+import os
+import socket
+import struct
+import sys
+import threading
+import urllib.parse
+
+from mam_containers import invalidate_container
+
+DEFAULT_SOCKET = '/var/run/docker.sock'
+API_VERSION = 'v1.41'
+DEFAULT_TIMEOUT = 30
+# Container events that usually mean a new VPN endpoint
+RESTART_EVENTS = ('start', 'restart', 'unpause')
+# Container events after which a cached ID, PID or running state may be wrong
+LIFECYCLE_EVENTS = RESTART_EVENTS + ('create', 'die', 'stop', 'kill', 'pause', 'destroy', 'rename')
+
+
+class DockerError(Exception):
+    """
+    Raised when the Docker daemon is unreachable or rejects a request.
+    """
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path, timeout=DEFAULT_TIMEOUT):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.socket_path)
+        except OSError:
+            sock.close()
+            raise
+        self.sock = sock
+
+
+def default_socket_path():
+    docker_host = os.environ.get('DOCKER_HOST', '')
+    if docker_host.startswith('unix://'):
+        return docker_host[len('unix://'):]
+    return DEFAULT_SOCKET
+
+
+def demux_stream(data):
+    """
+    Split a non-TTY attach/exec stream into (stdout, stderr) bytes.
+    """
+    stdout = bytearray()
+    stderr = bytearray()
+    offset = 0
+    while offset + 8 <= len(data):
+        stream, length = struct.unpack('>BxxxL', data[offset:offset + 8])
+        chunk = data[offset + 8:offset + 8 + length]
+        if stream == 2:
+            stderr += chunk
+        else:
+            stdout += chunk
+        offset += 8 + length
+    return bytes(stdout), bytes(stderr)
+
+
+class DockerClient(object):
+    """
+    Thread-safe Docker Engine API client with a small pool of keep-alive socket connections.
+    """
+    def __init__(self, socket_path=None, timeout=DEFAULT_TIMEOUT, max_idle=4):
+        self.socket_path = socket_path or default_socket_path()
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self._lock = threading.Lock()
+        self._idle = []
+
+    def available(self):
+        return os.path.exists(self.socket_path)
+
+    def _acquire(self, timeout):
+        with self._lock:
+            if self._idle:
+                conn = self._idle.pop()
+                conn.timeout = timeout
+                if conn.sock is not None:
+                    conn.sock.settimeout(timeout)
+                return conn, True
+        return UnixHTTPConnection(self.socket_path, timeout=timeout), False
+
+    def _release(self, conn):
+        with self._lock:
+            if len(self._idle) < self.max_idle:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+    def request(self, method, path, body=None, timeout=None):
+        """
+        Send one API request and return (status, body bytes).
+        """
+        url = f'/{API_VERSION}{path}'
+        headers = {'Host': 'docker'}
+        if body is not None:
+            body = json.dumps(body).encode()
+            headers['Content-Type'] = 'application/json'
+        timeout = self.timeout if timeout is None else timeout
+        for attempt in (0, 1):
+            conn, reused = self._acquire(timeout)
+            try:
+                conn.request(method, url, body=body, headers=headers)
+                raw = conn.getresponse()
+                data = raw.read()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError) as e:
+                conn.close()
+                if reused and attempt == 0:
+                    continue
+                raise DockerError(f"Docker daemon connection failed: {e}") from e
+            except (OSError, http.client.HTTPException) as e:
+                conn.close()
+                raise DockerError(f"Docker daemon request failed: {e}") from e
+            break
+        if raw.will_close:
+            conn.close()
+        else:
+            self._release(conn)
+        return raw.status, data
+
+    def _json(self, method, path, body=None, expect=(200,), timeout=None):
+        status, data = self.request(method, path, body=body, timeout=timeout)
+        if status not in expect:
+            try:
+                message = json.loads(data).get('message', '')
+            except (ValueError, AttributeError):
+                message = data.decode(errors='replace').strip()
+            raise DockerError(f"Docker API error {status}: {message}", status)
+        return json.loads(data) if data else None
+
+    def inspect(self, container_name, timeout=None):
+        """
+        Return the container's inspect document, or None if it does not exist.
+        """
+        try:
+            return self._json('GET', f'/containers/{urllib.parse.quote(container_name)}/json', timeout=timeout)
+        except DockerError as e:
+            if e.status == 404:
+                return None
+            raise
+
+    def is_running(self, container_name):
+        info = self.inspect(container_name)
+        return bool(info and info.get('State', {}).get('Running'))
+
+    def exec(self, container_name, cmd, timeout=None):
+        """
+        Run cmd inside the container and return (exit_code, stdout, stderr).
+        """
+        # Counted by mam_profile like the processes the docker CLI would start
+        sys.audit('mam.docker.exec', container_name, list(cmd))
+        created = self._json('POST', f'/containers/{urllib.parse.quote(container_name)}/exec', {
+            'AttachStdout': True,
+            'AttachStderr': True,
+            'Tty': False,
+            'Cmd': list(cmd),
+        }, expect=(201,), timeout=timeout)
+        exec_id = created['Id']
+        status, data = self.request('POST', f'/exec/{exec_id}/start', {'Detach': False, 'Tty': False}, timeout=timeout)
+        if status != 200:
+            raise DockerError(f"Docker API error {status}: {data.decode(errors='replace').strip()}", status)
+        stdout, stderr = demux_stream(data)
+        exit_code = self._json('GET', f'/exec/{exec_id}/json', timeout=timeout).get('ExitCode')
+        return exit_code, stdout.decode(errors='replace'), stderr.decode(errors='replace')
+
+    def events_connection(self):
+        return UnixHTTPConnection(self.socket_path, timeout=None)
+
+    def events(self, container_names=None, event_types=RESTART_EVENTS, stop_event=None, conn=None):
+        """
+        Yield container events as dicts until stop_event is set or the stream ends.
+        Uses its own connection because the stream never completes; pass one from
+        events_connection() to be able to shut it down from another thread.
+        """
+        filters = {'type': ['container'], 'event': list(event_types)}
+        if container_names:
+            filters['container'] = list(container_names)
+        query = urllib.parse.urlencode({'filters': json.dumps(filters)})
+        if conn is None:
+            conn = self.events_connection()
+        try:
+            conn.request('GET', f'/{API_VERSION}/events?{query}', headers={'Host': 'docker'})
+            raw = conn.getresponse()
+            if raw.status != 200:
+                raise DockerError(f"Docker API error {raw.status}: {raw.read().decode(errors='replace').strip()}", raw.status)
+            while stop_event is None or not stop_event.is_set():
+                line = raw.readline()
+                if not line:
+                    return
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+        except (OSError, http.client.HTTPException) as e:
+            raise DockerError(f"Docker event stream failed: {e}") from e
+        finally:
+            conn.close()
+
+
+class EventWatcher(object):
+    """
+    Background thread that calls callback(container_name, event) on container restarts,
+    reconnecting to the event stream with a backoff if the daemon goes away. Every
+    lifecycle event of the containers also invalidates their cached resolution.
+    """
+    def __init__(self, client, container_names, callback, retry_delay=5):
+        self.client = client
+        self.container_names = list(container_names)
+        self.callback = callback
+        self.retry_delay = retry_delay
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='mam-docker-events', daemon=True)
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stop watching; the thread exits without waiting for another event.
+        """
+        with self._lock:
+            self.stop_event.set()
+            conn = self._conn
+        # Wakes the thread from reading the stream
+        if conn is not None and conn.sock is not None:
+            try:
+                conn.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def _run(self):
+        while not self.stop_event.is_set():
+            conn = self.client.events_connection()
+            with self._lock:
+                if self.stop_event.is_set():
+                    break
+                self._conn = conn
+            try:
+                for event in self.client.events(self.container_names, LIFECYCLE_EVENTS, self.stop_event, conn):
+                    if self.stop_event.is_set():
+                        break
+                    attributes = event.get('Actor', {}).get('Attributes', {})
+                    name = attributes.get('name') or event.get('id', '')
+                    action = event.get('Action') or event.get('status')
+                    for key in (name, event.get('id'), attributes.get('oldName', '').lstrip('/')):
+                        if key:
+                            invalidate_container(key)
+                    if action in RESTART_EVENTS:
+                        self.callback(name, action)
+            except DockerError:
+                pass
+            finally:
+                with self._lock:
+                    self._conn = None
+            # Events are missed while the stream is down
+            for name in self.container_names:
+                invalidate_container(name)
+            self.stop_event.wait(self.retry_delay)
+
+
+_default_client = None
+_default_client_lock = threading.Lock()
+
+
+def get_client():
+    global _default_client
+    with _default_client_lock:
+        if _default_client is None:
+            _default_client = DockerClient()
+        return _default_client
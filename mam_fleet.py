@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+
+"""
+Description:
+Fleet mode for the MAM IP Updater.
+Updates every account section of the config file concurrently from one process, so a
+sweep over many qBittorrent-VPN containers takes about as long as the slowest account.
+
+Usage:
+    python3 mam_fleet.py [--config FILE] [--workers N] [--interval SECONDS] [--once] [--metrics-port PORT] [--metrics-file FILE]
+                         [--control-port PORT] [--control-socket PATH] [--no-reload]
+
+Accounts added to, changed in or removed from the config file are picked up between sweeps.
+"""
+
+import argparse
+import signal
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from mam_config import DEFAULT_CONFIG, load_accounts, read_config, validate_accounts
+from mam_core import Updater, UpdateResult
+from mam_control import ControlError
+from mam_daemon import (DEFAULT_INTERVAL, WATCHED_SETTINGS, AccountWatchers, add_control_arguments, add_metrics_arguments,
+                        add_reload_arguments, describe_address_change, log, start_control, start_metrics, watch_config, write_metrics)
+from mam_http import HTTPClient
+
+DEFAULT_WORKERS = 8
+
+
+class FleetResult(object):
+    def __init__(self, account, result, elapsed):
+        self.account = account
+        self.result = result
+        self.elapsed = elapsed
+
+
+class Fleet(object):
+    """
+    Runs one Updater per account on a bounded thread pool.
+    """
+    def __init__(self, accounts, max_workers=DEFAULT_WORKERS, http=None, metrics=None):
+        self.metrics = metrics
+        # Threads are only started when needed, so accounts added by a reload can use them all
+        self.max_workers = max(1, max_workers)
+        self.http = http or HTTPClient(max_idle_per_host=self.max_workers)
+        # IP-echo source statistics are shared so one account's failures trip the breaker for all
+        self.source_stats = {}
+        self.updaters = [Updater(account, self.http, source_stats=self.source_stats) for account in accounts]
+        # Sweeps and pushes from the control API take turns on each Updater
+        self.run_locks = {updater: threading.Lock() for updater in self.updaters}
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='mam-fleet')
+
+    def _run_one(self, updater, force, ip=None, override_rate_limit=None):
+        lock = self.run_locks.get(updater)
+        if lock is None:
+            return self._removed(updater)
+        with lock:
+            # A reload may have removed the account while this run waited for its turn
+            if self.run_locks.get(updater) is not lock:
+                return self._removed(updater)
+            started = time.monotonic()
+            try:
+                result = updater.run(force=force, ip=ip, override_rate_limit=override_rate_limit)
+            except Exception as e:
+                result = UpdateResult(UpdateResult.ERROR, f"Error: Unexpected failure while updating IP: {e}")
+            elapsed = time.monotonic() - started
+            if self.metrics is not None:
+                self.metrics.record(updater, result, elapsed)
+        return FleetResult(updater.account, result, elapsed)
+
+    def _removed(self, updater):
+        return FleetResult(updater.account, UpdateResult(UpdateResult.ERROR, "Skipped: the account was removed from the config."), 0)
+
+    def run_account(self, name, force=False, ip=None, override_rate_limit=None):
+        """
+        Update one account now, on the calling thread. Raises ControlError if there is
+        no such account, e.g. because a reload removed it.
+        """
+        updater = next((updater for updater in self.updaters if updater.account.name == name), None)
+        if updater is None:
+            raise ControlError(f"Unknown account '{name}'")
+        return self._run_one(updater, force, ip, override_rate_limit)
+
+    def run_once(self, force=False, names=None):
+        updaters = [updater for updater in list(self.updaters) if names is None or updater.account.name in names]
+        futures = [self.executor.submit(self._run_one, updater, force) for updater in updaters]
+        return [future.result() for future in futures]
+
+    def reconfigure(self, accounts):
+        """
+        Apply a reloaded account list. New accounts get an Updater, removed ones are
+        closed, and the rest keep theirs (connections, rate-limit memory) with only
+        what their changed settings affect rebuilt. Each account is switched between
+        its runs. Returns (added names, removed names, {name: changed settings}).
+        """
+        current = {updater.account.name: updater for updater in self.updaters}
+        updaters = []
+        added = []
+        changed = {}
+        for account in accounts:
+            updater = current.pop(account.name, None)
+            if updater is None:
+                updater = Updater(account, self.http, source_stats=self.source_stats)
+                self.run_locks[updater] = threading.Lock()
+                added.append(account.name)
+            else:
+                with self.run_locks[updater]:
+                    settings = updater.reconfigure(account)
+                if settings:
+                    changed[account.name] = settings
+            updaters.append(updater)
+        self.updaters = updaters
+        # Runs of removed accounts that haven't started yet are skipped; running ones finish first
+        removed = [(updater, self.run_locks.pop(updater)) for updater in current.values()]
+        for updater, lock in removed:
+            with lock:
+                updater.close()
+        return added, list(current), changed
+
+    def cancel(self):
+        for updater in self.updaters:
+            updater.cancel()
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        for updater in self.updaters:
+            updater.close()
+        self.http.close()
+
+
+def format_table(results):
+    rows = [('ACCOUNT', 'STATUS', 'IP', 'TIME', 'MESSAGE')]
+    for item in results:
+        rows.append((item.account.name, item.result.status, item.result.ip or '-', f"{item.elapsed:.2f}s", item.result.message))
+    widths = [max(len(row[i]) for row in rows) for i in range(4)]
+    lines = []
+    for row in rows:
+        lines.append('  '.join(cell.ljust(widths[i]) for i, cell in enumerate(row[:4])) + '  ' + row[4])
+    ok = sum(1 for item in results if item.result.ok)
+    lines.append(f"{ok}/{len(results)} accounts OK")
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Update the MyAnonamouse dynamic seedbox IP for every configured account.")
+    parser.add_argument('--config', default=DEFAULT_CONFIG, help="Path to the updater config file.")
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help=f"Maximum accounts updated at once. Default: {DEFAULT_WORKERS}")
+    parser.add_argument('--interval', type=float, help=f"Seconds between sweeps. Default: poll_interval from the config or {DEFAULT_INTERVAL}.")
+    parser.add_argument('--once', action='store_true', help="Run a single sweep and exit.")
+    parser.add_argument('--force', action='store_true', help="Call the MAM API on the first sweep even if the IP is unchanged.")
+    parser.add_argument('--timeout', type=float, help="Overall time budget for one account's update in seconds. Default: update_timeout from the config.")
+    add_metrics_arguments(parser)
+    add_control_arguments(parser)
+    add_reload_arguments(parser)
+    args = parser.parse_args(argv)
+
+    def load(settings):
+        accounts = load_accounts(settings)
+        if args.timeout:
+            for account in accounts:
+                account.update_timeout = args.timeout
+        return accounts, args.interval or settings['DEFAULT'].getfloat('poll_interval', fallback=DEFAULT_INTERVAL)
+
+    settings = read_config(args.config)
+    accounts, interval = load(settings)
+    metrics, metrics_file, metrics_server = start_metrics(args, settings)
+    fleet = Fleet(accounts, max_workers=args.workers, metrics=metrics)
+
+    stop_event = threading.Event()
+    wake_event = threading.Event()
+    # Accounts whose container restarted since the last sweep
+    pending = set()
+    pending_lock = threading.Lock()
+
+    def stop(*_args):
+        stop_event.set()
+        wake_event.set()
+        fleet.cancel()
+
+    def on_container_event(container_name, action):
+        with pending_lock:
+            pending.update(account.name for account in accounts if account.container_name == container_name)
+        log(f"Container '{container_name}' {action}, checking IP now.")
+        wake_event.set()
+
+    def on_address_change(account, address, public):
+        with pending_lock:
+            pending.add(account.name)
+        log(f"[{account.name}] {describe_address_change(address, public)}, checking IP now.")
+        wake_event.set()
+
+    def on_push(name, force, ip):
+        log(f"[{name}] Update pushed" + (f", IP changed to {ip}" if ip else '') + '.')
+        # As in the daemon, a forced push doesn't override MAM's rate limit
+        item = fleet.run_account(name, force, ip, override_rate_limit=False)
+        log(f"[{name}] {item.result.message}")
+        if metrics is not None:
+            write_metrics(metrics, metrics_file)
+        return item.result
+
+    def reload(settings):
+        nonlocal accounts, interval
+        new_accounts, interval = load(settings)
+        added, removed, changed = fleet.reconfigure(new_accounts)
+        accounts = new_accounts
+        log(f"Config reloaded: {len(added)} accounts added, {len(removed)} removed, {len(changed)} changed.")
+        for name, settings_changed in changed.items():
+            log(f"[{name}] Changed: {', '.join(settings_changed)}.")
+        if added or removed or any(WATCHED_SETTINGS.intersection(settings_changed) for settings_changed in changed.values()):
+            watchers.start(accounts)
+        if added:
+            with pending_lock:
+                pending.update(added)
+            wake_event.set()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    watchers = AccountWatchers(on_container_event, on_address_change)
+    control_server = config_watcher = None
+    if not args.once:
+        watchers.start(accounts)
+        control_server = start_control(args, settings, lambda: [updater.account.name for updater in fleet.updaters], on_push)
+        config_watcher = watch_config(args, reload, lambda settings: validate_accounts(load(settings)[0]))
+    names = None
+    # Only the first sweep is forced, later ones would all run into MAM's rate limit
+    force = args.force
+    try:
+        while True:
+            started = time.monotonic()
+            results = fleet.run_once(force=force, names=names)
+            force = False
+            print(format_table(results), flush=True)
+            log(f"Sweep of {len(results)} accounts finished in {time.monotonic() - started:.2f}s")
+            if metrics is not None:
+                write_metrics(metrics, metrics_file)
+            if args.once:
+                return 0 if all(item.result.ok or item.result.status == UpdateResult.RATE_LIMITED for item in results) else 1
+            # Event-triggered partial sweeps don't move the regular schedule
+            if names is None:
+                next_sweep = started + interval
+            names = None
+            while not stop_event.is_set():
+                if not wake_event.wait(max(next_sweep - time.monotonic(), 0)):
+                    break
+                wake_event.clear()
+                with pending_lock:
+                    names = set(pending)
+                    pending.clear()
+                if names:
+                    break
+                names = None
+            if stop_event.is_set():
+                return 0
+    finally:
+        if config_watcher:
+            config_watcher.stop()
+        watchers.stop()
+        if control_server:
+            control_server.stop()
+        if metrics_server:
+            metrics_server.stop()
+        fleet.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
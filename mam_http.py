@@ -0,0 +1,389 @@
+"""
+Description:
+Small in-process HTTP layer used by the MAM IP Updater in place of curl.
+Connections are kept alive and reused per host, TLS sessions are resumed
+on reconnect, and the MAM.cookie Netscape file is read and written through
+http.cookiejar.MozillaCookieJar so no external tools are needed.
+"""
+
+import json
+import os
+import socket
+import threading
+import time
+import urllib.parse
+
+# http.client, ssl, http.cookiejar and urllib.request are imported on first use, so the
+# headless CLI starts quickly and a run that needs no request never loads them.
+
+USER_AGENT = 'MAM-IP-Updater/1.2'
+DEFAULT_TIMEOUT = 30
+MAX_IDLE_PER_HOST = 4
+READ_CHUNK = 4096
+
+
+class HTTPClientError(Exception):
+    """
+    Raised when a request could not be completed (connection, TLS or protocol failure).
+    """
+
+
+class CancelToken(object):
+    """
+    Aborts in-flight requests that were started with it, from any thread.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self.cancelled = False
+
+    def register(self, callback):
+        with self._lock:
+            if not self.cancelled:
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def unregister(self, callback):
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback()
+
+
+def _read_bounded(raw, max_bytes=None, until=None):
+    """
+    Read a response body in chunks, stopping at max_bytes or as soon as until(chunk)
+    returns True. Returns (body, complete); an incomplete body leaves the connection
+    unusable for another request.
+    """
+    chunks = []
+    size = 0
+    while max_bytes is None or size < max_bytes:
+        want = READ_CHUNK if max_bytes is None else min(READ_CHUNK, max_bytes - size)
+        chunk = raw.read1(want)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        size += len(chunk)
+        if until is not None and until(chunk):
+            break
+    # read1() never marks a Content-Length body as done; reading its empty rest does
+    if raw.length == 0:
+        raw.read()
+    return b''.join(chunks), raw.isclosed()
+
+
+def _abort_connection(conn):
+    # shutdown() wakes a thread blocked in recv(), close() alone does not
+    sock = conn.sock
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+class Response(object):
+    def __init__(self, url, status, reason, headers, body):
+        self.url = url
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+
+    def text(self):
+        charset = self.headers.get_content_charset() or 'utf-8'
+        return self.body.decode(charset, errors='replace')
+
+    def json(self):
+        return json.loads(self.text())
+
+    def info(self):
+        # Lets http.cookiejar extract Set-Cookie headers from this response
+        return self.headers
+
+
+_https_connection_class = None
+
+
+def _https_connection(*args, **kwargs):
+    """
+    Create an HTTPSConnection that offers the last TLS session of its pool on connect.
+    The class is built on first use, because importing http.client (and the email
+    package behind it) is the bulk of the startup time.
+    """
+    global _https_connection_class
+    if _https_connection_class is None:
+        import http.client
+        import ssl
+
+        class _HTTPSConnection(http.client.HTTPSConnection):
+            def __init__(self, *args, session_cache=None, **kwargs):
+                super().__init__(*args, **kwargs)
+                self._session_cache = session_cache
+
+            def connect(self):
+                http.client.HTTPConnection.connect(self)
+                server_hostname = self.host
+                if self._tunnel_host:
+                    server_hostname = self._tunnel_host
+                session = self._session_cache.get('session') if self._session_cache is not None else None
+                try:
+                    self.sock = self._context.wrap_socket(self.sock, server_hostname=server_hostname, session=session)
+                except ssl.SSLError:
+                    if session is None:
+                        raise
+                    # A stale session must not prevent a full handshake
+                    self._session_cache.pop('session', None)
+                    http.client.HTTPConnection.connect(self)
+                    self.sock = self._context.wrap_socket(self.sock, server_hostname=server_hostname)
+                if self._session_cache is not None and self.sock.session is not None:
+                    self._session_cache['session'] = self.sock.session
+
+        _https_connection_class = _HTTPSConnection
+    return _https_connection_class(*args, **kwargs)
+
+
+class HTTPClient(object):
+    """
+    Thread-safe client that pools keep-alive connections per (scheme, host, port).
+    If resolver is given, resolver(host, port) returns the addresses to try in order
+    instead of letting the socket layer resolve the host name.
+    """
+    def __init__(self, timeout=DEFAULT_TIMEOUT, ssl_context=None, max_idle_per_host=MAX_IDLE_PER_HOST, resolver=None):
+        self.timeout = timeout
+        self.resolver = resolver
+        # Loading the CA store takes a while, so it is deferred to the first HTTPS request
+        self._ssl_context = ssl_context
+        self.max_idle_per_host = max_idle_per_host
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._tls_sessions = {}
+
+    @property
+    def ssl_context(self):
+        with self._lock:
+            if self._ssl_context is None:
+                import ssl
+                self._ssl_context = ssl.create_default_context()
+            return self._ssl_context
+
+    def _new_connection(self, key, timeout):
+        import http.client
+        scheme, host, port = key
+        if scheme == 'https':
+            session_cache = self._tls_sessions.setdefault(key, {})
+            conn = _https_connection(host, port, timeout=timeout, context=self.ssl_context, session_cache=session_cache)
+        else:
+            conn = http.client.HTTPConnection(host, port, timeout=timeout)
+        if self.resolver is not None:
+            conn._create_connection = self._resolved_connection
+        return conn
+
+    def _resolved_connection(self, address, *args):
+        host, port = address
+        error = OSError(f"No addresses found for {host}")
+        for resolved in self.resolver(host, port):
+            try:
+                return socket.create_connection((resolved, port), *args)
+            except OSError as e:
+                error = e
+        raise error
+
+    def _acquire(self, key, timeout):
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                conn = idle.pop()
+                conn.timeout = timeout
+                if conn.sock is not None:
+                    conn.sock.settimeout(timeout)
+                return conn, True
+        return self._new_connection(key, timeout), False
+
+    def _release(self, key, conn):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_idle_per_host:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        with self._lock:
+            pools = list(self._idle.values())
+            self._idle.clear()
+        for idle in pools:
+            for conn in idle:
+                conn.close()
+
+    def request(self, method, url, headers=None, body=None, cookiejar=None, timeout=None, cancel=None, max_bytes=None, until=None):
+        """
+        Send a request and return its Response. With max_bytes or until, the body is
+        read in chunks and only up to max_bytes, or until until(chunk) returns True.
+        """
+        import http.client
+        parsed = urllib.parse.urlsplit(url)
+        if parsed.scheme not in ('http', 'https') or not parsed.hostname:
+            raise HTTPClientError(f"Unsupported URL '{url}'")
+        port = parsed.port or (443 if parsed.scheme == 'https' else 80)
+        key = (parsed.scheme, parsed.hostname, port)
+        path = parsed.path or '/'
+        if parsed.query:
+            path += '?' + parsed.query
+
+        request_headers = {'User-Agent': USER_AGENT, 'Accept': '*/*'}
+        request_headers.update(headers or {})
+        cookie_request = None
+        if cookiejar is not None:
+            from urllib.request import Request
+            cookie_request = Request(url, headers=request_headers, method=method)
+            cookiejar.add_cookie_header(cookie_request)
+            request_headers = dict(cookie_request.header_items())
+
+        timeout = self.timeout if timeout is None else timeout
+        # A pooled connection may have been closed by the server while idle;
+        # retry once on a fresh connection in that case.
+        for attempt in (0, 1):
+            if cancel is not None and cancel.cancelled:
+                raise HTTPClientError(f"Request to {parsed.hostname} cancelled")
+            conn, reused = self._acquire(key, timeout)
+            abort = None
+            if cancel is not None:
+                abort = lambda conn=conn: _abort_connection(conn)
+                cancel.register(abort)
+            try:
+                conn.request(method, path, body=body, headers=request_headers)
+                raw = conn.getresponse()
+                if max_bytes is None and until is None:
+                    data, complete = raw.read(), True
+                else:
+                    data, complete = _read_bounded(raw, max_bytes, until)
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError) as e:
+                conn.close()
+                if reused and attempt == 0 and not (cancel is not None and cancel.cancelled):
+                    continue
+                raise HTTPClientError(f"Connection to {parsed.hostname} failed: {e}") from e
+            except (OSError, http.client.HTTPException) as e:
+                conn.close()
+                raise HTTPClientError(f"Request to {parsed.hostname} failed: {e}") from e
+            finally:
+                if abort is not None:
+                    cancel.unregister(abort)
+            break
+
+        response = Response(url, raw.status, raw.reason, raw.msg, data)
+        if raw.will_close or not complete or (cancel is not None and cancel.cancelled):
+            conn.close()
+        else:
+            self._release(key, conn)
+
+        if cookiejar is not None:
+            cookiejar.extract_cookies(response, cookie_request)
+        return response
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+
+def _cookie_domain(url):
+    import ipaddress
+    host = urllib.parse.urlsplit(url).hostname or ''
+    try:
+        ipaddress.ip_address(host)
+        return host
+    except ValueError:
+        return '.' + host
+
+
+def make_cookie(name, value, url):
+    import http.cookiejar
+    domain = _cookie_domain(url)
+    return http.cookiejar.Cookie(
+        0, name, value, None, False,
+        domain, domain.startswith('.'), domain.startswith('.'),
+        '/', False, False, None, True, None, None, {})
+
+
+def _domain_matches(host, domain):
+    domain = domain.lstrip('.')
+    return host == domain or host.endswith('.' + domain)
+
+
+def load_cookie_jar(cookiefile, mam_cookie=None, url=None):
+    """
+    Load a Netscape cookie file, tolerating the 0 expiry curl uses for session cookies.
+    If mam_cookie is given and the file holds no mam_id that would be sent to the URL's
+    host, it is added.
+    """
+    import http.cookiejar
+    jar = http.cookiejar.MozillaCookieJar(cookiefile)
+    if os.path.exists(cookiefile):
+        try:
+            jar.load(ignore_discard=True, ignore_expires=True)
+        except http.cookiejar.LoadError:
+            jar.clear()
+    for cookie in jar:
+        if cookie.expires == 0:
+            cookie.expires = None
+            cookie.discard = True
+    if mam_cookie and url:
+        host = urllib.parse.urlsplit(url).hostname or ''
+        existing = [c for c in jar if c.name == 'mam_id' and _domain_matches(host, c.domain)]
+        if not existing:
+            jar.set_cookie(make_cookie('mam_id', mam_cookie, url))
+    return jar
+
+
+def cookie_fingerprint(jar):
+    return sorted((c.domain, c.path, c.name, c.value, c.expires) for c in jar)
+
+
+def keep_refreshed_cookie(jar, name, before):
+    """
+    When the server set a new value for cookie name, drop the older copies stored
+    under other domains so only the refreshed one is sent next time.
+    """
+    old_values = set(value for _domain, _path, cookie_name, value, _expires in before if cookie_name == name)
+    cookies = [c for c in jar if c.name == name]
+    if not any(c.value not in old_values for c in cookies):
+        return
+    for cookie in cookies:
+        if cookie.value in old_values:
+            jar.clear(cookie.domain, cookie.path, cookie.name)
+
+
+def save_cookie_jar(jar, before=None):
+    """
+    Write the jar back to its file through a temporary file and a rename.
+    If before (a cookie_fingerprint) is given, nothing is written unless the cookies changed.
+    """
+    if before is not None and cookie_fingerprint(jar) == before:
+        return False
+    directory = os.path.dirname(os.path.abspath(jar.filename))
+    tmp = os.path.join(directory, f".{os.path.basename(jar.filename)}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        jar.save(tmp, ignore_discard=True, ignore_expires=True)
+        os.replace(tmp, jar.filename)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+    return True
+
+
+def cookie_value(jar, name):
+    now = time.time()
+    for cookie in jar:
+        if cookie.name == name and not (cookie.expires and cookie.expires <= now):
+            return cookie.value
+    return None
@@ -0,0 +1,274 @@
+"""
+Description:
+Update metrics for the MAM IP Updater: counters of attempts and outcomes, failures by
+cause, IP changes and per-phase timing histograms. They are rendered in the Prometheus
+text exposition format, served on /metrics by MetricsServer or written to a
+node-exporter textfile, and summarized for the GUI's stats panel.
+"""
+
+import re
+import threading
+import time
+import weakref
+
+from mam_state import atomic_write, read_text
+
+DURATION_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# name -> (type, help)
+METRICS = {
+    'mam_update_attempts_total': ('counter', "Updates attempted."),
+    'mam_update_results_total': ('counter', "Updates by outcome (updated, unchanged, rate_limited, failed, error, timeout)."),
+    'mam_update_failures_total': ('counter', "Failed updates by cause (rejected, error, timeout) and pipeline phase."),
+    'mam_ip_changes_total': ('counter', "IP changes registered with MAM."),
+    'mam_update_duration_seconds': ('histogram', "Time taken by a whole update."),
+    'mam_phase_duration_seconds': ('histogram', "Time spent in each update phase."),
+    'mam_last_update_timestamp_seconds': ('gauge', "When the last update finished."),
+    'mam_last_success_timestamp_seconds': ('gauge', "When the last update that left the IP registered finished."),
+    'mam_rate_limited_until_timestamp_seconds': ('gauge', "When MAM accepts the next change, 0 if not rate limited."),
+    'mam_ip_source_requests_total': ('counter', "IP-echo source requests by outcome."),
+    'mam_ip_source_latency_seconds': ('gauge', "Median latency of the IP-echo source over its recent requests."),
+    'mam_ip_source_open': ('gauge', "1 while the IP-echo source's circuit breaker skips it."),
+    'mam_container_cache_lookups_total': ('counter', "Docker container resolution cache lookups by result (hit, negative_hit, miss)."),
+    'mam_container_cache_invalidations_total': ('counter', "Docker container cache entries dropped by lifecycle events and failed execs."),
+}
+
+FAILURE_CAUSES = {'failed': 'rejected', 'error': 'error', 'timeout': 'timeout'}
+
+SAMPLE_PATTERN = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(?:\{(.*)\})? (\S+)$')
+LABEL_PATTERN = re.compile(r'([a-zA-Z_][a-zA-Z0-9_]*)="((?:[^"\\]|\\.)*)"')
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _unescape(value):
+    return value.replace('\\n', '\n').replace('\\"', '"').replace('\\\\', '\\')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels) + '}'
+
+
+def _format_value(value):
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value)
+
+
+class Metrics(object):
+    """
+    Thread-safe registry of the updater's metrics. Labels are passed as dicts.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = {}
+        # (name, labels) -> [count per bucket..., sum, count]
+        self._histograms = {}
+        # Summary of each account's last update, for the GUI
+        self._last = {}
+        # Container cache counters already accounted for, per cache file
+        self._cache_seen = {}
+        # The same for each IP source's SourceStats, which go away with their Updater
+        self._source_seen = weakref.WeakKeyDictionary()
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((labels or {}).items()))
+
+    def inc(self, name, labels=None, value=1):
+        key = self._key(name, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def set(self, name, labels=None, value=0):
+        with self._lock:
+            self._values[self._key(name, labels)] = value
+
+    def observe(self, name, labels, seconds):
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.setdefault(key, [0] * (len(DURATION_BUCKETS) + 2))
+            for i, bound in enumerate(DURATION_BUCKETS):
+                if seconds <= bound:
+                    histogram[i] += 1
+            histogram[-2] += seconds
+            histogram[-1] += 1
+
+    def value(self, name, labels=None):
+        with self._lock:
+            return self._values.get(self._key(name, labels), 0)
+
+    def record(self, updater, result, elapsed):
+        """
+        Account for one finished Updater.run().
+        """
+        account = {'account': updater.account.name}
+        now = time.time()
+        self.inc('mam_update_attempts_total', account)
+        self.inc('mam_update_results_total', dict(account, status=result.status))
+        if result.status in FAILURE_CAUSES:
+            # Rejections come from the API reply; errors before the first phase have none
+            phase = result.phase or ('api' if result.status == 'failed' else 'none')
+            self.inc('mam_update_failures_total', dict(account, cause=FAILURE_CAUSES[result.status], phase=phase))
+        if result.status == 'updated':
+            self.inc('mam_ip_changes_total', account)
+        self.observe('mam_update_duration_seconds', account, elapsed)
+        for phase, seconds in updater.timings.items():
+            self.observe('mam_phase_duration_seconds', dict(account, phase=phase), seconds)
+        self.set('mam_last_update_timestamp_seconds', account, now)
+        if result.ok:
+            self.set('mam_last_success_timestamp_seconds', account, now)
+        self.set('mam_rate_limited_until_timestamp_seconds', account, result.retry_at or 0)
+        for url in updater.resolver.sources:
+            self.record_source(updater.resolver.source_stats(url))
+        if updater.containers is not None:
+            self.record_container_cache(updater.containers)
+        with self._lock:
+            self._last[updater.account.name] = {'status': result.status, 'elapsed': elapsed, 'timings': dict(updater.timings)}
+
+    def record_source(self, stats):
+        # SourceStats counts since its Updater was created and may be shared by a fleet's
+        # accounts, so only what it counted since last time is added
+        source = stats.snapshot()
+        url = {'url': source['url']}
+        counts = {outcome: source[outcome] for outcome in ('successes', 'failures', 'cancelled')}
+        with self._lock:
+            seen, self._source_seen[stats] = self._source_seen.get(stats, {}), counts
+        for outcome, count in counts.items():
+            self.inc('mam_ip_source_requests_total', dict(url, outcome=outcome), count - seen.get(outcome, 0))
+        if source['median_latency'] is not None:
+            self.set('mam_ip_source_latency_seconds', url, source['median_latency'])
+        self.set('mam_ip_source_open', url, 1 if source['open'] else 0)
+
+    def record_container_cache(self, cache):
+        # Several accounts can share a cache, so only what it counted since last time is added
+        counts = cache.snapshot()
+        with self._lock:
+            seen, self._cache_seen[cache.path] = self._cache_seen.get(cache.path, {}), counts
+        for counter, result in (('hits', 'hit'), ('negative_hits', 'negative_hit'), ('misses', 'miss')):
+            self.inc('mam_container_cache_lookups_total', {'result': result}, counts[counter] - seen.get(counter, 0))
+        self.inc('mam_container_cache_invalidations_total', None, counts['invalidations'] - seen.get('invalidations', 0))
+
+    def summary(self, account_name):
+        """
+        Counters and last timings of one account, as plain values for display.
+        """
+        account = {'account': account_name}
+        results = {}
+        container_cache = {}
+        with self._lock:
+            for (name, labels), value in self._values.items():
+                labels = dict(labels)
+                if name == 'mam_update_results_total' and labels.get('account') == account_name:
+                    results[labels['status']] = value
+                elif name == 'mam_container_cache_lookups_total':
+                    container_cache[labels['result']] = value
+            last = self._last.get(account_name)
+        return {
+            'attempts': self.value('mam_update_attempts_total', account),
+            'results': results,
+            'ip_changes': self.value('mam_ip_changes_total', account),
+            'container_cache': container_cache,
+            'last': last,
+        }
+
+    def render(self):
+        """
+        Return all metrics in the Prometheus text exposition format.
+        """
+        with self._lock:
+            values = sorted(self._values.items())
+            histograms = sorted((key, list(data)) for key, data in self._histograms.items())
+        samples = {}
+        for (name, labels), value in values:
+            samples.setdefault(name, []).append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        for (name, labels), data in histograms:
+            lines = samples.setdefault(name, [])
+            for bound, count in zip(DURATION_BUCKETS, data):
+                lines.append(f"{name}_bucket{_format_labels(labels + (('le', str(bound)),))} {count}")
+            lines.append(f"{name}_bucket{_format_labels(labels + (('le', '+Inf'),))} {data[-1]}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {round(data[-2], 6)}")
+            lines.append(f"{name}_count{_format_labels(labels)} {data[-1]}")
+        out = []
+        for name in sorted(samples):
+            kind, help_text = METRICS.get(name, ('untyped', ''))
+            out.append(f"# HELP {name} {help_text}")
+            out.append(f"# TYPE {name} {kind}")
+            out.extend(samples[name])
+        return '\n'.join(out) + '\n'
+
+    def write_textfile(self, path):
+        atomic_write(path, self.render())
+
+    def load_textfile(self, path):
+        """
+        Continue from the values in a textfile written earlier, so counters keep
+        growing across short-lived runs (cron invocations of mam_cli.py).
+        """
+        histograms = {}
+        for line in (read_text(path) or '').splitlines():
+            match = SAMPLE_PATTERN.match(line)
+            if not match:
+                continue
+            name, label_text, value = match.groups()
+            labels = {label: _unescape(text) for label, text in LABEL_PATTERN.findall(label_text or '')}
+            try:
+                value = float(value)
+            except ValueError:
+                continue
+            base = re.sub(r'_(bucket|sum|count)$', '', name)
+            if METRICS.get(base, ('',))[0] == 'histogram' and base != name:
+                bound = labels.pop('le', None)
+                histogram = histograms.setdefault(self._key(base, labels), [0] * (len(DURATION_BUCKETS) + 2))
+                if name.endswith('_sum'):
+                    histogram[-2] = value
+                elif name.endswith('_count'):
+                    histogram[-1] = int(value)
+                elif bound != '+Inf' and float(bound) in DURATION_BUCKETS:
+                    histogram[DURATION_BUCKETS.index(float(bound))] = int(value)
+            elif name in METRICS:
+                self.set(name, labels, value)
+        with self._lock:
+            self._histograms.update(histograms)
+
+
+class MetricsServer(object):
+    """
+    Serves the metrics on http://host:port/metrics from a background thread.
+    """
+    def __init__(self, metrics, host='127.0.0.1', port=9860):
+        # Only long-running modes serve metrics, so the CLI never imports http.server
+        import http.server
+
+        registry = metrics
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/metrics', '/'):
+                    self.send_error(404)
+                    return
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *_args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, name='mam-metrics', daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,205 @@
+"""
+Description:
+Local IP change detection for the MAM IP Updater (Linux only).
+When the public address sits on a local interface (PPPoE, a WireGuard tunnel inside a
+container's namespace), it can be read from the routing table instead of asking an
+IP-echo website. A NetlinkWatcher subscribes to rtnetlink address and route
+notifications and reports when the address outgoing traffic would use changes, so the
+daemons only run the update pipeline when there is something to register.
+"""
+
+import ipaddress
+import os
+import select
+import socket
+import struct
+import threading
+
+NETLINK_ROUTE = 0
+RTMGRP_IPV4_IFADDR = 0x10
+RTMGRP_IPV4_ROUTE = 0x40
+RTMGRP_IPV6_IFADDR = 0x100
+RTMGRP_IPV6_ROUTE = 0x400
+RTM_NEWADDR = 20
+RTM_DELADDR = 21
+RTM_NEWROUTE = 24
+RTM_DELROUTE = 25
+
+NLMSGHDR = struct.Struct('=IHHII')
+RTMSG = struct.Struct('=BBBBBBBBI')
+
+# Only used to look up the outgoing route; connect() on a UDP socket sends nothing
+PROBE_ADDRESSES = ((socket.AF_INET, '1.1.1.1'), (socket.AF_INET6, '2606:4700:4700::1111'))
+
+# Interface changes arrive as bursts of messages; wait for them to settle
+SETTLE_DELAY = 0.5
+# How often the watcher checks that a container's namespace still exists
+NETNS_CHECK_INTERVAL = 30
+
+
+class NetlinkError(Exception):
+    """
+    Raised when the rtnetlink socket can't be opened or its namespace can't be entered.
+    """
+
+
+def outbound_address():
+    """
+    Return the source address of the default route (IPv4 preferred) in the calling
+    thread's network namespace, or None if there is no route to the internet.
+    """
+    for family, destination in PROBE_ADDRESSES:
+        probe = socket.socket(family, socket.SOCK_DGRAM)
+        try:
+            probe.connect((destination, 53))
+            return probe.getsockname()[0]
+        except OSError:
+            continue
+        finally:
+            probe.close()
+    return None
+
+
+def is_public(address):
+    try:
+        return ipaddress.ip_address(address).is_global
+    except ValueError:
+        return False
+
+
+def public_address():
+    """
+    Return the outbound address if it is globally routable, i.e. the host is not behind NAT.
+    """
+    address = outbound_address()
+    return address if address is not None and is_public(address) else None
+
+
+def parse_messages(data):
+    """
+    Return (address changed, default route changed) for one netlink datagram.
+    """
+    address_changed = route_changed = False
+    offset = 0
+    while offset + NLMSGHDR.size <= len(data):
+        length, msg_type = NLMSGHDR.unpack_from(data, offset)[:2]
+        if length < NLMSGHDR.size:
+            break
+        if msg_type in (RTM_NEWADDR, RTM_DELADDR):
+            address_changed = True
+        elif msg_type in (RTM_NEWROUTE, RTM_DELROUTE) and offset + NLMSGHDR.size + RTMSG.size <= len(data):
+            # Only default routes (dst_len 0) decide where outgoing traffic leaves
+            if RTMSG.unpack_from(data, offset + NLMSGHDR.size)[1] == 0:
+                route_changed = True
+        offset += (length + 3) & ~3
+    return address_changed, route_changed
+
+
+def open_socket():
+    sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+    try:
+        sock.bind((0, RTMGRP_IPV4_IFADDR | RTMGRP_IPV4_ROUTE | RTMGRP_IPV6_IFADDR | RTMGRP_IPV6_ROUTE))
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+class NetlinkWatcher(object):
+    """
+    Background thread that calls callback(address, public) when the outbound address
+    changes. Behind NAT (the address is not public) a change of the default route is
+    reported as well, because the public address may have moved without the local one.
+    netns is the path of a network namespace to watch, or a callable returning it (called
+    again when the namespace goes away, e.g. after a container restart); the thread
+    joins it with setns, which needs root or CAP_SYS_ADMIN. on_error(message) is called
+    when the watcher can't run.
+    """
+    def __init__(self, callback, netns=None, on_error=None, retry_delay=5):
+        self.callback = callback
+        self.netns = netns
+        self.on_error = on_error
+        self.retry_delay = retry_delay
+        self.address = None
+        self.baseline = False
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='mam-netlink', daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+
+    def _enter_netns(self):
+        # Returns the path of the namespace the thread is now in, None for the host's
+        if self.netns is None:
+            return None
+        from mam_netns import CLONE_NEWNET, _setns
+        path = self.netns() if callable(self.netns) else self.netns
+        try:
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                _setns(fd, CLONE_NEWNET)
+            finally:
+                os.close(fd)
+        except OSError as e:
+            raise NetlinkError(f"Cannot enter network namespace '{path}': {e}")
+        return path
+
+    def _run(self):
+        while not self.stop_event.is_set():
+            try:
+                path = self._enter_netns()
+                sock = open_socket()
+            except Exception as e:
+                if self.on_error is not None:
+                    self.on_error(f"Error watching network interfaces: {e}")
+                self.stop_event.wait(self.retry_delay)
+                continue
+            try:
+                self._watch(sock, path)
+            finally:
+                sock.close()
+
+    def _watch(self, sock, netns_path):
+        if not self.baseline:
+            # The daemons run an update at startup anyway
+            self.address = outbound_address()
+            self.baseline = True
+        else:
+            # Re-entered a new namespace (container restart) or recovered from an error
+            self._check(force=True)
+        while not self.stop_event.is_set():
+            readable, _, _ = select.select([sock], [], [], NETNS_CHECK_INTERVAL)
+            if not readable:
+                if netns_path is not None and not os.path.exists(netns_path):
+                    return
+                continue
+            address_changed, route_changed = self._drain(sock)
+            # Let the burst settle before looking at the result
+            while select.select([sock], [], [], SETTLE_DELAY)[0]:
+                more = self._drain(sock)
+                address_changed, route_changed = address_changed or more[0], route_changed or more[1]
+            if address_changed or route_changed:
+                self._check(force=route_changed)
+
+    def _drain(self, sock):
+        try:
+            return parse_messages(sock.recv(65536))
+        except OSError:
+            # ENOBUFS: notifications were dropped, so assume anything changed
+            return True, True
+
+    def _check(self, force=False):
+        if self.stop_event.is_set():
+            return
+        address = outbound_address()
+        if address is None:
+            self.address = None
+            return
+        public = is_public(address)
+        if address != self.address or (force and not public):
+            self.address = address
+            self.callback(address, public)
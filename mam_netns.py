@@ -0,0 +1,158 @@
+"""
+Description:
+Network namespace support for the MAM IP Updater (Linux only).
+A NetnsWorker owns one thread that has joined a container's network namespace with setns,
+so the IP lookup and the dynamicSeedbox.php call leave through the container's VPN
+without a docker exec per call. Host names are still resolved in the host namespace,
+because the host's resolv.conf usually points at a resolver the container can't reach.
+"""
+
+import ctypes
+import os
+import queue
+import socket
+import threading
+from concurrent.futures import BrokenExecutor, ThreadPoolExecutor
+
+from mam_containers import container_entry, describe
+from mam_docker import DockerError
+from mam_http import HTTPClient
+
+CLONE_NEWNET = 0x40000000
+
+
+class NetnsError(Exception):
+    """
+    Raised when a network namespace can't be found or entered.
+    """
+
+
+def _setns(fd, nstype):
+    if hasattr(os, 'setns'):
+        os.setns(fd, nstype)
+        return
+    # The process already has libc loaded; find_library() would spawn ldconfig to locate it
+    libc = ctypes.CDLL(None, use_errno=True)
+    if libc.setns(fd, nstype) != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+
+
+def container_netns_path(docker, container_name, timeout=None, cache=None):
+    """
+    Return /proc/<pid>/ns/net for the container's init process. With a ContainerCache
+    the Docker daemon is only asked when the cache has no valid entry.
+    """
+    try:
+        if cache is not None:
+            entry = cache.resolve(docker, container_name, timeout)
+        else:
+            entry = container_entry(docker.inspect(container_name, timeout=timeout))
+    except DockerError as e:
+        raise NetnsError(f"Error: Could not inspect Docker container '{container_name}': {e}")
+    if not entry['running']:
+        raise NetnsError(f"Error: {describe(container_name, entry)}.")
+    return entry['netns']
+
+
+class HostResolver(object):
+    """
+    Resolves host names on a thread that stays in the namespace it was started from.
+    Must be created from a thread in the host network namespace.
+    """
+    def __init__(self):
+        self._requests = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='mam-host-resolver', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            host, port, reply = self._requests.get()
+            try:
+                infos = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+                reply.put(([info[4][0] for info in infos], None))
+            except OSError as e:
+                reply.put((None, e))
+
+    def resolve(self, host, port):
+        reply = queue.Queue(maxsize=1)
+        self._requests.put((host, port, reply))
+        addresses, error = reply.get()
+        if error is not None:
+            raise error
+        return addresses
+
+
+_host_resolver = None
+_host_resolver_lock = threading.Lock()
+
+
+def get_host_resolver():
+    global _host_resolver
+    with _host_resolver_lock:
+        if _host_resolver is None:
+            _host_resolver = HostResolver()
+        return _host_resolver
+
+
+class NetnsWorker(object):
+    """
+    Single worker thread inside a network namespace, with its own HTTP connection pool.
+    Connections opened by self.http belong to the namespace, so only use it through call().
+    """
+    def __init__(self, netns_path):
+        self.netns_path = netns_path
+        try:
+            self.inode = os.stat(netns_path).st_ino
+            self._fd = os.open(netns_path, os.O_RDONLY)
+        except OSError as e:
+            raise NetnsError(f"Error: Cannot open network namespace '{netns_path}': {e}")
+        resolver = get_host_resolver()
+        self.http = HTTPClient(resolver=resolver.resolve)
+        # Whichever of _enter and close takes the namespace fd closes it
+        self._fd_lock = threading.Lock()
+        # The executor thread is started by the first submit from a host-namespace
+        # thread and then moves itself into the target namespace.
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='mam-netns', initializer=self._enter)
+
+    def _take_fd(self):
+        with self._fd_lock:
+            fd, self._fd = self._fd, None
+        return fd
+
+    def _enter(self):
+        fd = self._take_fd()
+        if fd is None:
+            raise NetnsError("Error: The network namespace worker was closed.")
+        try:
+            _setns(fd, CLONE_NEWNET)
+        finally:
+            os.close(fd)
+
+    def matches(self, netns_path):
+        try:
+            return os.stat(netns_path).st_ino == self.inode
+        except OSError:
+            return False
+
+    def call(self, fn, *args, timeout=None, **kwargs):
+        """
+        Run fn on the namespace thread. Raises concurrent.futures.TimeoutError if it
+        doesn't finish in time; fn should also honour the timeout itself.
+        """
+        try:
+            return self._executor.submit(fn, *args, **kwargs).result(timeout)
+        except BrokenExecutor:
+            raise NetnsError(f"Error: Cannot enter network namespace '{self.netns_path}' (setns needs root or CAP_SYS_ADMIN).")
+
+    def close(self):
+        fd = self._take_fd()
+        if fd is not None:
+            # The thread never started, so there are no connections to close in the namespace
+            os.close(fd)
+        else:
+            try:
+                self._executor.submit(self.http.close)
+            except (BrokenExecutor, RuntimeError):
+                pass
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,340 @@
+#!/usr/bin/env python3
+
+"""
+Description:
+Profiling for the MAM IP Updater, for when a run is slow or memory keeps growing.
+A Profiler wraps one or more update cycles (Updater.run: resolving the IP, the state
+files and update_seedbox_ip) with cProfile, including the threads that race the IP
+sources, and tracemalloc. It records the processes spawned and the time spent in each
+update phase, and saves a report to STATEDIR/MAM.profile/ as JSON with stable keys,
+next to the raw cProfile data for pstats or snakeviz. Run mam_cli.py --profile or tick
+Profile in the GUI to make one; compare two reports with
+
+    python3 mam_profile.py OLD.json NEW.json
+"""
+
+import json
+import os
+import sys
+import threading
+import time
+
+from mam_state import atomic_write
+
+PROFILE_DIR = 'MAM.profile'
+REPORT_VERSION = 1
+# Functions of other modules kept in the report, by cumulative time; the updater's own are all kept
+DEFAULT_TOP = 40
+DEFAULT_ALLOCATION_SITES = 25
+# Audit events that start a new process; subprocess's own posix_spawn is not counted twice.
+# mam.docker.exec is raised by DockerClient.exec for each exec session of the Engine API
+SPAWN_EVENTS = ('subprocess.Popen', 'os.system', 'os.exec', 'os.fork', 'os.forkpty', 'os.spawn', 'mam.docker.exec')
+# Until Python 3.12 a cProfile.Profile only sees the thread that enabled it; from 3.12 it
+# uses sys.monitoring, sees every thread and can't be enabled next to another one
+PER_THREAD_PROFILES = sys.version_info < (3, 12)
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Audit hooks can't be removed, so one is installed on first use and counts for the active Profiler
+_active = None
+_active_lock = threading.Lock()
+_audit_installed = False
+
+
+class ProfileError(Exception):
+    """
+    Raised when a profile can't be taken or saved.
+    """
+
+
+def _audit(event, args):
+    profiler = _active
+    if profiler is None or event not in SPAWN_EVENTS:
+        return
+    # The argument list, or a shell command line
+    command = args[0] if event == 'os.system' else args[1] if event in ('subprocess.Popen', 'os.exec', 'mam.docker.exec') else [event]
+    if isinstance(command, (list, tuple)):
+        command = os.fsdecode(command[0]) if command else event
+    else:
+        words = os.fsdecode(command).split()
+        command = words[0] if words else event
+    command = os.path.basename(command)
+    profiler.count_spawn(f"docker exec {command}" if event == 'mam.docker.exec' else command)
+
+
+def _short_path(filename):
+    """
+    Path of a source file as shown in reports: the updater's modules by name, the
+    standard library and site-packages relative to their root, so reports taken on
+    different machines line up.
+    """
+    if filename.startswith(HERE + os.sep):
+        return os.path.relpath(filename, HERE)
+    for root in sorted(set(sys.path), key=len, reverse=True):
+        if root and os.path.isabs(root) and filename.startswith(root + os.sep):
+            return os.path.relpath(filename, root)
+    return filename
+
+
+def _function_label(key):
+    filename, lineno, name = key
+    if filename == '~':
+        # Built-in functions have no source location
+        return name
+    return f"{_short_path(filename)}:{lineno}({name})"
+
+
+def _round(seconds):
+    return round(seconds, 6)
+
+
+class Profiler(object):
+    """
+    Profiles the update cycles run between start() and stop(); record() each cycle's
+    Updater after it ran. Only one Profiler can run at a time, as cProfile and
+    tracemalloc are process-wide.
+    """
+    def __init__(self, top=DEFAULT_TOP, allocation_sites=DEFAULT_ALLOCATION_SITES):
+        self.top = top
+        self.allocation_sites = allocation_sites
+        self.cycles = []
+        self.spawns = {}
+        self.started = None
+        self.stats = None
+        self.allocations = None
+        self._profiles = []
+        self._lock = threading.Lock()
+        self._started_tracing = False
+        self._stopped = False
+        self._baseline = None
+
+    def start(self):
+        global _active, _audit_installed
+        import cProfile
+        import tracemalloc
+        with _active_lock:
+            if _active is not None:
+                raise ProfileError("Another profile is already being taken")
+            _active = self
+            if not _audit_installed:
+                sys.addaudithook(_audit)
+                _audit_installed = True
+        self.started = time.time()
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        tracemalloc.reset_peak()
+        if PER_THREAD_PROFILES:
+            # Threads started from now on (the IP source race, the netns worker) get their own profile
+            threading.setprofile(self._profile_thread)
+        profile = cProfile.Profile()
+        self._profiles.append(profile)
+        profile.enable()
+        return self
+
+    def _profile_thread(self, *_args):
+        import cProfile
+        if self._stopped:
+            sys.setprofile(None)
+            return
+
+        # A profile can only be disabled from its own thread, so the timer does it on the
+        # first call after stop(), in pool threads that outlive the profile
+        def timer():
+            if self._stopped:
+                sys.setprofile(None)
+            return time.perf_counter()
+
+        profile = cProfile.Profile(timer)
+        with self._lock:
+            self._profiles.append(profile)
+        profile.enable()
+
+    def count_spawn(self, command):
+        with self._lock:
+            self.spawns[command] = self.spawns.get(command, 0) + 1
+
+    def record(self, updater, result, elapsed):
+        """
+        Account for one finished Updater.run().
+        """
+        import tracemalloc
+        self.cycles.append({
+            'status': result.status,
+            'elapsed': _round(elapsed),
+            'phases': {phase: _round(seconds) for phase, seconds in updater.timings.items()},
+        })
+        if len(self.cycles) == 1:
+            # Growth is measured from the end of the first cycle, after caches and pools filled
+            self._baseline = self._snapshot(tracemalloc)
+
+    def _snapshot(self, tracemalloc):
+        return tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+            tracemalloc.Filter(False, '<unknown>'),
+            tracemalloc.Filter(False, __file__),
+            # The profiler's own bookkeeping
+            tracemalloc.Filter(False, '*/cProfile.py'),
+            tracemalloc.Filter(False, '*/pstats.py'),
+        ))
+
+    def stop(self):
+        global _active
+        import pstats
+        import tracemalloc
+        threading.setprofile(None)
+        self._profiles[0].disable()
+        stats = pstats.Stats(self._profiles[0])
+        with self._lock:
+            # Switches off the profiles of other threads, which are read while those threads
+            # idle in their pools
+            self._stopped = True
+            for profile in self._profiles[1:]:
+                stats.add(profile)
+        self.stats = stats
+        snapshot = self._snapshot(tracemalloc)
+        current, peak = tracemalloc.get_traced_memory()
+        self.allocations = {
+            'current_bytes': current,
+            'peak_bytes': peak,
+            'top': {
+                f"{_short_path(stat.traceback[0].filename)}:{stat.traceback[0].lineno}": {'size': stat.size, 'count': stat.count}
+                for stat in snapshot.statistics('lineno')[:self.allocation_sites]
+            },
+        }
+        if self._baseline is not None and len(self.cycles) > 1:
+            self.allocations['growth'] = {
+                f"{_short_path(stat.traceback[0].filename)}:{stat.traceback[0].lineno}": {'size': stat.size_diff, 'count': stat.count_diff}
+                for stat in snapshot.compare_to(self._baseline, 'lineno')[:self.allocation_sites]
+                if stat.size_diff
+            }
+        self._baseline = None
+        if self._started_tracing:
+            tracemalloc.stop()
+        with _active_lock:
+            _active = None
+
+    def functions(self):
+        """
+        {label: {calls, tottime, cumtime}} for the updater's own functions and the
+        slowest others.
+        """
+        entries = sorted(self.stats.stats.items(), key=lambda item: item[1][3], reverse=True)
+        functions = {}
+        others = 0
+        for key, (_primitive, calls, tottime, cumtime, _callers) in entries:
+            own = key[0].startswith(HERE + os.sep)
+            if not own:
+                if others >= self.top:
+                    continue
+                others += 1
+            functions[_function_label(key)] = {'calls': calls, 'tottime': _round(tottime), 'cumtime': _round(cumtime)}
+        return functions
+
+    def phases(self):
+        phases = {}
+        for cycle in self.cycles:
+            for phase, seconds in cycle['phases'].items():
+                phases.setdefault(phase, []).append(seconds)
+        return {phase: {'total': _round(sum(values)), 'mean': _round(sum(values) / len(values)), 'max': max(values)}
+                for phase, values in phases.items()}
+
+    def report(self, account=None):
+        import platform
+        return {
+            'version': REPORT_VERSION,
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z', time.localtime(self.started)),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'account': account.name if account is not None else None,
+            'ip_method': account.ip_method if account is not None else None,
+            'cycles': self.cycles,
+            'phases': self.phases(),
+            'spawns': {'total': sum(self.spawns.values()), 'commands': dict(self.spawns)},
+            'allocations': self.allocations,
+            'functions': self.functions(),
+        }
+
+    def save(self, statedir, account=None):
+        """
+        Write the report and the raw cProfile data to STATEDIR/MAM.profile/ and
+        return the path of the report.
+        """
+        directory = os.path.join(statedir, PROFILE_DIR)
+        stamp = time.strftime('%Y%m%d-%H%M%S', time.localtime(self.started))
+        try:
+            os.makedirs(directory, exist_ok=True)
+            # Profiles taken within the same second don't overwrite each other
+            name, number = stamp, 1
+            while os.path.exists(os.path.join(directory, f"{name}.json")):
+                number += 1
+                name = f"{stamp}-{number}"
+            path = os.path.join(directory, f"{name}.json")
+            atomic_write(path, json.dumps(self.report(account), indent=2, sort_keys=True) + '\n')
+            self.stats.dump_stats(os.path.join(directory, f"{name}.prof"))
+        except OSError as e:
+            raise ProfileError(f"Cannot save the profile to '{directory}': {e}")
+        return path
+
+
+def profile_updates(updater, cycles=1, force=False):
+    """
+    Run updater cycles times under a Profiler and return (last result, profiler).
+    """
+    profiler = Profiler().start()
+    result = None
+    try:
+        for _ in range(max(1, cycles)):
+            started = time.monotonic()
+            result = updater.run(force=force)
+            profiler.record(updater, result, time.monotonic() - started)
+    finally:
+        profiler.stop()
+    return result, profiler
+
+
+def format_comparison(old, new, limit=15):
+    lines = [f"Compared with the profile of {old.get('timestamp')}:"]
+    for phase in sorted(set(old['phases']) | set(new['phases'])):
+        before = old['phases'].get(phase, {}).get('mean', 0)
+        after = new['phases'].get(phase, {}).get('mean', 0)
+        lines.append(f"  phase {phase}: {before * 1000:.1f} -> {after * 1000:.1f}ms")
+    lines.append(f"  spawns: {old['spawns']['total']} -> {new['spawns']['total']}")
+    lines.append(f"  peak traced memory: {old['allocations']['peak_bytes'] // 1024} -> {new['allocations']['peak_bytes'] // 1024}KB")
+    changes = []
+    for label in set(old['functions']) | set(new['functions']):
+        before = old['functions'].get(label, {}).get('cumtime', 0)
+        after = new['functions'].get(label, {}).get('cumtime', 0)
+        if after != before:
+            changes.append((abs(after - before), label, before, after))
+    changes.sort(reverse=True)
+    if changes:
+        lines.append("  largest changes in cumulative time:")
+    for _delta, label, before, after in changes[:limit]:
+        lines.append(f"    {label}: {before * 1000:.1f} -> {after * 1000:.1f}ms")
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="Compare two MAM IP Updater profile reports.")
+    parser.add_argument('old', help="Earlier report (STATEDIR/MAM.profile/*.json).")
+    parser.add_argument('new', help="Later report.")
+    parser.add_argument('--limit', type=int, default=15, help="Functions to list. Default: 15")
+    args = parser.parse_args(argv)
+    try:
+        with open(args.old) as f:
+            old = json.load(f)
+        with open(args.new) as f:
+            new = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Error reading the reports: {e}", file=sys.stderr)
+        return 1
+    print(format_comparison(old, new, args.limit))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,163 @@
+"""
+Description:
+Config file watching for the long-running MAM IP Updater modes (GUI, daemon and fleet).
+A ConfigWatcher notices when ~/.mam_updater_config.ini changes, through inotify on Linux
+and by polling its mtime elsewhere, and hands the parsed and validated settings to a
+callback. A file that fails to parse or validate is reported and otherwise ignored, so
+the running settings stay in place until it is fixed.
+"""
+
+import configparser
+import os
+import select
+import struct
+import threading
+
+POLL_INTERVAL = 2.0
+# Editors save in several steps (truncate, write, rename); wait for them to finish
+SETTLE_DELAY = 0.2
+
+IN_MODIFY = 0x002
+IN_ATTRIB = 0x004
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_FROM = 0x040
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+# struct inotify_event: wd, mask, cookie, len, then the name
+INOTIFY_EVENT = struct.Struct('=iIII')
+
+
+class ConfigError(Exception):
+    """
+    Raised when a changed config file can't be used.
+    """
+
+
+def _inotify_watch(directory):
+    """
+    Return an inotify file descriptor watching directory, or None where inotify is unavailable.
+    The directory is watched rather than the file, so saves that replace the file are seen.
+    """
+    if not hasattr(os, 'O_CLOEXEC') or not os.path.isdir('/proc/self'):
+        return None
+    import ctypes
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    if libc.inotify_add_watch(fd, os.fsencode(directory), WATCH_MASK) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+
+def _read_events(fd):
+    """
+    Return the names in the pending inotify events.
+    """
+    names = []
+    try:
+        data = os.read(fd, 65536)
+    except BlockingIOError:
+        return names
+    offset = 0
+    while offset + INOTIFY_EVENT.size <= len(data):
+        length = INOTIFY_EVENT.unpack_from(data, offset)[3]
+        start = offset + INOTIFY_EVENT.size
+        names.append(os.fsdecode(data[start:start + length].rstrip(b'\0')))
+        offset = start + length
+    return names
+
+
+def parse_config(text):
+    settings = configparser.ConfigParser()
+    try:
+        settings.read_string(text)
+    except configparser.Error as e:
+        raise ConfigError(f"Cannot parse the config file: {e}")
+    return settings
+
+
+class ConfigWatcher(object):
+    """
+    Background thread that calls callback(settings) with a fresh ConfigParser whenever the
+    contents of the config file change. validate(settings), if given, may raise an
+    exception to reject the new settings; on_error(message) is told why.
+    """
+    def __init__(self, path, callback, validate=None, on_error=None, poll_interval=POLL_INTERVAL):
+        self.path = os.path.abspath(path)
+        self.callback = callback
+        self.validate = validate
+        self.on_error = on_error
+        self.poll_interval = poll_interval
+        self.signature = self._signature()
+        self.text = self._read()
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='mam-config-watch', daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+
+    def _signature(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return st.st_ino, st.st_size, st.st_mtime_ns
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def _run(self):
+        fd = _inotify_watch(os.path.dirname(self.path))
+        try:
+            while not self.stop_event.is_set():
+                notified = False
+                if fd is None:
+                    self.stop_event.wait(self.poll_interval)
+                elif select.select([fd], [], [], self.poll_interval)[0]:
+                    if os.path.basename(self.path) not in _read_events(fd):
+                        continue
+                    self.stop_event.wait(SETTLE_DELAY)
+                    _read_events(fd)
+                    notified = True
+                # The stat also covers changes inotify can't see (network filesystems)
+                signature = self._signature()
+                if notified or signature != self.signature:
+                    self.signature = signature
+                    self.check()
+        finally:
+            if fd is not None:
+                os.close(fd)
+
+    def check(self):
+        text = self._read()
+        # Touching the file, or a save without changes, doesn't count
+        if text is None or text == self.text:
+            return False
+        try:
+            settings = parse_config(text)
+            if self.validate is not None:
+                self.validate(settings)
+        except Exception as e:
+            if self.on_error is not None:
+                self.on_error(f"Config file '{self.path}' not reloaded: {e}")
+            return False
+        self.text = text
+        self.callback(settings)
+        return True
@@ -0,0 +1,403 @@
+"""
+Description:
+IP resolution from IP-echo websites for the MAM IP Updater.
+Several sources are queried in parallel and the first valid answer wins (or the first
+answer that enough sources agree on, when a quorum is set). Slower requests are aborted,
+and every source keeps rolling latency and error statistics. A circuit breaker skips
+sources that keep failing until a cooldown has passed.
+
+Responses are parsed as they stream in, up to MAX_RESPONSE_BYTES. Plain-text, JSON and
+HTML answers are understood, IPv4 and IPv6 addresses are validated with ipaddress, and
+a source can carry its own extraction rule after a '#' (the fragment is never sent):
+
+    https://api.ipify.org                    auto-detect the format
+    https://ifconfig.co/ip#plain             the whole body is the address
+    https://ifconfig.co/json#json:ip         the value at this key path (dots for nesting)
+    https://example.net/ip#regex:IP is (\S+)  the first group, or the whole match
+
+Rules can't contain commas, since those separate the sources.
+"""
+
+import codecs
+import json
+import re
+import threading
+import time
+from collections import deque
+
+from mam_http import CancelToken, HTTPClientError
+
+# Candidates only; every match is checked with ipaddress before it is used
+IP_PATTERN = re.compile(
+    r'(?<![\w.])(?:[0-9]{1,3}\.){3}[0-9]{1,3}(?!\w|\.[0-9])'
+    r'|(?<![\w:.])(?:[0-9A-Fa-f]{0,4}:){2,7}(?:(?:[0-9]{1,3}\.){3}[0-9]{1,3}|[0-9A-Fa-f]{1,4})?(?![\w:.])')
+# Markup that never holds the visitor's address
+HTML_NOISE = re.compile(r'<(script|style)\b.*?(?:</\1\s*>|$)|<!--.*?(?:-->|$)|<[^>]*(?:>|$)', re.S | re.I)
+JSON_KEYS = ('ip', 'ip_addr', 'ip_address', 'ipAddress', 'address', 'client_ip', 'clientIp', 'query', 'origin')
+
+MAX_RESPONSE_BYTES = 64 * 1024
+# A plain-text answer longer than this is not just an address
+MAX_PLAIN_BYTES = 256
+RULES = ('auto', 'plain', 'json', 'regex')
+
+LATENCY_WINDOW = 20
+FAILURE_THRESHOLD = 3
+BREAKER_COOLDOWN = 60
+MAX_BREAKER_COOLDOWN = 3600
+
+
+class ResolverError(Exception):
+    """
+    Raised when no source produced a usable IP address.
+    """
+
+
+def _local_networks():
+    import ipaddress
+    return [ipaddress.ip_network(net) for net in ('10.0.0.0/8', '172.16.0.0/12', '192.168.0.0/16', '100.64.0.0/10', 'fc00::/7')]
+
+
+_LOCAL_NETWORKS = None
+
+
+def valid_ip(text):
+    """
+    Return text as a normalized ipaddress object if MAM could plausibly see it as the
+    client address, else None. Loopback, private, link-local, multicast and reserved
+    addresses are never the answer of a working IP-echo source.
+    """
+    import ipaddress
+    global _LOCAL_NETWORKS
+    try:
+        ip = ipaddress.ip_address(text.strip())
+    except ValueError:
+        return None
+    if ip.version == 6 and ip.ipv4_mapped is not None:
+        ip = ip.ipv4_mapped
+    if ip.is_loopback or ip.is_unspecified or ip.is_multicast or ip.is_link_local or ip.is_reserved:
+        return None
+    if _LOCAL_NETWORKS is None:
+        _LOCAL_NETWORKS = _local_networks()
+    if any(ip.version == net.version and ip in net for net in _LOCAL_NETWORKS):
+        return None
+    return ip
+
+
+def parse_source(source):
+    """
+    Split an IP source into (url, rule); rule is None for auto-detection.
+    Raises ValueError for an unknown rule.
+    """
+    url, _, rule = source.partition('#')
+    if not rule or rule == 'auto':
+        return url, None
+    kind, _, argument = rule.partition(':')
+    if kind not in RULES or (kind in ('json', 'regex') and not argument):
+        raise ValueError(f"Invalid extraction rule '{rule}' for {url}, expected plain, json:KEY or regex:PATTERN")
+    if kind == 'regex':
+        try:
+            re.compile(argument)
+        except re.error as e:
+            raise ValueError(f"Invalid extraction rule '{rule}' for {url}: {e}")
+    return url, rule
+
+
+class IPResponseParser(object):
+    """
+    Incremental parser for an IP-echo response. feed(chunk) returns True once the
+    address is known for certain, so the rest of the body needn't be read; close()
+    returns the address as a string, or None.
+    """
+    def __init__(self, rule=None, max_bytes=MAX_RESPONSE_BYTES):
+        kind, _, argument = (rule or 'auto').partition(':')
+        self.kind = kind
+        self.argument = argument
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.text = ''
+        self.format = None
+        self.ip = None
+        self.done = False
+        self._decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+
+    def feed(self, chunk):
+        if self.done:
+            return True
+        chunk = chunk[:max(0, self.max_bytes - self.size)]
+        self.size += len(chunk)
+        self.text += self._decoder.decode(chunk)
+        if self.format is None and self.text.strip():
+            first = self.text.lstrip()[0]
+            self.format = 'json' if first in '{[' else 'html' if first == '<' else 'text'
+        if self.size >= self.max_bytes or (self.kind == 'plain' and self.size > MAX_PLAIN_BYTES):
+            # Whatever the rule, nothing more is read
+            self.done = True
+            self.ip = self._final()
+        elif self.kind == 'regex':
+            match = re.search(self.argument, self.text)
+            # A match touching the end of the buffer may still grow
+            if match and match.end() < len(self.text):
+                self.done = True
+                self.ip = self._from_match(match)
+        elif self.kind == 'auto' and self.format != 'json':
+            ip = self._scan(self.text, final=False)
+            if ip is not None:
+                self.done = True
+                self.ip = ip
+        return self.done
+
+    def close(self):
+        if not self.done:
+            self.text += self._decoder.decode(b'', final=True)
+            self.done = True
+            self.ip = self._final()
+        return self.ip
+
+    def _final(self):
+        if self.kind == 'plain':
+            ip = valid_ip(self.text) if self.size <= MAX_PLAIN_BYTES else None
+            return str(ip) if ip is not None else None
+        if self.kind == 'regex':
+            match = re.search(self.argument, self.text)
+            return self._from_match(match) if match else None
+        if self.kind == 'json':
+            return self._from_json(self.argument.split('.'))
+        ip = valid_ip(self.text)
+        if ip is not None:
+            return str(ip)
+        if self.format == 'json':
+            ip = self._from_json(None)
+            if ip is not None:
+                return ip
+        return self._scan(self.text, final=True)
+
+    def _from_match(self, match):
+        ip = valid_ip(match.group(1) if match.re.groups else match.group(0))
+        return str(ip) if ip is not None else None
+
+    def _from_json(self, path):
+        try:
+            data = json.loads(self.text)
+        except ValueError:
+            # Cut off at the byte cap, or not JSON after all
+            return None if path else self._scan(self.text, final=True)
+        if path:
+            for key in path:
+                if isinstance(data, list) and key.isdigit() and int(key) < len(data):
+                    data = data[int(key)]
+                elif isinstance(data, dict) and key in data:
+                    data = data[key]
+                else:
+                    return None
+            ip = valid_ip(data) if isinstance(data, str) else None
+            return str(ip) if ip is not None else None
+        if isinstance(data, dict):
+            for key in JSON_KEYS:
+                if isinstance(data.get(key), str):
+                    # httpbin's origin may list proxies after the client
+                    ip = self._scan(data[key], final=True)
+                    if ip is not None:
+                        return ip
+        return self._scan(self.text, final=True)
+
+    def _scan(self, text, final):
+        """
+        Return the first public address in text. Addresses that are merely valid
+        (documentation ranges) only count once the whole response is in.
+        """
+        if self.format == 'html':
+            text = HTML_NOISE.sub(' ', text)
+        fallback = None
+        for match in IP_PATTERN.finditer(text):
+            if not final and match.end() >= len(text):
+                break
+            ip = valid_ip(match.group(0))
+            if ip is None:
+                continue
+            if ip.is_global:
+                return str(ip)
+            if fallback is None:
+                fallback = str(ip)
+        return fallback if final else None
+
+
+def extract_ip(response, rule=None):
+    """
+    Return the address in an already-read response, or None.
+    """
+    parser = IPResponseParser(rule)
+    parser.feed(response.encode() if isinstance(response, str) else response)
+    return parser.close()
+
+
+class SourceStats(object):
+    """
+    Rolling statistics and circuit breaker state for one IP-echo source.
+    """
+    def __init__(self, url):
+        self.url = url
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.successes = 0
+        self.failures = 0
+        self.cancelled = 0
+        self.consecutive_failures = 0
+        self.open_until = 0
+        self.cooldown = BREAKER_COOLDOWN
+        self.last_error = None
+        self._lock = threading.Lock()
+
+    def record_success(self, latency):
+        with self._lock:
+            self.latencies.append(latency)
+            self.successes += 1
+            self.consecutive_failures = 0
+            self.open_until = 0
+            self.cooldown = BREAKER_COOLDOWN
+
+    def record_failure(self, error):
+        with self._lock:
+            self.failures += 1
+            self.consecutive_failures += 1
+            self.last_error = str(error)
+            if self.consecutive_failures >= FAILURE_THRESHOLD:
+                # Half-open after the cooldown: one more failure re-opens it for longer
+                if self.open_until:
+                    self.cooldown = min(self.cooldown * 2, MAX_BREAKER_COOLDOWN)
+                self.open_until = time.monotonic() + self.cooldown
+
+    def record_cancelled(self):
+        with self._lock:
+            self.cancelled += 1
+
+    def is_open(self):
+        return time.monotonic() < self.open_until
+
+    def median_latency(self):
+        import statistics
+        with self._lock:
+            return statistics.median(self.latencies) if self.latencies else None
+
+    def snapshot(self):
+        median = self.median_latency()
+        return {
+            'url': self.url,
+            'successes': self.successes,
+            'failures': self.failures,
+            'cancelled': self.cancelled,
+            'median_latency': round(median, 4) if median is not None else None,
+            'open': self.is_open(),
+            'last_error': self.last_error,
+        }
+
+
+class IPResolver(object):
+    """
+    Races the configured IP-echo sources. stats may be shared between resolvers
+    (a dict of url -> SourceStats) so fleet accounts learn from each other.
+    """
+    def __init__(self, http, sources, quorum=1, timeout=None, stats=None):
+        if not sources:
+            raise ValueError("At least one IP source is required")
+        self.http = http
+        self.sources = list(sources)
+        self.quorum = max(1, min(quorum, len(self.sources)))
+        self.timeout = timeout
+        self.stats = stats if stats is not None else {}
+        self._stats_lock = threading.Lock()
+        # Created on first use so the threads start in the caller's network namespace
+        self._executor = None
+
+    def source_stats(self, url):
+        with self._stats_lock:
+            if url not in self.stats:
+                self.stats[url] = SourceStats(url)
+            return self.stats[url]
+
+    def _query(self, source, cancel, timeout=None):
+        started = time.monotonic()
+        stats = self.source_stats(source)
+        if self.timeout is not None:
+            timeout = self.timeout if timeout is None else min(timeout, self.timeout)
+        try:
+            try:
+                url, rule = parse_source(source)
+            except ValueError as e:
+                raise ResolverError(str(e))
+            parser = IPResponseParser(rule)
+            # The body is read until the parser is sure, and never beyond the cap
+            response = self.http.get(url, timeout=timeout, cancel=cancel, max_bytes=MAX_RESPONSE_BYTES, until=parser.feed)
+            if response.status >= 400:
+                raise ResolverError(f"{url} returned HTTP {response.status}")
+            ip = parser.close()
+            if not ip:
+                raise ResolverError(f"No valid IP address found in the response from {url}")
+        except (HTTPClientError, ResolverError) as e:
+            if cancel.cancelled:
+                stats.record_cancelled()
+            else:
+                stats.record_failure(e)
+            raise
+        stats.record_success(time.monotonic() - started)
+        return ip
+
+    def resolve(self, timeout=None, cancel=None):
+        """
+        Return the winning IP address, or raise ResolverError.
+        Cancelling the optional cancel token aborts every outstanding query.
+        """
+        candidates = [url for url in self.sources if not self.source_stats(url).is_open()]
+        if len(candidates) < self.quorum:
+            # Every breaker is open; trying anyway beats not updating at all
+            candidates = list(self.sources)
+        expires = time.monotonic() + timeout if timeout is not None else None
+        race = CancelToken()
+        if cancel is not None:
+            cancel.register(race.cancel)
+        try:
+            if len(candidates) == 1:
+                try:
+                    return self._query(candidates[0], race, timeout)
+                except HTTPClientError as e:
+                    raise ResolverError(str(e)) from e
+            return self._race(candidates, race, expires)
+        finally:
+            race.cancel()
+            if cancel is not None:
+                cancel.unregister(race.cancel)
+
+    def _race(self, candidates, race, expires):
+        # Imported here: a single source never needs the thread pool
+        from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=len(self.sources), thread_name_prefix='mam-resolve')
+        timeout = max(0.0, expires - time.monotonic()) if expires is not None else None
+        pending = {self._executor.submit(self._query, url, race, timeout): url for url in candidates}
+        votes = {}
+        errors = []
+        while pending:
+            remaining = max(0.0, expires - time.monotonic()) if expires is not None else None
+            done, _ = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+            if not done:
+                raise ResolverError(f"Timed out waiting for IP sources after {timeout:.1f}s")
+            for future in done:
+                url = pending.pop(future)
+                try:
+                    ip = future.result()
+                except (HTTPClientError, ResolverError) as e:
+                    errors.append(f"{url}: {e}")
+                    continue
+                votes[ip] = votes.get(ip, 0) + 1
+                if votes[ip] >= self.quorum:
+                    return ip
+            if self.quorum > 1 and max(votes.values(), default=0) + len(pending) < self.quorum:
+                break
+        if votes:
+            raise ResolverError(f"IP sources disagree, no quorum of {self.quorum}: {votes}")
+        raise ResolverError("All IP sources failed: " + '; '.join(errors))
+
+    def snapshot(self):
+        return [self.source_stats(url).snapshot() for url in self.sources]
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
@@ -0,0 +1,271 @@
+"""
+Description:
+State directory handling for the MAM IP Updater.
+MAM.ip, MAM.cookie and MAM.state are replaced atomically (write to a temporary file,
+then rename) and only when their content actually changes. IP changes and MAM API
+replies are appended to the MAM.journal history file, one JSON object per line.
+Updates of one account are serialized across processes with an flock on MAM.lock.
+"""
+
+import json
+import os
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    # No flock (Windows): updates are not serialized across processes
+    fcntl = None
+
+STATE_FILE = 'MAM.state'
+JOURNAL_FILE = 'MAM.journal'
+# The journal is compacted to its newest entries once it grows past this size
+JOURNAL_MAX_BYTES = 256 * 1024
+JOURNAL_KEEP = 1000
+LOCK_POLL_INTERVAL = 0.05
+
+
+class LockTimeout(Exception):
+    """
+    Raised when the account lock could not be taken in time, or the wait was cancelled.
+    """
+
+
+def atomic_write(path, data):
+    """
+    Replace path with data so readers see either the old or the new file, never a mix.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    tmp = os.path.join(directory, f".{os.path.basename(path)}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        with open(tmp, 'w') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+
+
+def read_text(path):
+    try:
+        with open(path) as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def cookie_seed(mam_cookie):
+    # Only a hash of the configured cookie is kept, to notice when the user replaces it
+    import hashlib
+    return hashlib.sha256(mam_cookie.encode()).hexdigest()
+
+
+def initial_cookie_file(mam_cookie):
+    return f"""# Netscape HTTP Cookie File
+# This file was generated by the MAM IP Updater script
+.t.myanonamouse.net\tTRUE\t/\tFALSE\t0\tmam_id\t{mam_cookie}
+"""
+
+
+def cookie_file_values(text, name):
+    """
+    Return the values of cookie name in the text of a Netscape cookie file.
+    """
+    values = []
+    for line in text.splitlines():
+        if line.startswith('#HttpOnly_'):
+            line = line[len('#HttpOnly_'):]
+        elif line.startswith('#'):
+            continue
+        fields = line.rstrip('\n').split('\t')
+        if len(fields) == 7 and fields[5] == name:
+            values.append(fields[6])
+    return values
+
+
+def lock_name(account_name):
+    return 'MAM.lock' if account_name == 'DEFAULT' else f"MAM.{account_name}.lock"
+
+
+class StateLock(object):
+    """
+    Exclusive flock held while one process updates an account. A caller that had to
+    wait leaves a marker file, which asks the holder to publish its result in the lock
+    file on release so the waiters can reuse it instead of repeating the update.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.marker = path + '.waiting'
+        self.waited = False
+        self._fd = None
+
+    def acquire(self, timeout=None, cancel=None):
+        """
+        Take the lock, waiting at most timeout seconds. Returns True if another
+        process held it when we arrived.
+        """
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        if fcntl is None:
+            return False
+        expires = time.monotonic() + timeout if timeout is not None else None
+        self.waited = False
+        while True:
+            try:
+                fcntl.flock(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return self.waited
+            except BlockingIOError:
+                pass
+            if not self.waited:
+                self.waited = True
+                with open(self.marker, 'a'):
+                    pass
+            if (cancel is not None and cancel.cancelled) or (expires is not None and time.monotonic() >= expires):
+                os.close(self._fd)
+                self._fd = None
+                raise LockTimeout(self.path)
+            time.sleep(LOCK_POLL_INTERVAL)
+
+    def read_result(self):
+        """
+        Return the result the previous holder published, or None.
+        """
+        try:
+            data = os.pread(self._fd, 64 * 1024, 0)
+            return json.loads(data) if data else None
+        except (OSError, ValueError):
+            return None
+
+    def publish(self, result):
+        # Only written when somebody is waiting, so uncontended runs don't touch the disk
+        if not os.path.exists(self.marker):
+            return False
+        data = json.dumps(result, sort_keys=True).encode()
+        os.ftruncate(self._fd, 0)
+        os.pwrite(self._fd, data, 0)
+        try:
+            os.unlink(self.marker)
+        except OSError:
+            pass
+        return True
+
+    def release(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+class StateStore(object):
+    """
+    Write-on-change access to one account's state directory.
+    """
+    def __init__(self, statedir, cachefile=None, cookiefile=None):
+        self.statedir = statedir
+        self.cachefile = cachefile or os.path.join(statedir, 'MAM.ip')
+        self.cookiefile = cookiefile or os.path.join(statedir, 'MAM.cookie')
+        self.statefile = os.path.join(statedir, STATE_FILE)
+        self.journalfile = os.path.join(statedir, JOURNAL_FILE)
+        self._state = None
+        self._lock = threading.Lock()
+
+    def ensure_statedir(self):
+        os.makedirs(self.statedir, exist_ok=True)
+
+    def lock(self, account_name):
+        return StateLock(os.path.join(self.statedir, lock_name(account_name)))
+
+    def reload(self):
+        # Forget the cached MAM.state, another process may have changed it
+        with self._lock:
+            self._state = None
+
+    def cached_ip(self):
+        text = read_text(self.cachefile)
+        if text is None:
+            return None
+        return text.strip() or None
+
+    def set_ip(self, ip):
+        """
+        Store ip in MAM.ip if it differs; returns True when the file was rewritten.
+        """
+        if self.cached_ip() == ip:
+            return False
+        atomic_write(self.cachefile, ip)
+        self.append_journal('ip_change', ip=ip)
+        return True
+
+    def load_state(self):
+        with self._lock:
+            if self._state is None:
+                try:
+                    self._state = json.loads(read_text(self.statefile) or '{}')
+                except ValueError:
+                    self._state = {}
+            return dict(self._state)
+
+    def get(self, key, default=None):
+        return self.load_state().get(key, default)
+
+    def update(self, **values):
+        """
+        Merge values into MAM.state, writing it only if something changed.
+        """
+        current = self.load_state()
+        merged = dict(current, **values)
+        if merged == current:
+            return False
+        atomic_write(self.statefile, json.dumps(merged, sort_keys=True, indent=1))
+        with self._lock:
+            self._state = merged
+        return True
+
+    def ensure_cookie(self, mam_cookie):
+        """
+        Create MAM.cookie for the configured session cookie. An existing file is left
+        alone so the mam_id MAM refreshed in it survives, unless the configured cookie
+        itself was changed since the file was written. A file from before MAM.state
+        kept the seed is only kept if it holds the configured cookie.
+        """
+        seed = cookie_seed(mam_cookie)
+        stored_seed = self.get('cookie_seed')
+        if stored_seed is None:
+            text = read_text(self.cookiefile)
+            if text is not None and mam_cookie in cookie_file_values(text, 'mam_id'):
+                self.update(cookie_seed=seed)
+                return False
+        elif stored_seed == seed and os.path.exists(self.cookiefile):
+            return False
+        atomic_write(self.cookiefile, initial_cookie_file(mam_cookie))
+        self.update(cookie_seed=seed)
+        return True
+
+    def append_journal(self, event, **fields):
+        entry = dict(time=round(time.time(), 3), event=event, **fields)
+        with self._lock:
+            with open(self.journalfile, 'a') as f:
+                f.write(json.dumps(entry, sort_keys=True) + '\n')
+                size = f.tell()
+            if size > JOURNAL_MAX_BYTES:
+                self._compact_journal()
+
+    def _compact_journal(self):
+        lines = (read_text(self.journalfile) or '').splitlines(True)
+        atomic_write(self.journalfile, ''.join(lines[-JOURNAL_KEEP:]))
+
+    def record_response(self, ip, response_json):
+        self.append_journal('api_response', ip=ip, success=response_json.get('Success'), msg=response_json.get('msg'))
+
+    def history(self, limit=None):
+        entries = []
+        for line in (read_text(self.journalfile) or '').splitlines():
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                continue
+        return entries[-limit:] if limit else entries
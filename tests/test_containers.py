@@ -0,0 +1,139 @@
+"""
+Description:
+Tests for the container resolution cache (mam_containers.py) with an injected clock:
+the TTLs of running and of missing or stopped containers, entries dropped when the
+container's init process changed or on invalidate_container, the counters, and entries
+shared through MAM.containers.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from mam_containers import CACHE_FILE, ContainerCache, get_cache, invalidate_container
+
+CONTAINER_NAME = 'vpn'
+CONTAINER_ID = 'c0ffee'
+TTL = 300
+NEGATIVE_TTL = 30
+
+
+class FakeDocker(object):
+    """
+    Answers inspect with the container's state; this test process stands in for its init.
+    """
+    def __init__(self):
+        self.state = {'Running': True, 'Status': 'running', 'Pid': os.getpid()}
+        self.exists = True
+        self.inspects = 0
+
+    def inspect(self, name, timeout=None):
+        self.inspects += 1
+        if not self.exists or name != CONTAINER_NAME:
+            return None
+        return {'Id': CONTAINER_ID, 'State': dict(self.state)}
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1700000000.0
+
+    def __call__(self):
+        return self.now
+
+
+class ContainerCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.statedir = tempfile.mkdtemp(prefix='mam-containers-test-')
+        self.addCleanup(shutil.rmtree, self.statedir, ignore_errors=True)
+        self.path = os.path.join(self.statedir, CACHE_FILE)
+        self.clock = Clock()
+        self.cache = ContainerCache(self.path, TTL, NEGATIVE_TTL, clock=self.clock)
+        self.docker = FakeDocker()
+
+    def resolve(self):
+        return self.cache.resolve(self.docker, CONTAINER_NAME)
+
+    def test_running_container(self):
+        entry = self.resolve()
+        self.assertEqual((entry['id'], entry['running'], entry['pid']), (CONTAINER_ID, True, os.getpid()))
+        self.assertEqual(entry['netns'], f"/proc/{os.getpid()}/ns/net")
+        self.clock.now += TTL - 1
+        self.assertEqual(self.resolve()['id'], CONTAINER_ID)
+        self.assertEqual(self.docker.inspects, 1)
+        self.assertEqual(self.cache.snapshot(), {'hits': 1, 'negative_hits': 0, 'misses': 1, 'invalidations': 0})
+
+    def test_ttl_expires(self):
+        self.resolve()
+        self.clock.now += TTL + 1
+        self.assertIsNone(self.cache.lookup(CONTAINER_NAME))
+        self.resolve()
+        self.assertEqual(self.docker.inspects, 2)
+        self.assertEqual(self.cache.snapshot()['misses'], 3)
+
+    def test_clock_going_back_expires(self):
+        self.resolve()
+        self.clock.now -= 1
+        self.assertIsNone(self.cache.lookup(CONTAINER_NAME))
+
+    def test_missing_container(self):
+        self.docker.exists = False
+        self.assertEqual(self.resolve(), {'exists': False, 'running': False, 'checked': self.clock.now})
+        self.clock.now += NEGATIVE_TTL - 1
+        self.assertFalse(self.resolve()['exists'])
+        self.assertEqual(self.docker.inspects, 1)
+        self.clock.now += 2
+        self.docker.exists = True
+        self.assertTrue(self.resolve()['running'])
+        self.assertEqual(self.docker.inspects, 2)
+        self.assertEqual(self.cache.snapshot(), {'hits': 0, 'negative_hits': 1, 'misses': 2, 'invalidations': 0})
+
+    def test_stopped_container(self):
+        self.docker.state = {'Running': False, 'Status': 'exited', 'Pid': 0}
+        entry = self.resolve()
+        self.assertEqual((entry['exists'], entry['running'], entry['pid']), (True, False, None))
+        self.clock.now += NEGATIVE_TTL + 1
+        self.assertIsNone(self.cache.lookup(CONTAINER_NAME))
+
+    def test_changed_start_time(self):
+        self.resolve()
+        # The container restarted, or its init PID now belongs to another process
+        with mock.patch('mam_containers.process_start_time', return_value='1'):
+            self.assertIsNone(self.cache.lookup(CONTAINER_NAME))
+        self.assertIsNone(self.cache.lookup(CONTAINER_NAME))
+        self.assertEqual(self.cache.snapshot()['misses'], 3)
+
+    def test_invalidate(self):
+        self.resolve()
+        self.assertTrue(self.cache.invalidate(CONTAINER_ID))
+        self.assertFalse(self.cache.invalidate(CONTAINER_ID))
+        self.assertIsNone(self.cache.lookup(CONTAINER_NAME))
+        self.assertEqual(self.cache.snapshot()['invalidations'], 1)
+
+    def test_shared_through_file(self):
+        self.resolve()
+        other = ContainerCache(self.path, TTL, NEGATIVE_TTL, clock=self.clock)
+        self.assertEqual(other.lookup(CONTAINER_NAME)['id'], CONTAINER_ID)
+        other.invalidate(CONTAINER_NAME)
+        self.assertIsNone(self.cache.lookup(CONTAINER_NAME))
+
+
+class InvalidateContainerTest(unittest.TestCase):
+    def test_every_cache_of_the_process(self):
+        statedirs = [tempfile.mkdtemp(prefix='mam-containers-test-') for _ in range(2)]
+        for statedir in statedirs:
+            self.addCleanup(shutil.rmtree, statedir, ignore_errors=True)
+        caches = [get_cache(statedir) for statedir in statedirs]
+        self.assertIs(get_cache(statedirs[0]), caches[0])
+        for cache in caches:
+            cache.resolve(FakeDocker(), CONTAINER_NAME)
+        invalidate_container(CONTAINER_NAME)
+        for cache in caches:
+            self.assertIsNone(cache.lookup(CONTAINER_NAME))
+            self.assertEqual(cache.snapshot()['invalidations'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
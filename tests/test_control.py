@@ -0,0 +1,239 @@
+"""
+Description:
+Tests for the control API (mam_control.py): debouncing bursts of pushes, errors reaching
+every caller of a burst, the HTTP replies of ControlServer, who may call its TCP port,
+forced pushes to the daemon waiting out MAM's rate limit, and pushed addresses being
+replaced by the one MAM registered.
+"""
+
+import http.client
+import json
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import unittest
+
+from benchmark import STUB_IP, StubServer, account_settings
+from mam_control import ControlError, ControlServer, Debouncer
+from mam_core import Account, Updater, UpdateResult, registered_ip
+from mam_daemon import Daemon
+from mam_docker import UnixHTTPConnection
+
+WAIT = 5
+JSON = {'Content-Type': 'application/json'}
+PUSHED_IP = '45.67.89.10'
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class DebouncerTest(unittest.TestCase):
+    def test_burst_runs_once(self):
+        calls = []
+        debouncer = Debouncer(lambda key, force, ip: calls.append((key, force, ip)) or len(calls), debounce=0.05)
+        results = []
+        threads = [threading.Thread(target=lambda force=force: results.append(debouncer.submit('a', force=force, ip='203.0.113.7')))
+                   for force in (False, True, False)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(WAIT)
+        self.assertEqual(calls, [('a', True, '203.0.113.7')])
+        self.assertEqual(results, [1, 1, 1])
+
+    def test_error_reaches_every_caller(self):
+        started = threading.Event()
+
+        def run(key, force, ip):
+            started.set()
+            raise RuntimeError("updater crashed")
+
+        debouncer = Debouncer(run, debounce=0.2)
+        errors = []
+
+        def submit():
+            try:
+                debouncer.submit('a')
+            except RuntimeError as e:
+                errors.append(str(e))
+
+        leader = threading.Thread(target=submit)
+        leader.start()
+        time.sleep(0.05)
+        submit()
+        leader.join(WAIT)
+        self.assertTrue(started.is_set())
+        self.assertEqual(errors, ["updater crashed", "updater crashed"])
+
+    def test_submit_all_raises_after_all_finished(self):
+        finished = []
+
+        def run(key, force, ip):
+            if key == 'broken':
+                raise RuntimeError("updater crashed")
+            time.sleep(0.1)
+            finished.append(key)
+            return key
+
+        debouncer = Debouncer(run, debounce=0)
+        self.assertEqual(debouncer.submit_all(['a', 'b']), {'a': 'a', 'b': 'b'})
+        with self.assertRaises(RuntimeError):
+            debouncer.submit_all(['broken', 'c'])
+        self.assertIn('c', finished)
+
+
+class ControlServerTest(unittest.TestCase):
+    def setUp(self):
+        self.calls = []
+        directory = tempfile.mkdtemp(prefix='mam-control-test-')
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        self.socket_path = os.path.join(directory, 'MAM.control')
+        self.server = ControlServer(self.handle, socket_path=self.socket_path).start()
+        self.addCleanup(self.server.stop)
+
+    def handle(self, account, force, ip):
+        self.calls.append((account, force, ip))
+        if account == 'missing':
+            raise ControlError(f"Unknown account '{account}'")
+        if account == 'broken':
+            raise RuntimeError("updater crashed")
+        return [(account or 'DEFAULT', UpdateResult(UpdateResult.UPDATED, "Success: Completed", ip))]
+
+    def post(self, path, body=None, headers=JSON, conn=None):
+        conn = conn or UnixHTTPConnection(self.socket_path, timeout=WAIT)
+        try:
+            conn.request('POST', path, body=body, headers=headers)
+            response = conn.getresponse()
+            return response.status, json.loads(response.read())
+        finally:
+            conn.close()
+
+    def test_update(self):
+        status, body = self.post('/update?ip=203.0.113.7&force=1&account=vpn')
+        self.assertEqual(status, 200)
+        self.assertEqual(body['results'][0]['account'], 'vpn')
+        self.assertEqual(self.calls, [('vpn', True, '203.0.113.7')])
+
+    def test_json_body(self):
+        status, _body = self.post('/update', json.dumps({'account': 'vpn', 'force': True}))
+        self.assertEqual(status, 200)
+        self.assertEqual(self.calls, [('vpn', True, None)])
+
+    def test_json_only(self):
+        # What a web page can send cross-origin without a preflight
+        for headers in ({}, {'Content-Type': 'application/x-www-form-urlencoded'}, {'Content-Type': 'text/plain'}):
+            status, _body = self.post('/update', 'account=vpn&force=1', headers)
+            self.assertEqual(status, 415)
+        self.assertEqual(self.calls, [])
+
+    def test_body_too_large(self):
+        status, _body = self.post('/update', json.dumps({'account': 'x' * 8192}))
+        self.assertEqual(status, 413)
+        self.assertEqual(self.calls, [])
+
+    def test_invalid_ip(self):
+        status, body = self.post('/update?ip=10.0.0.1')
+        self.assertEqual(status, 400)
+        self.assertIn('Invalid IP address', body['error'])
+        self.assertEqual(self.calls, [])
+
+    def test_control_error(self):
+        status, body = self.post('/update?account=missing')
+        self.assertEqual((status, body), (400, {'error': "Unknown account 'missing'"}))
+
+    def test_unexpected_error(self):
+        status, body = self.post('/update?account=broken')
+        self.assertEqual((status, body), (500, {'error': "Update failed: updater crashed"}))
+
+    def test_unknown_endpoint(self):
+        status, _body = self.post('/restart')
+        self.assertEqual(status, 404)
+
+
+class TCPControlTest(unittest.TestCase):
+    def server(self, token=None):
+        self.port = free_port()
+        server = ControlServer(lambda account, force, ip: [], port=self.port, token=token).start()
+        self.addCleanup(server.stop)
+
+    def post(self, headers):
+        conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=WAIT)
+        try:
+            conn.request('POST', '/update', headers=dict(JSON, **headers))
+            return conn.getresponse().status
+        finally:
+            conn.close()
+
+    def test_localhost_only(self):
+        self.server()
+        self.assertEqual(self.post({}), 200)
+        self.assertEqual(self.post({'Host': f'localhost:{self.port}'}), 200)
+        # A page on a name rebound to 127.0.0.1
+        self.assertEqual(self.post({'Host': f'rebound.example.net:{self.port}'}), 403)
+
+    def test_token(self):
+        self.server(token='s3cret')
+        self.assertEqual(self.post({}), 403)
+        self.assertEqual(self.post({'Authorization': 'Bearer wrong'}), 403)
+        self.assertEqual(self.post({'Authorization': 'Bearer s3cret', 'Host': 'seedbox.lan'}), 200)
+
+    def test_other_address_needs_token(self):
+        with self.assertRaises(ControlError):
+            ControlServer(lambda account, force, ip: [], host='0.0.0.0', port=free_port())
+
+
+class PushTestCase(unittest.TestCase):
+    REPLY = 'success'
+
+    def setUp(self):
+        self.server = StubServer(0.1)
+        threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.statedir = tempfile.mkdtemp(prefix='mam-control-test-')
+        self.addCleanup(shutil.rmtree, self.statedir, ignore_errors=True)
+        settings = account_settings('website_plain', self.REPLY, self.server.base_url, self.statedir, WAIT)
+        self.updater = Updater(Account.from_section('DEFAULT', settings))
+        self.addCleanup(self.updater.close)
+        self.daemon = Daemon(self.updater, log=lambda message: None)
+
+
+class ForcedPushTest(PushTestCase):
+    REPLY = 'rate_limited'
+
+    def test_forced_push_waits_out_rate_limit(self):
+        self.assertEqual(self.daemon.run_once().status, UpdateResult.RATE_LIMITED)
+        self.assertEqual(self.server.take_counts(), {'ip_lookups': 1, 'api_calls': 1})
+        result = self.daemon.push('DEFAULT', True, None)
+        self.assertEqual(result.status, UpdateResult.RATE_LIMITED)
+        self.assertEqual(self.server.take_counts(), {'ip_lookups': 1})
+
+    def test_forced_run_overrides_rate_limit(self):
+        self.daemon.run_once()
+        self.server.take_counts()
+        self.assertEqual(self.daemon.run_once(force=True).status, UpdateResult.RATE_LIMITED)
+        self.assertEqual(self.server.take_counts(), {'ip_lookups': 1, 'api_calls': 1})
+
+
+class PushedIPTest(PushTestCase):
+    def test_registered_address_is_stored(self):
+        # MAM saw the request come from STUB_IP, whatever was pushed
+        result = self.daemon.push('DEFAULT', False, PUSHED_IP)
+        self.assertEqual((result.status, result.ip), (UpdateResult.UPDATED, STUB_IP))
+        self.assertEqual(self.updater.state.cached_ip(), STUB_IP)
+        self.assertEqual(self.server.take_counts(), {'api_calls': 1})
+
+    def test_reply_without_address(self):
+        self.assertIsNone(registered_ip({'Success': True, 'msg': 'Completed'}))
+        self.assertIsNone(registered_ip({'Success': True, 'ip': '10.0.0.1'}))
+        self.assertEqual(registered_ip({'Success': True, 'ip': STUB_IP}), STUB_IP)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,200 @@
+"""
+Description:
+Tests for mam_core.py: the Docker-mode MAM API call, where update_seedbox_ip_docker
+parses the output of curl -i run inside the container through a stand-in Docker client,
+and Updater runs against the benchmark stub servers: phases timing out within the
+update's budget, and concurrent runs of one account sharing a single update through its
+lock file.
+"""
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from benchmark import STUB_IP, StubServer, account_settings
+from mam_core import (PHASE_API, PHASE_RESOLVE, PHASE_STATE, Account, Deadline, Phase, PhaseTimeout, UpdateError, Updater, UpdateResult,
+                      update_seedbox_ip_docker)
+from mam_state import StateStore, cookie_seed
+
+URL = 'https://t.myanonamouse.net/json/dynamicSeedbox.php'
+REPLY = '{"Success": true, "msg": "Completed", "ip": "203.0.113.10"}'
+
+
+class FakeDocker(object):
+    """
+    Answers every exec with a fixed output and remembers the commands.
+    """
+    def __init__(self, output):
+        self.output = output
+        self.commands = []
+
+    def available(self):
+        return True
+
+    def exec(self, container_name, cmd, timeout=None):
+        self.commands.append(list(cmd))
+        return 0, self.output, ''
+
+
+def http_response(status='200 OK', headers=(), body=REPLY):
+    lines = [f'HTTP/1.1 {status}'] + [f'{name}: {value}' for name, value in headers]
+    return '\r\n'.join(lines) + '\r\n\r\n' + body
+
+
+class UpdateSeedboxIpDockerTest(unittest.TestCase):
+    def setUp(self):
+        self.statedir = tempfile.mkdtemp(prefix='mam-core-test-')
+        self.addCleanup(shutil.rmtree, self.statedir, ignore_errors=True)
+        self.cookiefile = os.path.join(self.statedir, 'MAM.cookie')
+
+    def call(self, output):
+        docker = FakeDocker(output)
+        reply = update_seedbox_ip_docker('vpn', 'configured-cookie', self.cookiefile, URL, docker)
+        return reply, docker
+
+    def saved_cookies(self):
+        with open(self.cookiefile) as f:
+            return f.read()
+
+    def test_sends_configured_cookie(self):
+        reply, docker = self.call(http_response())
+        self.assertEqual(reply['msg'], 'Completed')
+        self.assertIn('Cookie: mam_id=configured-cookie', docker.commands[0])
+
+    def test_refreshed_cookie_is_saved(self):
+        self.call(http_response(headers=[('Set-Cookie', 'mam_id=refreshed; Domain=.myanonamouse.net; Path=/')]))
+        cookies = self.saved_cookies()
+        self.assertIn('refreshed', cookies)
+        self.assertNotIn('configured-cookie', cookies)
+
+    def test_proxy_connect_response_is_skipped(self):
+        # curl through HTTPS_PROXY prints the proxy's CONNECT reply first
+        output = 'HTTP/1.1 200 Connection established\r\n\r\n' + http_response(headers=[('Set-Cookie', 'mam_id=refreshed; Domain=.myanonamouse.net; Path=/')])
+        reply, _docker = self.call(output)
+        self.assertEqual(reply['Success'], True)
+        self.assertIn('refreshed', self.saved_cookies())
+
+    def test_continue_response_is_skipped(self):
+        reply, _docker = self.call('HTTP/1.1 100 Continue\n\n' + http_response())
+        self.assertEqual(reply['msg'], 'Completed')
+
+    def test_body_without_headers(self):
+        reply, _docker = self.call(REPLY + '\n')
+        self.assertEqual(reply['msg'], 'Completed')
+
+    def test_headers_without_body(self):
+        with self.assertRaisesRegex(UpdateError, 'Failed to get a response'):
+            self.call(http_response(status='502 Bad Gateway', body=''))
+
+
+class UpdaterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = StubServer(0.5)
+        threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.statedir = tempfile.mkdtemp(prefix='mam-core-test-')
+        self.addCleanup(shutil.rmtree, self.statedir, ignore_errors=True)
+
+    def updater(self, method='manual', reply='success', **settings):
+        values = account_settings(method, reply, self.server.base_url, self.statedir, 5)
+        values.update(settings)
+        updater = Updater(Account.from_section('DEFAULT', values))
+        self.addCleanup(updater.close)
+        return updater
+
+
+class CookieChangeTest(UpdaterTestCase):
+    def setUp(self):
+        super().setUp()
+        # A state directory from before the registered cookie was recorded
+        with open(os.path.join(self.statedir, 'MAM.ip'), 'w') as f:
+            f.write(STUB_IP)
+
+    def test_unseeded_state_is_unchanged(self):
+        updater = self.updater()
+        self.assertEqual(updater.run().status, UpdateResult.UNCHANGED)
+        self.assertEqual(self.server.take_counts(), {})
+        self.assertEqual(StateStore(self.statedir).get('registered_cookie_seed'), cookie_seed('benchmark-cookie'))
+
+    def test_cookie_rotated_since_cookie_file_was_written(self):
+        StateStore(self.statedir).update(cookie_seed=cookie_seed('old-cookie'))
+        self.assertEqual(self.updater().run().status, UpdateResult.UPDATED)
+        self.assertEqual(self.server.take_counts(), {'api_calls': 1})
+        self.assertEqual(self.updater().run().status, UpdateResult.UNCHANGED)
+
+
+class DeadlineTest(UpdaterTestCase):
+    # The stub's slow reply takes 0.5s
+    BUDGET = 0.4
+
+    def test_deadline_runs_down(self):
+        deadline = Deadline(0.05)
+        self.assertLessEqual(deadline.remaining(), 0.05)
+        time.sleep(0.06)
+        self.assertEqual(deadline.remaining(), 0.0)
+
+    def test_phase_gets_its_share(self):
+        deadline = Deadline(10)
+        self.assertAlmostEqual(Phase(deadline, PHASE_RESOLVE).timeout, 5, places=1)
+        # Everything left but the reserve for writing the state afterwards
+        self.assertAlmostEqual(Phase(deadline, PHASE_API).timeout, 9.5, places=1)
+        self.assertAlmostEqual(Phase(deadline, PHASE_STATE).timeout, 2, places=1)
+
+    def test_exhausted_budget(self):
+        deadline = Deadline(0.01)
+        time.sleep(0.02)
+        with self.assertRaises(PhaseTimeout) as caught:
+            with Phase(deadline, PHASE_STATE):
+                pass
+        self.assertEqual(caught.exception.phase, PHASE_STATE)
+        result = self.updater('website_plain').update(deadline, force=False)
+        self.assertEqual((result.status, result.phase), (UpdateResult.TIMEOUT, PHASE_RESOLVE))
+        self.assertEqual(self.server.take_counts(), {})
+
+    def test_slow_api_call(self):
+        updater = self.updater('website_plain', 'slow')
+        started = time.monotonic()
+        result = updater.run(budget=self.BUDGET)
+        self.assertLess(time.monotonic() - started, 0.5)
+        self.assertEqual((result.status, result.phase), (UpdateResult.TIMEOUT, PHASE_API))
+        self.assertIn('Timed out during the api phase', result.message)
+        self.assertEqual(set(updater.timings), {'lock', PHASE_RESOLVE, PHASE_STATE, PHASE_API})
+        self.assertGreater(updater.timings[PHASE_API], 0.2)
+        # A timeout is no answer from MAM, so nothing is recorded as registered
+        self.assertIsNone(updater.state.cached_ip())
+
+    def test_slow_ip_lookup(self):
+        updater = self.updater('website_plain', external_ip_url=f'{self.server.base_url}/json/slow/dynamicSeedbox.php')
+        result = updater.run(budget=self.BUDGET)
+        self.assertEqual((result.status, result.phase), (UpdateResult.TIMEOUT, PHASE_RESOLVE))
+        self.assertAlmostEqual(updater.timings[PHASE_RESOLVE], self.BUDGET / 2, delta=0.1)
+        self.assertNotIn(PHASE_API, updater.timings)
+
+
+class SingleFlightTest(UpdaterTestCase):
+    def test_concurrent_runs_share_one_update(self):
+        # One Updater each, as separate processes would have; only the lock file is shared
+        updaters = [self.updater('website_plain', 'slow') for _ in range(3)]
+        results = [None] * len(updaters)
+
+        def run(index):
+            results[index] = updaters[index].run()
+
+        threads = [threading.Thread(target=run, args=(index,)) for index in range(len(updaters))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(self.server.take_counts(), {'ip_lookups': 1, 'api_calls': 1})
+        self.assertEqual([result.status for result in results], [UpdateResult.UPDATED] * 3)
+        shared = [result for result in results if result.message.endswith(" (result of a concurrent update)")]
+        self.assertEqual(len(shared), 2)
+        self.assertEqual({result.ip for result in results}, {STUB_IP})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,277 @@
+"""
+Description:
+Tests for the Docker Engine API client (mam_docker.py) against a fake Docker daemon
+on a unix socket: inspect, exec with a multiplexed output stream, the /events stream
+and EventWatcher reconnecting after the stream drops and stopping while it is idle.
+"""
+
+import http.server
+import json
+import os
+import queue
+import shutil
+import socketserver
+import struct
+import tempfile
+import threading
+import time
+import unittest
+import urllib.parse
+
+from mam_containers import get_cache
+from mam_docker import LIFECYCLE_EVENTS, DockerClient, DockerError, EventWatcher, demux_stream
+
+CONTAINER_NAME = 'vpn'
+CONTAINER_ID = 'c0ffee'
+WAIT = 5
+
+
+def frame(stream, data):
+    return struct.pack('>BxxxL', stream, len(data)) + data
+
+
+class FakeDocker(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    One running container; exec prints to stdout and stderr and exits with 3. Events
+    put on the events queue are streamed to the subscriber; None ends the stream.
+    """
+    daemon_threads = True
+
+    def __init__(self, socket_path):
+        super().__init__(socket_path, FakeDockerHandler)
+        self.events = queue.Queue()
+        self.event_queries = []
+        self.execs = {}
+        self.connections = 0
+        self.lock = threading.Lock()
+        self.closing = threading.Event()
+
+
+class FakeDockerHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def address_string(self):
+        return 'docker'
+
+    def log_message(self, *_args):
+        pass
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def send(self, status, obj=None, raw=None):
+        body = raw if raw is not None else json.dumps(obj).encode()
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path, _, query = self.path.partition('?')
+        parts = path.strip('/').split('/')[1:]
+        if parts == ['containers', CONTAINER_NAME, 'json']:
+            return self.send(200, {'Id': CONTAINER_ID, 'State': {'Running': True, 'Status': 'running', 'Pid': os.getpid()}})
+        if parts[:1] == ['containers']:
+            return self.send(404, {'message': f"No such container: {parts[1]}"})
+        if parts[:1] == ['exec'] and parts[2:] == ['json']:
+            return self.send(200, {'ExitCode': 3, 'Running': False})
+        if parts == ['events']:
+            return self.stream_events(urllib.parse.parse_qs(query))
+        self.send(404, {'message': 'page not found'})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length) or b'null')
+        parts = self.path.split('?')[0].strip('/').split('/')[1:]
+        if parts == ['containers', CONTAINER_NAME, 'exec']:
+            with self.server.lock:
+                exec_id = f"exec{len(self.server.execs)}"
+                self.server.execs[exec_id] = body
+            return self.send(201, {'Id': exec_id})
+        if parts[:1] == ['containers']:
+            return self.send(404, {'message': f"No such container: {parts[1]}"})
+        if parts[:1] == ['exec'] and parts[2:] == ['start']:
+            # Output split over several frames, as the daemon does for long output
+            return self.send(200, raw=frame(1, b'203.0.') + frame(2, b'warning\n') + frame(1, b'113.7\n'))
+        self.send(404, {'message': 'page not found'})
+
+    def stream_events(self, query):
+        self.server.event_queries.append(json.loads(query['filters'][0]))
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        self.close_connection = True
+        try:
+            while not self.server.closing.is_set():
+                try:
+                    event = self.server.events.get(timeout=0.05)
+                except queue.Empty:
+                    continue
+                if event is None:
+                    break
+                data = json.dumps(event).encode() + b'\n'
+                self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+                self.wfile.flush()
+            self.wfile.write(b'0\r\n\r\n')
+        except OSError:
+            # The subscriber stopped reading and hung up
+            pass
+
+
+def container_event(action, name=CONTAINER_NAME, container_id=CONTAINER_ID, **attributes):
+    return {'Type': 'container', 'Action': action, 'status': action, 'id': container_id,
+            'Actor': {'ID': container_id, 'Attributes': dict(attributes, name=name)}}
+
+
+class DockerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='mam-docker-test-')
+        self.server = FakeDocker(os.path.join(self.tmpdir, 'docker.sock'))
+        threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True).start()
+        self.client = DockerClient(self.server.server_address, timeout=WAIT)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.closing.set()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+
+class DockerClientTest(DockerTestCase):
+    def test_inspect(self):
+        info = self.client.inspect(CONTAINER_NAME)
+        self.assertEqual(info['Id'], CONTAINER_ID)
+        self.assertTrue(self.client.is_running(CONTAINER_NAME))
+
+    def test_inspect_missing_container(self):
+        self.assertIsNone(self.client.inspect('missing'))
+        self.assertFalse(self.client.is_running('missing'))
+
+    def test_connections_are_reused(self):
+        for _ in range(3):
+            self.client.inspect(CONTAINER_NAME)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_exec_demultiplexes_output(self):
+        exit_code, stdout, stderr = self.client.exec(CONTAINER_NAME, ['curl', '-s', 'http://example.invalid/'])
+        self.assertEqual((exit_code, stdout, stderr), (3, '203.0.113.7\n', 'warning\n'))
+        self.assertEqual(self.server.execs['exec0']['Cmd'], ['curl', '-s', 'http://example.invalid/'])
+
+    def test_exec_missing_container(self):
+        with self.assertRaises(DockerError) as caught:
+            self.client.exec('missing', ['true'])
+        self.assertEqual(caught.exception.status, 404)
+        self.assertIn('No such container', str(caught.exception))
+
+    def test_demux_ignores_truncated_frame(self):
+        self.assertEqual(demux_stream(frame(1, b'out') + frame(2, b'err') + b'\x01\x00'), (b'out', b'err'))
+
+    def test_unreachable_daemon(self):
+        client = DockerClient(os.path.join(self.tmpdir, 'nothing.sock'))
+        self.assertFalse(client.available())
+        with self.assertRaises(DockerError):
+            client.inspect(CONTAINER_NAME)
+
+
+class EventsTest(DockerTestCase):
+    def test_events_stream(self):
+        for action in ('start', 'die'):
+            self.server.events.put(container_event(action))
+        self.server.events.put(None)
+        events = list(self.client.events([CONTAINER_NAME], LIFECYCLE_EVENTS))
+        self.assertEqual([event['Action'] for event in events], ['start', 'die'])
+        self.assertEqual(self.server.event_queries, [{'type': ['container'], 'event': list(LIFECYCLE_EVENTS), 'container': [CONTAINER_NAME]}])
+
+    def test_events_stop(self):
+        stop = threading.Event()
+        self.server.events.put(container_event('start'))
+        for _event in self.client.events([CONTAINER_NAME], stop_event=stop):
+            stop.set()
+        self.assertTrue(stop.is_set())
+
+
+class EventWatcherTest(DockerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.cache = get_cache(self.tmpdir)
+        self.calls = queue.Queue()
+        self.watcher = EventWatcher(self.client, [CONTAINER_NAME], lambda name, action: self.calls.put((name, action)), retry_delay=0.05)
+
+    def tearDown(self):
+        self.watcher.stop()
+        super().tearDown()
+        self.watcher.thread.join(WAIT)
+
+    def cached(self):
+        return self.cache.lookup(CONTAINER_NAME)
+
+    def test_restart_calls_back_and_invalidates(self):
+        self.cache.resolve(self.client, CONTAINER_NAME)
+        self.watcher.start()
+        self.server.events.put(container_event('die'))
+        self.server.events.put(container_event('start'))
+        self.assertEqual(self.calls.get(timeout=WAIT), (CONTAINER_NAME, 'start'))
+        # 'die' only invalidates, it doesn't trigger an update
+        self.assertTrue(self.calls.empty())
+        self.assertIsNone(self.cached())
+
+    def test_rename_invalidates_old_name(self):
+        self.cache.resolve(self.client, CONTAINER_NAME)
+        self.watcher.start()
+        self.server.events.put(container_event('rename', name='vpn-new', oldName='/' + CONTAINER_NAME))
+        self.server.events.put(container_event('start', name='vpn-new'))
+        self.assertEqual(self.calls.get(timeout=WAIT), ('vpn-new', 'start'))
+        self.assertIsNone(self.cached())
+
+    def test_reconnects_after_stream_ends(self):
+        self.watcher.start()
+        self.server.events.put(container_event('start'))
+        self.assertEqual(self.calls.get(timeout=WAIT), (CONTAINER_NAME, 'start'))
+        # Entries cached while the stream is down are dropped on reconnect
+        self.cache.resolve(self.client, CONTAINER_NAME)
+        self.server.events.put(None)
+        deadline = time.monotonic() + WAIT
+        while len(self.server.event_queries) < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(len(self.server.event_queries), 2)
+        self.assertIsNone(self.cached())
+        self.server.events.put(container_event('restart'))
+        self.assertEqual(self.calls.get(timeout=WAIT), (CONTAINER_NAME, 'restart'))
+
+    def subscribed(self):
+        deadline = time.monotonic() + WAIT
+        while not self.server.event_queries and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(len(self.server.event_queries), 1)
+
+    def test_stop_interrupts_stream(self):
+        self.watcher.start()
+        self.subscribed()
+        # The stream is idle: stop() has to wake the thread itself
+        self.watcher.stop()
+        self.watcher.thread.join(WAIT)
+        self.assertFalse(self.watcher.thread.is_alive())
+        self.server.events.put(container_event('start'))
+        time.sleep(0.2)
+        self.assertTrue(self.calls.empty())
+        self.assertEqual(len(self.server.event_queries), 1)
+
+    def test_no_callback_after_stop(self):
+        # A callback that stops the watcher, as a config reload replacing it does
+        self.watcher.callback = lambda name, action: (self.calls.put((name, action)), self.watcher.stop())
+        self.watcher.start()
+        self.subscribed()
+        self.server.events.put(container_event('start'))
+        self.server.events.put(container_event('restart'))
+        self.watcher.thread.join(WAIT)
+        self.assertFalse(self.watcher.thread.is_alive())
+        self.assertEqual(self.calls.get_nowait(), (CONTAINER_NAME, 'start'))
+        self.assertTrue(self.calls.empty())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,139 @@
+"""
+Description:
+Tests for fleet mode (mam_fleet.py) against the benchmark stub servers: sweeps bounded
+by the worker count, failures kept to their account and the results table. A reloaded
+config applied to a running fleet: a rotated mam_cookie reaches MAM on the next run,
+accounts added by a reload run in parallel, and removed ones are reported, also when
+the reload comes in the middle of a sweep.
+"""
+
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from benchmark import STUB_IP, StubServer, account_settings
+from mam_control import ControlError
+from mam_core import Account, UpdateResult
+from mam_fleet import Fleet, FleetResult, format_table
+
+WAIT = 5
+SLOW_DELAY = 0.5
+
+
+class FleetTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = StubServer(SLOW_DELAY)
+        threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.statedir = tempfile.mkdtemp(prefix='mam-fleet-test-')
+        self.addCleanup(shutil.rmtree, self.statedir, ignore_errors=True)
+
+    def account(self, name, reply='success', **settings):
+        values = account_settings('website_plain', reply, self.server.base_url, f'{self.statedir}/{name}', WAIT)
+        values.update(settings)
+        return Account.from_section(name, values)
+
+    def fleet(self, accounts, workers=8):
+        fleet = Fleet(accounts, max_workers=workers)
+        self.addCleanup(fleet.close)
+        return fleet
+
+
+class SweepTest(FleetTestCase):
+    def test_workers_bound_concurrency(self):
+        fleet = self.fleet([self.account(name, reply='slow') for name in 'abcd'], workers=2)
+        started = time.monotonic()
+        results = fleet.run_once()
+        elapsed = time.monotonic() - started
+        self.assertEqual([item.account.name for item in results], list('abcd'))
+        self.assertEqual([item.result.status for item in results], [UpdateResult.UPDATED] * 4)
+        # Two rounds of two accounts
+        self.assertGreaterEqual(elapsed, 2 * SLOW_DELAY)
+        self.assertLess(elapsed, 3 * SLOW_DELAY)
+
+    def test_failures_stay_with_their_account(self):
+        fleet = self.fleet([self.account('a'), self.account('b', reply='malformed'), self.account('c')])
+        with mock.patch.object(fleet.updaters[2], 'run', side_effect=RuntimeError("updater crashed")):
+            results = fleet.run_once()
+        self.assertEqual([item.result.status for item in results], [UpdateResult.UPDATED, UpdateResult.ERROR, UpdateResult.ERROR])
+        self.assertIn("updater crashed", results[2].result.message)
+        self.assertEqual(fleet.run_once(names={'c'})[0].result.status, UpdateResult.UPDATED)
+
+    def test_only_named_accounts(self):
+        fleet = self.fleet([self.account('a'), self.account('b')])
+        self.assertEqual([item.account.name for item in fleet.run_once(names={'b'})], ['b'])
+
+
+class FormatTableTest(unittest.TestCase):
+    def test_table(self):
+        results = [
+            FleetResult(Account.from_section('seedbox', {}), UpdateResult(UpdateResult.UPDATED, "Success: Completed", STUB_IP), 0.25),
+            FleetResult(Account.from_section('vpn', {}), UpdateResult(UpdateResult.ERROR, "Error: Timed out"), 5),
+        ]
+        self.assertEqual(format_table(results).splitlines(), [
+            'ACCOUNT  STATUS   IP            TIME   MESSAGE',
+            'seedbox  updated  203.0.113.10  0.25s  Success: Completed',
+            'vpn      error    -             5.00s  Error: Timed out',
+            '1/2 accounts OK',
+        ])
+
+
+class ReconfigureTest(FleetTestCase):
+    def test_rotated_cookie_is_registered(self):
+        fleet = self.fleet([self.account('a')])
+        self.assertEqual(fleet.run_account('a').result.status, UpdateResult.UPDATED)
+        self.assertEqual(fleet.run_account('a').result.status, UpdateResult.UNCHANGED)
+        _added, _removed, changed = fleet.reconfigure([self.account('a', mam_cookie='rotated')])
+        self.assertEqual(changed, {'a': ['mam_cookie']})
+        self.server.take_counts()
+        self.assertEqual(fleet.run_account('a').result.status, UpdateResult.UPDATED)
+        self.assertEqual(self.server.take_counts(), {'ip_lookups': 1, 'api_calls': 1})
+        self.assertEqual(fleet.run_account('a').result.status, UpdateResult.UNCHANGED)
+
+    def test_rotated_cookie_waits_out_rate_limit(self):
+        fleet = self.fleet([self.account('a', reply='rate_limited')])
+        self.assertEqual(fleet.run_account('a').result.status, UpdateResult.RATE_LIMITED)
+        fleet.reconfigure([self.account('a', reply='rate_limited', mam_cookie='rotated')])
+        self.server.take_counts()
+        self.assertEqual(fleet.run_account('a').result.status, UpdateResult.RATE_LIMITED)
+        self.assertEqual(self.server.take_counts(), {'ip_lookups': 1})
+        self.assertTrue(fleet.updaters[0].force_next)
+
+    def test_added_accounts_run_in_parallel(self):
+        fleet = self.fleet([self.account('a', reply='slow')], workers=4)
+        added, removed, _changed = fleet.reconfigure([self.account(name, reply='slow') for name in 'abcd'])
+        self.assertEqual((added, removed), (['b', 'c', 'd'], []))
+        started = time.monotonic()
+        results = fleet.run_once()
+        self.assertEqual([item.result.status for item in results], [UpdateResult.UPDATED] * 4)
+        self.assertLess(time.monotonic() - started, 2 * SLOW_DELAY)
+
+    def test_reload_during_sweep(self):
+        fleet = self.fleet([self.account('a', reply='slow'), self.account('b', reply='slow')], workers=1)
+        results = []
+        sweep = threading.Thread(target=lambda: results.extend(fleet.run_once()))
+        sweep.start()
+        # 'a' is running and 'b' waits for the only worker
+        time.sleep(SLOW_DELAY / 2)
+        _added, removed, _changed = fleet.reconfigure([self.account('c')])
+        sweep.join(WAIT)
+        self.assertEqual(removed, ['a', 'b'])
+        self.assertEqual([(item.account.name, item.result.status) for item in results],
+                         [('a', UpdateResult.UPDATED), ('b', UpdateResult.ERROR)])
+        self.assertIn('removed from the config', results[1].result.message)
+        self.assertEqual(fleet.run_account('c').result.status, UpdateResult.UPDATED)
+
+    def test_removed_account(self):
+        fleet = self.fleet([self.account('a'), self.account('b')])
+        _added, removed, _changed = fleet.reconfigure([self.account('a')])
+        self.assertEqual(removed, ['b'])
+        with self.assertRaisesRegex(ControlError, "Unknown account 'b'"):
+            fleet.run_account('b')
+
+
+if __name__ == '__main__':
+    unittest.main()
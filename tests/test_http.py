@@ -0,0 +1,182 @@
+"""
+Description:
+Tests for the pooled HTTP client (mam_http.py) against a local http.server stub:
+keep-alive connections being reused or retried once the server dropped them,
+cancelling a request in flight, timeouts, bounded reads, and the MAM.cookie jar
+sending the configured cookie and keeping the one the server refreshed.
+"""
+
+import http.server
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from mam_http import CancelToken, HTTPClient, HTTPClientError, cookie_fingerprint, cookie_value, keep_refreshed_cookie, load_cookie_jar, save_cookie_jar
+
+SLOW_DELAY = 2
+WAIT = 5
+
+
+class StubServer(http.server.ThreadingHTTPServer):
+    """
+    /hello answers at once, /slow after SLOW_DELAY, /close asks to close the connection,
+    /drop closes it without saying so, /cookie sets mam_id=refreshed and /big sends
+    64KB. Remembers the Cookie headers and counts the connections accepted.
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), StubHandler)
+        self.connections = 0
+        self.cookies = []
+        self.lock = threading.Lock()
+        self.closing = threading.Event()
+
+    def url(self, path):
+        return f'http://127.0.0.1:{self.server_port}{path}'
+
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *_args):
+        pass
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.cookies.append(self.headers.get('Cookie'))
+        headers = []
+        body = b'{"ok": true}'
+        if self.path == '/slow':
+            # Returns early when the test is torn down
+            self.server.closing.wait(SLOW_DELAY)
+        elif self.path == '/close':
+            headers.append(('Connection', 'close'))
+        elif self.path == '/cookie':
+            headers.append(('Set-Cookie', 'mam_id=refreshed; Path=/'))
+        elif self.path == '/big':
+            body = b'x' * 65536
+        try:
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            for name, value in headers:
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+            if self.path == '/drop':
+                self.close_connection = True
+        except OSError:
+            # The client gave up on the request and hung up
+            pass
+
+
+class HTTPClientTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = StubServer()
+        threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.addCleanup(self.server.closing.set)
+        self.http = HTTPClient(timeout=WAIT)
+        self.addCleanup(self.http.close)
+
+
+class ConnectionTest(HTTPClientTestCase):
+    def test_connection_is_reused(self):
+        for _ in range(3):
+            response = self.http.get(self.server.url('/hello'))
+            self.assertEqual((response.status, response.json()), (200, {'ok': True}))
+        self.assertEqual(self.server.connections, 1)
+
+    def test_closed_connection_is_not_reused(self):
+        self.http.get(self.server.url('/close'))
+        self.http.get(self.server.url('/hello'))
+        self.assertEqual(self.server.connections, 2)
+
+    def test_stale_connection_is_retried(self):
+        # The server drops the pooled connection, as when it times out idle ones
+        self.http.get(self.server.url('/drop'))
+        time.sleep(0.05)
+        self.assertEqual(self.http.get(self.server.url('/hello')).status, 200)
+        self.assertEqual(self.server.connections, 2)
+
+    def test_bounded_read(self):
+        response = self.http.get(self.server.url('/big'), max_bytes=100)
+        self.assertEqual(len(response.body), 100)
+        # The rest of the body is still on that connection, so it is not reused
+        self.http.get(self.server.url('/hello'))
+        self.assertEqual(self.server.connections, 2)
+
+    def test_unsupported_url(self):
+        with self.assertRaisesRegex(HTTPClientError, 'Unsupported URL'):
+            self.http.get('ftp://127.0.0.1/')
+
+
+class CancelTest(HTTPClientTestCase):
+    def test_cancel_in_flight(self):
+        cancel = CancelToken()
+        timer = threading.Timer(0.1, cancel.cancel)
+        timer.start()
+        self.addCleanup(timer.cancel)
+        started = time.monotonic()
+        with self.assertRaises(HTTPClientError):
+            self.http.get(self.server.url('/slow'), cancel=cancel)
+        self.assertLess(time.monotonic() - started, SLOW_DELAY)
+        # The aborted connection isn't handed out again
+        self.assertEqual(self.http.get(self.server.url('/hello')).status, 200)
+        self.assertEqual(self.server.connections, 2)
+
+    def test_cancelled_before_request(self):
+        cancel = CancelToken()
+        cancel.cancel()
+        with self.assertRaisesRegex(HTTPClientError, 'cancelled'):
+            self.http.get(self.server.url('/hello'), cancel=cancel)
+        self.assertEqual(self.server.connections, 0)
+
+    def test_timeout(self):
+        started = time.monotonic()
+        with self.assertRaisesRegex(HTTPClientError, 'timed out'):
+            self.http.get(self.server.url('/slow'), timeout=0.2)
+        self.assertLess(time.monotonic() - started, SLOW_DELAY)
+
+
+class CookieJarTest(HTTPClientTestCase):
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.mkdtemp(prefix='mam-http-test-')
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        self.cookiefile = os.path.join(directory, 'MAM.cookie')
+
+    def jar(self):
+        return load_cookie_jar(self.cookiefile, 'configured', self.server.url('/'))
+
+    def test_refreshed_cookie_is_kept(self):
+        jar = self.jar()
+        before = cookie_fingerprint(jar)
+        self.http.get(self.server.url('/cookie'), cookiejar=jar)
+        keep_refreshed_cookie(jar, 'mam_id', before)
+        self.assertTrue(save_cookie_jar(jar, before))
+        jar = self.jar()
+        self.assertEqual(cookie_value(jar, 'mam_id'), 'refreshed')
+        self.http.get(self.server.url('/hello'), cookiejar=jar)
+        self.assertEqual(self.server.cookies, ['mam_id=configured', 'mam_id=refreshed'])
+
+    def test_unchanged_jar_is_not_written(self):
+        jar = self.jar()
+        before = cookie_fingerprint(jar)
+        self.http.get(self.server.url('/hello'), cookiejar=jar)
+        self.assertFalse(save_cookie_jar(jar, before))
+        self.assertFalse(os.path.exists(self.cookiefile))
+
+
+if __name__ == '__main__':
+    unittest.main()
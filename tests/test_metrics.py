@@ -0,0 +1,92 @@
+"""
+Description:
+Tests for the IP source counters in mam_metrics.py: they keep growing across Updaters
+(the GUI makes one per click), shared SourceStats and runs continued from a textfile.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from mam_metrics import Metrics
+from mam_resolver import SourceStats
+
+URL = 'https://ip.example.net/'
+
+
+class FakeResolver(object):
+    def __init__(self, stats):
+        self.stats = stats
+        self.sources = [stats.url]
+
+    def source_stats(self, url):
+        return self.stats
+
+
+class FakeAccount(object):
+    name = 'DEFAULT'
+
+
+class FakeUpdater(object):
+    account = FakeAccount()
+    containers = None
+    timings = {}
+
+    def __init__(self, stats):
+        self.resolver = FakeResolver(stats)
+
+
+class FakeResult(object):
+    status = 'unchanged'
+    ok = True
+    phase = None
+    retry_at = None
+
+
+def source_stats(successes=0, failures=0):
+    stats = SourceStats(URL)
+    for _ in range(successes):
+        stats.record_success(0.01)
+    for _ in range(failures):
+        stats.record_failure('HTTP 500')
+    return stats
+
+
+class SourceCounterTest(unittest.TestCase):
+    def setUp(self):
+        self.metrics = Metrics()
+
+    def requests(self, outcome):
+        return self.metrics.value('mam_ip_source_requests_total', {'url': URL, 'outcome': outcome})
+
+    def record(self, stats):
+        self.metrics.record(FakeUpdater(stats), FakeResult(), 0.1)
+
+    def test_counts_add_up_across_updaters(self):
+        self.record(source_stats(successes=2))
+        self.record(source_stats(successes=1, failures=1))
+        self.assertEqual((self.requests('successes'), self.requests('failures')), (3, 1))
+
+    def test_shared_stats_are_counted_once(self):
+        stats = source_stats(successes=1)
+        self.record(stats)
+        self.record(stats)
+        stats.record_success(0.01)
+        self.record(stats)
+        self.assertEqual(self.requests('successes'), 2)
+
+    def test_counts_continue_from_textfile(self):
+        directory = tempfile.mkdtemp(prefix='mam-metrics-test-')
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        path = os.path.join(directory, 'mam.prom')
+        self.record(source_stats(successes=2))
+        self.metrics.write_textfile(path)
+        metrics = self.metrics = Metrics()
+        metrics.load_textfile(path)
+        self.record(source_stats(successes=1))
+        self.assertEqual(self.requests('successes'), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,152 @@
+"""
+Description:
+Tests for local IP change detection (mam_netlink.py): parsing rtnetlink datagrams, and a
+NetlinkWatcher in a network namespace made with unshare(1) reacting to address and
+default route changes, with the behind-NAT fallback. The namespace tests are skipped
+without unshare or CAP_SYS_ADMIN.
+"""
+
+import queue
+import subprocess
+import time
+import unittest
+from unittest import mock
+
+from mam_netlink import NLMSGHDR, RTM_DELADDR, RTM_NEWADDR, RTM_NEWROUTE, RTMSG, NetlinkWatcher, parse_messages
+from tests.test_netns import Namespace, can_unshare
+
+WAIT = 5
+# Not routable from the namespace, which has no way out
+PUBLIC = '45.67.89.10'
+OTHER_PUBLIC = '45.67.90.5'
+PRIVATE = '10.1.0.5'
+RTM_NEWLINK = 16
+
+
+def message(msg_type, payload=b''):
+    length = NLMSGHDR.size + len(payload)
+    # Messages are padded to 4 bytes
+    return NLMSGHDR.pack(length, msg_type, 0, 0, 0) + payload + b'\0' * (-length % 4)
+
+
+def route(msg_type, dst_len):
+    return message(msg_type, RTMSG.pack(2, dst_len, 0, 0, 254, 4, 0, 1, 0))
+
+
+class ParseMessagesTest(unittest.TestCase):
+    def test_address_messages(self):
+        self.assertEqual(parse_messages(message(RTM_NEWADDR, b'\1\2\3')), (True, False))
+        self.assertEqual(parse_messages(message(RTM_DELADDR)), (True, False))
+
+    def test_default_route(self):
+        self.assertEqual(parse_messages(route(RTM_NEWROUTE, 0)), (False, True))
+
+    def test_other_routes_are_ignored(self):
+        self.assertEqual(parse_messages(route(RTM_NEWROUTE, 24)), (False, False))
+        self.assertEqual(parse_messages(message(RTM_NEWLINK, b'\0' * 16)), (False, False))
+
+    def test_several_messages(self):
+        data = message(RTM_NEWLINK, b'\0' * 5) + route(RTM_NEWROUTE, 24) + message(RTM_NEWADDR, b'\0' * 7) + route(RTM_NEWROUTE, 0)
+        self.assertEqual(parse_messages(data), (True, True))
+
+    def test_truncated_data(self):
+        self.assertEqual(parse_messages(b''), (False, False))
+        self.assertEqual(parse_messages(message(RTM_NEWADDR)[:NLMSGHDR.size - 1]), (False, False))
+        # A route message cut off before its rtmsg says nothing about the destination
+        self.assertEqual(parse_messages(NLMSGHDR.pack(NLMSGHDR.size + RTMSG.size, RTM_NEWROUTE, 0, 0, 0)), (False, False))
+
+    def test_invalid_length_stops(self):
+        data = NLMSGHDR.pack(0, RTM_NEWROUTE, 0, 0, 0) + message(RTM_NEWADDR)
+        self.assertEqual(parse_messages(data), (False, False))
+
+
+class WatcherErrorTest(unittest.TestCase):
+    def test_missing_namespace(self):
+        errors = queue.Queue()
+        watcher = NetlinkWatcher(lambda address, public: None, netns='/proc/0/ns/net', on_error=errors.put, retry_delay=WAIT).start()
+        self.addCleanup(watcher.stop)
+        self.assertIn('Cannot enter network namespace', errors.get(timeout=WAIT))
+
+
+@unittest.skipUnless(can_unshare(), "needs unshare and CAP_SYS_ADMIN")
+class NetlinkWatcherTest(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch('mam_netlink.SETTLE_DELAY', 0.05)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.namespace = Namespace()
+        self.addCleanup(self.namespace.close)
+        self.ip('link', 'add', 'veth0', 'type', 'veth', 'peer', 'name', 'veth1')
+        self.ip('link', 'set', 'veth0', 'up')
+        self.ip('link', 'set', 'veth1', 'up')
+        self.changes = queue.Queue()
+        self.errors = []
+
+    def ip(self, *args):
+        subprocess.run(['nsenter', f'--net={self.namespace.path}', 'ip'] + list(args), check=True, stdout=subprocess.DEVNULL, timeout=WAIT)
+
+    def connect(self, address, gateway):
+        self.ip('addr', 'add', f'{address}/24', 'dev', 'veth0')
+        self.ip('route', 'add', 'default', 'via', gateway)
+
+    def watch(self):
+        watcher = NetlinkWatcher(lambda address, public: self.changes.put((address, public)), self.namespace.path, self.errors.append)
+        self.addCleanup(watcher.stop)
+        watcher.start()
+        # Changes made before the baseline is taken go unnoticed
+        deadline = time.monotonic() + WAIT
+        while not watcher.baseline and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(watcher.baseline, self.errors)
+        return watcher
+
+    def assertNoChange(self):
+        with self.assertRaises(queue.Empty):
+            self.changes.get(timeout=0.5)
+
+    def test_address_added(self):
+        watcher = self.watch()
+        self.assertIsNone(watcher.address)
+        self.connect(PUBLIC, '45.67.89.1')
+        self.assertEqual(self.changes.get(timeout=WAIT), (PUBLIC, True))
+
+    def test_address_changed(self):
+        self.connect(PUBLIC, '45.67.89.1')
+        watcher = self.watch()
+        self.assertEqual(watcher.address, PUBLIC)
+        self.ip('addr', 'add', f'{OTHER_PUBLIC}/32', 'dev', 'veth0')
+        self.ip('route', 'replace', 'default', 'via', '45.67.89.1', 'src', OTHER_PUBLIC)
+        self.assertEqual(self.changes.get(timeout=WAIT), (OTHER_PUBLIC, True))
+
+    def test_unrelated_address_ignored(self):
+        self.connect(PUBLIC, '45.67.89.1')
+        self.watch()
+        self.ip('addr', 'add', '192.168.7.1/24', 'dev', 'veth1')
+        self.assertNoChange()
+
+    def test_public_route_change_ignored(self):
+        self.connect(PUBLIC, '45.67.89.1')
+        self.watch()
+        # The public address is still the one outgoing traffic uses
+        self.ip('route', 'replace', 'default', 'via', '45.67.89.2')
+        self.assertNoChange()
+
+    def test_route_change_behind_nat(self):
+        self.connect(PRIVATE, '10.1.0.1')
+        self.watch()
+        # A new gateway may mean a new public address even though the local one stayed
+        self.ip('route', 'replace', 'default', 'via', '10.1.0.2')
+        self.assertEqual(self.changes.get(timeout=WAIT), (PRIVATE, False))
+
+    def test_route_removed(self):
+        self.connect(PUBLIC, '45.67.89.1')
+        watcher = self.watch()
+        self.ip('route', 'del', 'default')
+        self.assertNoChange()
+        self.assertIsNone(watcher.address)
+        self.ip('route', 'add', 'default', 'via', '45.67.89.1')
+        self.assertEqual(self.changes.get(timeout=WAIT), (PUBLIC, True))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,186 @@
+"""
+Description:
+Tests for the network namespace worker (mam_netns.py) and Updater.in_netns. A network
+namespace with only a loopback interface is made with unshare(1), and the stub IP and
+MAM servers of benchmark.py listen inside it, so a request only reaches them when it
+really leaves from the namespace. Skipped without unshare or CAP_SYS_ADMIN.
+"""
+
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import unittest
+
+from benchmark import STUB_IP, StubServer, account_settings
+from mam_core import Account, UpdateResult, Updater
+from mam_netns import NetnsError, NetnsWorker, container_netns_path
+
+WAIT = 5
+
+
+def can_unshare():
+    if not hasattr(os, 'geteuid') or not shutil.which('unshare') or not shutil.which('ip'):
+        return False
+    try:
+        return subprocess.run(['unshare', '--net', 'true'], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=WAIT).returncode == 0
+    except (OSError, subprocess.TimeoutExpired):
+        return False
+
+
+def namespace_inode():
+    return os.stat('/proc/thread-self/ns/net').st_ino
+
+
+class Namespace(object):
+    """
+    A network namespace with loopback up, kept alive by a sleeping process.
+    """
+    def __init__(self):
+        self.process = subprocess.Popen(['unshare', '--net', 'sh', '-c', 'ip link set lo up && exec sleep 600'])
+        self.path = f'/proc/{self.process.pid}/ns/net'
+        deadline = time.monotonic() + WAIT
+        # sh execs sleep once loopback is up
+        while self.comm() != 'sleep':
+            if self.process.poll() is not None or time.monotonic() > deadline:
+                raise RuntimeError("Could not set up a network namespace")
+            time.sleep(0.01)
+
+    def comm(self):
+        try:
+            with open(f'/proc/{self.process.pid}/comm') as f:
+                return f.read().strip()
+        except OSError:
+            return None
+
+    def close(self):
+        self.process.kill()
+        self.process.wait()
+
+
+class FakeDocker(object):
+    def __init__(self, info):
+        self.info = info
+
+    def inspect(self, container_name, timeout=None):
+        return self.info
+
+
+class ContainerNetnsPathTest(unittest.TestCase):
+    def test_running_container(self):
+        docker = FakeDocker({'Id': 'c0ffee', 'State': {'Running': True, 'Pid': os.getpid()}})
+        self.assertEqual(container_netns_path(docker, 'vpn'), f'/proc/{os.getpid()}/ns/net')
+
+    def test_stopped_container(self):
+        docker = FakeDocker({'Id': 'c0ffee', 'State': {'Running': False, 'Pid': 0}})
+        with self.assertRaisesRegex(NetnsError, 'is not running'):
+            container_netns_path(docker, 'vpn')
+
+    def test_missing_container(self):
+        with self.assertRaisesRegex(NetnsError, 'does not exist'):
+            container_netns_path(FakeDocker(None), 'vpn')
+
+    def test_missing_namespace(self):
+        with self.assertRaises(NetnsError):
+            NetnsWorker('/proc/0/ns/net')
+
+
+class UnusedWorkerTest(unittest.TestCase):
+    def test_close_before_first_call(self):
+        worker = NetnsWorker('/proc/self/ns/net')
+        fd = worker._fd
+        worker.close()
+        with self.assertRaises(OSError):
+            os.fstat(fd)
+        # Closing didn't start the thread just to have it enter the namespace
+        self.assertEqual(len(worker._executor._threads), 0)
+        worker.close()
+
+
+@unittest.skipUnless(can_unshare(), "needs unshare and CAP_SYS_ADMIN")
+class NetnsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.namespace = Namespace()
+        self.addCleanup(self.namespace.close)
+        self.worker = NetnsWorker(self.namespace.path)
+        self.addCleanup(self.worker.close)
+        # Created on the worker thread, so the stub listens on the namespace's loopback
+        self.server = self.worker.call(StubServer, 0.1, timeout=WAIT)
+        threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+
+class NetnsWorkerTest(NetnsTestCase):
+    def test_worker_runs_in_namespace(self):
+        inode = os.stat(self.namespace.path).st_ino
+        self.assertNotEqual(namespace_inode(), inode)
+        self.assertEqual(self.worker.call(namespace_inode, timeout=WAIT), inode)
+        # The calling thread stays where it was
+        self.assertNotEqual(namespace_inode(), inode)
+
+    def test_matches(self):
+        self.assertTrue(self.worker.matches(self.namespace.path))
+        self.assertFalse(self.worker.matches('/proc/self/ns/net'))
+
+    def test_http_in_namespace(self):
+        url = f'{self.server.base_url}/myip.txt'
+        response = self.worker.call(lambda: self.worker.http.get(url, timeout=WAIT), timeout=WAIT)
+        self.assertEqual(response.text().strip(), STUB_IP)
+        self.assertEqual(self.server.take_counts(), {'ip_lookups': 1})
+
+
+class UpdaterInNetnsTest(NetnsTestCase):
+    def setUp(self):
+        super().setUp()
+        self.statedir = tempfile.mkdtemp(prefix='mam-netns-test-')
+        self.addCleanup(shutil.rmtree, self.statedir, ignore_errors=True)
+
+    def updater(self, reply='success'):
+        settings = account_settings('netns', reply, self.server.base_url, self.statedir, WAIT)
+        settings.update(netns=self.namespace.path, external_ip_url=f'{self.server.base_url}/myip.txt')
+        updater = Updater(Account.from_section('DEFAULT', settings))
+        self.addCleanup(updater.close)
+        return updater
+
+    def test_update_through_namespace(self):
+        updater = self.updater()
+        result = updater.run()
+        self.assertEqual(result.status, UpdateResult.UPDATED, result.message)
+        self.assertEqual(result.ip, STUB_IP)
+        self.assertEqual(self.server.take_counts(), {'ip_lookups': 1, 'api_calls': 1})
+        # The refreshed mam_id came back through the namespace's HTTP client
+        with open(os.path.join(self.statedir, 'MAM.cookie')) as f:
+            self.assertIn('refreshed-', f.read())
+
+    def test_worker_is_reused(self):
+        updater = self.updater()
+        updater.run()
+        worker = updater.netns_worker
+        self.assertEqual(updater.run(force=True).status, UpdateResult.UPDATED)
+        self.assertIs(updater.netns_worker, worker)
+
+    def test_new_namespace_replaces_worker(self):
+        updater = self.updater()
+        updater.run()
+        worker = updater.netns_worker
+        namespace = Namespace()
+        self.addCleanup(namespace.close)
+        updater.account.netns = namespace.path
+        # Nothing listens in the new namespace
+        result = updater.run(force=True)
+        self.assertIsNot(updater.netns_worker, worker)
+        self.assertEqual(result.status, UpdateResult.ERROR, result.message)
+
+    def test_host_namespace_cannot_reach_stub(self):
+        settings = account_settings('website_plain', 'success', self.server.base_url, self.statedir, 1)
+        updater = Updater(Account.from_section('DEFAULT', settings))
+        self.addCleanup(updater.close)
+        result = updater.run()
+        self.assertEqual(result.status, UpdateResult.ERROR, result.message)
+
+
+if __name__ == '__main__':
+    unittest.main()
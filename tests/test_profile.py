@@ -0,0 +1,49 @@
+"""
+Description:
+Tests for mam_profile.py: the profiles of pool threads are switched off by stop(), and
+Docker Engine API exec sessions are counted with the processes spawned.
+"""
+
+import sys
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from mam_profile import PER_THREAD_PROFILES, Profiler
+
+
+def work():
+    return sum(range(100))
+
+
+def work_calls(profiler):
+    return sum(calls for key, (_primitive, calls, _tottime, _cumtime, _callers) in profiler.stats.stats.items() if key[2] == 'work')
+
+
+class ProfilerTest(unittest.TestCase):
+    def profiler(self):
+        profiler = Profiler().start()
+        self.addCleanup(lambda: profiler._stopped or profiler.stop())
+        return profiler
+
+    def test_pool_threads(self):
+        pool = ThreadPoolExecutor(1)
+        self.addCleanup(pool.shutdown)
+        profiler = self.profiler()
+        pool.submit(work).result()
+        profiler.stop()
+        self.assertEqual(work_calls(profiler), 1)
+        self.assertEqual(len(profiler._profiles), 2 if PER_THREAD_PROFILES else 1)
+        pool.submit(work).result()
+        if PER_THREAD_PROFILES:
+            profiler._profiles[1].create_stats()
+            self.assertEqual(sum(stat[1] for key, stat in profiler._profiles[1].stats.items() if key[2] == 'work'), 1)
+
+    def test_docker_exec_counted(self):
+        profiler = self.profiler()
+        sys.audit('mam.docker.exec', 'vpn', ['/usr/bin/curl', '-s', 'https://ip.example.net/'])
+        profiler.stop()
+        self.assertEqual(profiler.spawns, {'docker exec curl': 1})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,340 @@
+"""
+Description:
+Tests for mam_resolver.py. The streaming response parser: IPv4 and IPv6 answers, the
+plain, JSON, HTML and regex formats, the byte cap and stopping as soon as the address
+is known. The IP source race against a local IP-echo server with per-source delays:
+the first answer wins, quorums, slower requests being cancelled, and the circuit
+breaker opening, going half-open after its cooldown and closing again.
+"""
+
+import http.server
+import socket
+import threading
+import time
+import unittest
+
+from mam_core import UpdateError, get_external_ip
+from mam_http import HTTPClient
+from mam_resolver import BREAKER_COOLDOWN, FAILURE_THRESHOLD, MAX_RESPONSE_BYTES, IPResolver, IPResponseParser, ResolverError, extract_ip
+
+FAST_IP = '203.0.113.1'
+SLOW_IP = '203.0.113.2'
+# Global addresses, which the parser trusts before the response is complete
+PUBLIC_IP = '45.67.89.10'
+PUBLIC_IPV6 = '2a01:4f8:c0c:1234::1'
+SLOW_DELAY = 2
+WAIT = 5
+
+
+class EchoServer(http.server.ThreadingHTTPServer):
+    """
+    /ip/<address>[?delay=SECONDS] answers with the address, /fail and the paths in
+    down with HTTP 500. /stream/<address> sends the address and then stalls for
+    SLOW_DELAY before finishing its body. Counts the requests per path.
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), EchoHandler)
+        self.hits = {}
+        self.down = set()
+        self.lock = threading.Lock()
+        self.closing = threading.Event()
+
+    def url(self, path):
+        return f'http://127.0.0.1:{self.server_port}{path}'
+
+    def count(self, path):
+        with self.lock:
+            return self.hits.get(path, 0)
+
+
+class EchoHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *_args):
+        pass
+
+    def do_GET(self):
+        path, _, query = self.path.partition('?')
+        with self.server.lock:
+            self.server.hits[path] = self.server.hits.get(path, 0) + 1
+        if query.startswith('delay='):
+            # Returns early when the test is torn down
+            self.server.closing.wait(float(query[len('delay='):]))
+        if path.startswith('/stream/'):
+            return self.stream(path[len('/stream/'):])
+        if path.startswith('/ip/') and path not in self.server.down:
+            body, status = path[len('/ip/'):].encode(), 200
+        else:
+            body, status = b'Internal Server Error', 500
+        try:
+            self.send_response(status)
+            self.send_header('Content-Type', 'text/plain')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        except OSError:
+            # The resolver cancelled the request and hung up
+            pass
+
+    def stream(self, address):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        try:
+            for chunk in (f'<html><body>Your IP is {address}.\n'.encode(), b'</body></html>\n'):
+                self.wfile.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+                self.wfile.flush()
+                self.server.closing.wait(SLOW_DELAY)
+            self.wfile.write(b'0\r\n\r\n')
+        except OSError:
+            pass
+
+
+def closed_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class ExtractIpTest(unittest.TestCase):
+    def test_plain_text(self):
+        self.assertEqual(extract_ip(f'{PUBLIC_IP}\n'), PUBLIC_IP)
+        self.assertEqual(extract_ip(f'{PUBLIC_IP}\n', 'plain'), PUBLIC_IP)
+        # Only the whole body counts with the plain rule
+        self.assertIsNone(extract_ip(f'Your IP: {PUBLIC_IP}', 'plain'))
+        self.assertIsNone(extract_ip(f'{PUBLIC_IP}{" " * 300}', 'plain'))
+
+    def test_ipv6(self):
+        self.assertEqual(extract_ip(f'{PUBLIC_IPV6}\n'), PUBLIC_IPV6)
+        self.assertEqual(extract_ip('2A01:04F8:0C0C:1234:0:0:0:1'), PUBLIC_IPV6)
+        self.assertEqual(extract_ip(f'{{"ip": "{PUBLIC_IPV6}"}}'), PUBLIC_IPV6)
+        self.assertEqual(extract_ip(f'::ffff:{PUBLIC_IP}'), PUBLIC_IP)
+
+    def test_invalid_addresses(self):
+        self.assertIsNone(extract_ip('999.1.1.1'))
+        self.assertIsNone(extract_ip('256.256.256.256', 'plain'))
+        self.assertIsNone(extract_ip('1.2.3.4.5'))
+        self.assertIsNone(extract_ip('version 1.2.3.4a'))
+        self.assertEqual(extract_ip(f'999.1.1.1 {PUBLIC_IP}'), PUBLIC_IP)
+
+    def test_local_addresses(self):
+        for address in ('127.0.0.1', '10.1.2.3', '192.168.1.1', '100.64.0.1', '169.254.1.1', '::1', 'fd00::1'):
+            self.assertIsNone(extract_ip(address), address)
+        self.assertEqual(extract_ip(f'192.168.1.1 via {PUBLIC_IP}'), PUBLIC_IP)
+
+    def test_documentation_address_is_a_fallback(self):
+        self.assertEqual(extract_ip(FAST_IP), FAST_IP)
+        self.assertEqual(extract_ip(f'{FAST_IP} {PUBLIC_IP}'), PUBLIC_IP)
+
+    def test_json(self):
+        self.assertEqual(extract_ip(f'{{"country": "NL", "ip": "{PUBLIC_IP}"}}'), PUBLIC_IP)
+        # httpbin lists the proxies after the client
+        self.assertEqual(extract_ip(f'{{"origin": "{PUBLIC_IP}, 45.67.90.5"}}'), PUBLIC_IP)
+        self.assertEqual(extract_ip(f'{{"data": {{"client": ["x", "{PUBLIC_IP}"]}}}}', 'json:data.client.1'), PUBLIC_IP)
+        self.assertIsNone(extract_ip(f'{{"ip": "{PUBLIC_IP}"}}', 'json:address'))
+        self.assertIsNone(extract_ip(f'{{"ip": "{PUBLIC_IP}"', 'json:ip'))
+
+    def test_html(self):
+        page = ('<html><head><script>var resolver = "8.8.8.8";</script><style>/* 1.1.1.1 */</style></head>'
+                f'<!-- 9.9.9.9 --><body>Your IP address is <b>{PUBLIC_IP}</b></body></html>')
+        self.assertEqual(extract_ip(page), PUBLIC_IP)
+
+    def test_regex(self):
+        text = f'Server 45.67.90.5 says your IP is {PUBLIC_IP}.'
+        self.assertEqual(extract_ip(text, r'regex:IP is ([0-9.]+[0-9])'), PUBLIC_IP)
+        self.assertEqual(extract_ip(text, r'regex:(?<=is )[0-9.]+[0-9]'), PUBLIC_IP)
+        self.assertIsNone(extract_ip(text, r'regex:IP is (\S+)'))
+
+    def test_format_detection(self):
+        for body, detected in ((f' {{"ip": "{PUBLIC_IP}"}}', 'json'), (f'<p>{PUBLIC_IP}</p>', 'html'), (PUBLIC_IP, 'text')):
+            parser = IPResponseParser()
+            parser.feed(body.encode())
+            self.assertEqual((parser.format, parser.close()), (detected, PUBLIC_IP))
+
+
+class IPResponseParserTest(unittest.TestCase):
+    def test_stops_once_address_is_known(self):
+        parser = IPResponseParser()
+        self.assertFalse(parser.feed(b'<p>Your IP is 45.67'))
+        # The address touching the end of what was read may still grow
+        self.assertFalse(parser.feed(b'.89.10'))
+        self.assertTrue(parser.feed(b'</p>'))
+        self.assertTrue(parser.feed(b'never read'))
+        self.assertEqual(parser.close(), PUBLIC_IP)
+
+    def test_regex_stops_once_matched(self):
+        parser = IPResponseParser(r'regex:IP is ([0-9.]+)')
+        self.assertFalse(parser.feed(f'IP is {PUBLIC_IP}'.encode()))
+        self.assertTrue(parser.feed(b'\n'))
+        self.assertEqual(parser.close(), PUBLIC_IP)
+
+    def test_json_is_read_to_the_end(self):
+        parser = IPResponseParser()
+        self.assertFalse(parser.feed(f'{{"ip": "{PUBLIC_IP}", '.encode()))
+        self.assertFalse(parser.feed(b'"proxy": "45.67.90.5"}'))
+        self.assertEqual(parser.close(), PUBLIC_IP)
+
+    def test_documentation_address_waits_for_the_end(self):
+        parser = IPResponseParser()
+        self.assertFalse(parser.feed(f'{FAST_IP}\n'.encode()))
+        self.assertEqual(parser.close(), FAST_IP)
+
+    def test_byte_cap(self):
+        parser = IPResponseParser()
+        self.assertFalse(parser.feed(b' ' * (MAX_RESPONSE_BYTES - 4)))
+        self.assertTrue(parser.feed(f'{PUBLIC_IP}\n'.encode()))
+        self.assertEqual(parser.size, MAX_RESPONSE_BYTES)
+        # The address was cut off at the cap
+        self.assertIsNone(parser.close())
+
+    def test_split_utf8(self):
+        parser = IPResponseParser()
+        data = f'Adresse IP \u00e9tablie : {PUBLIC_IP}\n'.encode()
+        split = data.index(b'\xc3') + 1
+        parser.feed(data[:split])
+        parser.feed(data[split:])
+        self.assertEqual(parser.close(), PUBLIC_IP)
+
+
+class ResolverTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = EchoServer()
+        threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True).start()
+        self.http = HTTPClient()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.addCleanup(self.server.closing.set)
+        self.addCleanup(self.http.close)
+
+    def resolver(self, paths, quorum=1, **kwargs):
+        resolver = IPResolver(self.http, [self.server.url(path) for path in paths], quorum, **kwargs)
+        self.addCleanup(resolver.close)
+        return resolver
+
+    def stats(self, resolver, path):
+        return resolver.source_stats(self.server.url(path))
+
+
+class RaceTest(ResolverTestCase):
+    def test_first_answer_wins(self):
+        resolver = self.resolver([f'/ip/{SLOW_IP}?delay={SLOW_DELAY}', f'/ip/{FAST_IP}'])
+        started = time.monotonic()
+        self.assertEqual(resolver.resolve(), FAST_IP)
+        self.assertLess(time.monotonic() - started, SLOW_DELAY)
+
+    def test_failed_source_is_outrun(self):
+        resolver = self.resolver(['/fail', f'/ip/{FAST_IP}?delay=0.2'])
+        self.assertEqual(resolver.resolve(), FAST_IP)
+        self.assertEqual(self.stats(resolver, '/fail').failures, 1)
+
+    def test_losers_are_cancelled(self):
+        slow = f'/ip/{SLOW_IP}?delay={SLOW_DELAY}'
+        resolver = self.resolver([slow, f'/ip/{FAST_IP}'])
+        self.assertEqual(resolver.resolve(), FAST_IP)
+        stats = self.stats(resolver, slow)
+        deadline = time.monotonic() + WAIT
+        while stats.cancelled == 0 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual((stats.cancelled, stats.failures, stats.successes), (1, 0, 0))
+
+    def test_quorum_waits_for_agreement(self):
+        resolver = self.resolver([f'/ip/{FAST_IP}', f'/ip/{SLOW_IP}?delay=0.1', f'/ip/{FAST_IP}?delay=0.3'], quorum=2)
+        started = time.monotonic()
+        self.assertEqual(resolver.resolve(), FAST_IP)
+        self.assertGreaterEqual(time.monotonic() - started, 0.3)
+
+    def test_quorum_not_reached(self):
+        resolver = self.resolver([f'/ip/{FAST_IP}', f'/ip/{SLOW_IP}', '/fail'], quorum=2)
+        with self.assertRaisesRegex(ResolverError, 'no quorum of 2'):
+            resolver.resolve()
+
+    def test_all_sources_fail(self):
+        resolver = self.resolver(['/fail', '/fail?delay=0.1'])
+        with self.assertRaisesRegex(ResolverError, 'All IP sources failed'):
+            resolver.resolve()
+
+    def test_timeout(self):
+        resolver = self.resolver([f'/ip/{SLOW_IP}?delay={SLOW_DELAY}', f'/ip/{SLOW_IP}?delay={SLOW_DELAY}'])
+        started = time.monotonic()
+        with self.assertRaises(ResolverError):
+            resolver.resolve(timeout=0.2)
+        self.assertLess(time.monotonic() - started, SLOW_DELAY)
+
+
+class SingleSourceTest(ResolverTestCase):
+    def test_single_source(self):
+        self.assertEqual(self.resolver([f'/ip/{FAST_IP}']).resolve(), FAST_IP)
+
+    def test_connection_error_is_a_resolver_error(self):
+        resolver = IPResolver(self.http, [f'http://127.0.0.1:{closed_port()}/ip'])
+        with self.assertRaises(ResolverError):
+            resolver.resolve()
+        with self.assertRaisesRegex(UpdateError, 'Error retrieving IP address'):
+            get_external_ip(resolver)
+
+
+class StreamingTest(ResolverTestCase):
+    def test_body_is_not_read_past_the_address(self):
+        started = time.monotonic()
+        self.assertEqual(self.resolver([f'/stream/{PUBLIC_IP}']).resolve(), PUBLIC_IP)
+        self.assertLess(time.monotonic() - started, SLOW_DELAY)
+
+
+class BreakerTest(ResolverTestCase):
+    # Answers first whenever it is up
+    FLAKY = f'/ip/{FAST_IP}'
+
+    def setUp(self):
+        super().setUp()
+        self.race = self.resolver([self.FLAKY, f'/ip/{SLOW_IP}?delay=0.1'])
+        self.flaky = self.stats(self.race, self.FLAKY)
+        self.flaky.cooldown = 0.2
+        self.server.down.add(self.FLAKY)
+
+    def trip(self):
+        for _ in range(FAILURE_THRESHOLD):
+            self.assertEqual(self.race.resolve(), SLOW_IP)
+        self.assertTrue(self.flaky.is_open())
+
+    def test_open_breaker_skips_source(self):
+        self.trip()
+        self.server.down.clear()
+        self.assertEqual(self.race.resolve(), SLOW_IP)
+        self.assertEqual(self.server.count(self.FLAKY), FAILURE_THRESHOLD)
+
+    def test_half_open_failure_reopens_for_longer(self):
+        self.trip()
+        time.sleep(0.25)
+        self.assertFalse(self.flaky.is_open())
+        self.assertEqual(self.race.resolve(), SLOW_IP)
+        # One trial request after the cooldown, which failed again
+        self.assertEqual(self.server.count(self.FLAKY), FAILURE_THRESHOLD + 1)
+        self.assertTrue(self.flaky.is_open())
+        self.assertEqual(self.flaky.cooldown, 0.4)
+
+    def test_half_open_success_closes(self):
+        self.trip()
+        time.sleep(0.25)
+        self.server.down.clear()
+        self.assertEqual(self.race.resolve(), FAST_IP)
+        self.assertFalse(self.flaky.is_open())
+        self.assertEqual((self.flaky.consecutive_failures, self.flaky.cooldown), (0, BREAKER_COOLDOWN))
+        self.assertEqual(self.race.resolve(), FAST_IP)
+
+    def test_all_open_still_tries(self):
+        resolver = self.resolver(['/fail'])
+        stats = self.stats(resolver, '/fail')
+        for _ in range(FAILURE_THRESHOLD):
+            with self.assertRaises(ResolverError):
+                resolver.resolve()
+        self.assertTrue(stats.is_open())
+        with self.assertRaises(ResolverError):
+            resolver.resolve()
+        self.assertEqual(self.server.count('/fail'), FAILURE_THRESHOLD + 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
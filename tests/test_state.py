@@ -0,0 +1,69 @@
+"""
+Description:
+Tests for MAM.cookie handling in mam_state.py: when StateStore.ensure_cookie keeps an
+existing cookie file and when it writes a fresh one for the configured cookie.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from mam_state import StateStore, cookie_file_values, initial_cookie_file
+
+
+def cookie_line(value, prefix=''):
+    return f"{prefix}.t.myanonamouse.net\tTRUE\t/\tFALSE\t0\tmam_id\t{value}\n"
+
+
+class EnsureCookieTest(unittest.TestCase):
+    def setUp(self):
+        self.statedir = tempfile.mkdtemp(prefix='mam-state-test-')
+        self.addCleanup(shutil.rmtree, self.statedir, ignore_errors=True)
+        self.store = StateStore(self.statedir)
+
+    def write_cookie_file(self, text):
+        with open(self.store.cookiefile, 'w') as f:
+            f.write(text)
+
+    def cookie_values(self):
+        with open(self.store.cookiefile) as f:
+            return cookie_file_values(f.read(), 'mam_id')
+
+    def test_creates_cookie_file(self):
+        self.assertTrue(self.store.ensure_cookie('configured'))
+        self.assertEqual(self.cookie_values(), ['configured'])
+
+    def test_keeps_refreshed_cookie(self):
+        self.store.ensure_cookie('configured')
+        self.write_cookie_file(initial_cookie_file('refreshed'))
+        self.assertFalse(self.store.ensure_cookie('configured'))
+        self.assertEqual(self.cookie_values(), ['refreshed'])
+
+    def test_rewrites_when_configured_cookie_changes(self):
+        self.store.ensure_cookie('configured')
+        self.write_cookie_file(initial_cookie_file('refreshed'))
+        self.assertTrue(self.store.ensure_cookie('rotated'))
+        self.assertEqual(self.cookie_values(), ['rotated'])
+
+    def test_adopts_unseeded_file_with_configured_cookie(self):
+        self.write_cookie_file('# Netscape HTTP Cookie File\n' + cookie_line('configured', '#HttpOnly_'))
+        self.assertFalse(self.store.ensure_cookie('configured'))
+        self.assertIsNotNone(self.store.get('cookie_seed'))
+        self.assertEqual(self.cookie_values(), ['configured'])
+
+    def test_rewrites_unseeded_file_with_other_cookie(self):
+        self.write_cookie_file(initial_cookie_file('stale'))
+        self.assertTrue(self.store.ensure_cookie('configured'))
+        self.assertEqual(self.cookie_values(), ['configured'])
+        self.assertIsNotNone(self.store.get('cookie_seed'))
+
+    def test_recreates_deleted_file(self):
+        self.store.ensure_cookie('configured')
+        os.unlink(self.store.cookiefile)
+        self.assertTrue(self.store.ensure_cookie('configured'))
+        self.assertEqual(self.cookie_values(), ['configured'])
+
+
+if __name__ == '__main__':
+    unittest.main()